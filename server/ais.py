@@ -924,55 +924,83 @@ field_groups = (
 # this: the whole point of the design is to embody most of the information
 # about the AIS format in the pseudoinstruction tables.
 
-from array import array
-
 BITS_PER_BYTE = 8
 
+# the six-bit character set used in AIS strings
+SIXBIT_CHARS = "@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^- !\"#$%&'()*+,-./0123456789:;<=>?"
+# translation table six-bit value (0..63) -> character
+SIXBIT_TABLE = bytes.maketrans(bytes(range(64)), SIXBIT_CHARS.encode('ascii'))
+# translation table armored payload character -> two octal digits (its six-bit value)
+# invalid characters are mapped like the former bit by bit decoding did
+ARMOR_TABLE = {}
+for _c in range(256):
+    _v = _c - 48
+    if _v > 40:
+        _v -= 8
+    ARMOR_TABLE[_c] = "%02o" % (_v & 0x3f)
+
 class BitVector(object):
-    "Fast bit-vector class based on Python built-in array type."
+    """Fast bit-vector class based on a Python int.
+    The int holds capacity bits (a multiple of 8), bit 0 of the vector
+    is the most significant bit of the int."""
     def __init__(self, data=None, length=None):
-        self.bits = array('B')
+        self.value = 0
+        self.capacity = 0
         self.bitlen = 0
         if data is not None:
-            self.bits.extend(data)
+            data = bytes(data)
+            self.value = int.from_bytes(data, 'big')
+            self.capacity = len(data) * 8
             if length is None:
                 self.bitlen = len(data) * 8
             else:
                 self.bitlen = length
+    @property
+    def bits(self):
+        "The content as bytes."
+        return self.value.to_bytes(self.capacity // 8, 'big')
     def extend_to(self, length):
         "Extend vector to given bitlength."
         if length > self.bitlen:
-            self.bits.extend([0]*((length - self.bitlen +7 )//8))
+            add = ((length - self.bitlen + 7) // 8) * 8
+            self.value <<= add
+            self.capacity += add
             self.bitlen = length
     def from_sixbit(self, data, pad=0):
         "Initialize bit vector from AIVDM-style six-bit armoring."
-        self.bits.extend([0] * len(data))
-        for ch in data:
-            ch = ord(ch) - 48
-            if ch > 40:
-                ch -= 8
-            for i in (5, 4, 3, 2, 1, 0):
-                if (ch >> i) & 0x01:
-                    self.bits[self.bitlen//8] |= (1 << (7 - self.bitlen % 8))
-                self.bitlen += 1
-        self.bitlen -= pad
+        if len(data) < 1:
+            self.bitlen -= pad
+            return
+        sixbit = int(data.translate(ARMOR_TABLE), 8)
+        add = len(data) * 8
+        self.value <<= add
+        self.capacity += add
+        self.value |= sixbit << (self.capacity - self.bitlen - 6 * len(data))
+        self.bitlen += 6 * len(data) - pad
     def ubits(self, start, width):
         "Extract a (zero-origin) bitfield from the buffer as an unsigned int."
-        fld = 0
-        for i in range(start//BITS_PER_BYTE, (start + width + BITS_PER_BYTE - 1)//BITS_PER_BYTE):
-            fld <<= BITS_PER_BYTE
-            fld |= self.bits[i]
-        end = (start + width) % BITS_PER_BYTE
-        if end != 0:
-            fld >>= (BITS_PER_BYTE - end)
-        fld &= ~(-1 << width)
-        return fld
+        shift = self.capacity - start - width
+        if shift < 0:
+            raise IndexError("bitfield %d:%d out of range" % (start, width))
+        return (self.value >> shift) & ((1 << width) - 1)
     def sbits(self, start, width):
         "Extract a (zero-origin) bitfield from the buffer as a signed int."
         fld = self.ubits(start, width);
         if fld & (1 << (width-1)):
             fld = -(2 ** width - fld)
         return fld
+    def string(self, start, width):
+        "Extract a six-bit string, stopping at the first @ or at the end of the buffer."
+        nchars = min(width // 6, (self.capacity - start) // 6)
+        if nchars < 1:
+            return ''
+        fld = self.ubits(start, 6 * nchars)
+        value = bytes([(fld >> shift) & 0x3f for shift in range(6 * (nchars - 1), -1, -6)])
+        value = value.translate(SIXBIT_TABLE).decode('ascii')
+        end = value.find('@')
+        if end >= 0:
+            value = value[:end]
+        return value.rstrip()
     def __len__(self):
         return self.bitlen
     def __repr__(self):
@@ -1009,19 +1037,9 @@ def aivdm_unpack(lc, data, offset, values, instructions):
             elif inst.type == 'signed':
                 value = data.sbits(offset, inst.width)
             elif inst.type == 'string':
-                value = ''
-                # The try/catch error here is in case we run off the end
-                # of a variable-length string field, as in messages 12 and 14
-                try:
-                    for i in range(inst.width//6):
-                        newchar = "@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^- !\"#$%&'()*+,-./0123456789:;<=>?"[data.ubits(offset + 6*i, 6)]
-                        if newchar == '@':
-                            break
-                        else:
-                            value += newchar
-                except IndexError:
-                    pass
-                value = value.replace("@", " ").rstrip()
+                # stops at the end of a variable-length string field,
+                # as in messages 12 and 14
+                value = data.string(offset, inst.width)
             elif inst.type == 'raw':
                 # Note: Doesn't rely on the length.
                 value = BitVector(data.bits[offset//8:], len(data)-offset)
@@ -1036,6 +1054,122 @@ def aivdm_unpack(lc, data, offset, values, instructions):
             cooked.append([inst, value])
     return cooked
 
+# Compilation of the instruction tables.  aivdm_unpack interprets the
+# tables for every message; for the message types a consumer really
+# stores we instead generate a specialized function once that directly
+# fills a dict.  The generated code behaves like aivdm_unpack followed
+# by postprocess: unpacking stops at the end of the data, validators
+# raise AISUnpackingException and a repeated string field (the type 21
+# name extension) is appended to the first one.
+
+def message_instructions(msgtype):
+    "Return the instruction table for one message type (header included)."
+    header = aivdm_decode[:-1]
+    subtypes = aivdm_decode[-1].subtypes.get(msgtype)
+    if subtypes is None:
+        return None
+    return tuple(header) + tuple(subtypes)
+
+class _UnpackCompiler(object):
+    "Generates the python source for an unpack function."
+    def __init__(self, converters, names):
+        self.converters = converters or {}
+        self.names = names or {}
+        self.namespace = {'AISUnpackingException': AISUnpackingException,
+                          'BitVector': BitVector}
+        self.lines = []
+        self.counter = 0
+    def symbol(self, prefix, value):
+        self.counter += 1
+        name = "%s_%d" % (prefix, self.counter)
+        self.namespace[name] = value
+        return name
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+    def compile(self, instructions, indent, offset, fields, emitted):
+        for inst in instructions:
+            if inst.conditional is not None:
+                raise ValueError("conditional instructions cannot be compiled")
+            if isinstance(inst, spare):
+                offset += inst.width
+                continue
+            self.emit(indent, "if end <= %d: return rt" % offset)
+            if isinstance(inst, dispatch):
+                if inst is not instructions[-1]:
+                    raise ValueError("dispatch must be the last instruction")
+                compute = self.symbol("compute", inst.compute)
+                self.emit(indent, "sel = %s(%s)" % (compute, fields[inst.fieldname]))
+                first = True
+                for key, subtypes in inst.subtypes.items():
+                    self.emit(indent, "%s sel == %r:" % ("if" if first else "elif", key))
+                    first = False
+                    if subtypes is None:
+                        self.emit(indent + 1, "raise ValueError('no decoder for %s %r')" % (inst.fieldname, key))
+                        continue
+                    self.compile(subtypes, indent + 1, offset, dict(fields), set(emitted))
+                    self.emit(indent + 1, "return rt")
+                self.emit(indent, "raise KeyError(sel)")
+                return
+            var = "f_%d" % self.counter
+            self.counter += 1
+            if inst.type == 'unsigned':
+                self.emit(indent, "%s = (val >> (cap - %d)) & %d" % (var, offset + inst.width, (1 << inst.width) - 1))
+            elif inst.type == 'signed':
+                self.emit(indent, "%s = (val >> (cap - %d)) & %d" % (var, offset + inst.width, (1 << inst.width) - 1))
+                self.emit(indent, "if %s & %d: %s -= %d" % (var, 1 << (inst.width - 1), var, 1 << inst.width))
+            elif inst.type == 'string':
+                self.emit(indent, "%s = data.string(%d, %d)" % (var, offset, inst.width))
+            elif inst.type == 'raw':
+                self.emit(indent, "%s = BitVector(data.bits[%d:], end - %d)" % (var, offset // 8, offset))
+            else:
+                raise ValueError("unknown field type %s" % inst.type)
+            fields[inst.name] = var
+            if inst.validator:
+                validator = self.symbol("validator", inst.validator)
+                self.emit(indent, "if not %s(%s): raise AISUnpackingException(0, %r, %s)" % (validator, var, inst.name, var))
+            name = self.names.get(inst.name, inst.name)
+            converter = self.converters.get(name)
+            if name in emitted:
+                if inst.type != 'string' or converter is not None:
+                    raise ValueError("repeated field %s cannot be compiled" % inst.name)
+                self.emit(indent, "rt[%r] += %s" % (name, var))
+            elif converter is not None:
+                converter = self.symbol("convert", converter)
+                self.emit(indent, "try: rt[%r] = %s(%s)" % (name, converter, var))
+                self.emit(indent, "except Exception: rt[%r] = None" % name)
+            elif inst.type == 'string':
+                self.emit(indent, "rt[%r] = %s" % (name, var))
+            else:
+                self.emit(indent, "rt[%r] = str(%s)" % (name, var))
+            emitted.add(name)
+            offset += inst.width
+
+def compile_unpacker(instructions, converters=None, names=None):
+    """Compile an instruction table into a function unpack(data, rt).
+    The function unpacks the BitVector data into the dict rt and returns it.
+    Field names are translated using names, values are converted
+    with the function from converters for the (translated) name or
+    converted to str if there is none."""
+    compiler = _UnpackCompiler(converters, names)
+    compiler.emit(0, "def unpack(data, rt):")
+    compiler.emit(1, "end = data.bitlen")
+    compiler.emit(1, "val = data.value")
+    compiler.emit(1, "cap = data.capacity")
+    compiler.compile(tuple(instructions), 1, 0, {}, set())
+    compiler.emit(1, "return rt")
+    exec("\n".join(compiler.lines), compiler.namespace)
+    return compiler.namespace['unpack']
+
+def compile_unpackers(msgtypes, converters=None, names=None):
+    "Compile unpack functions for the given message types, returns a dict msgtype->function."
+    rt = {}
+    for msgtype in msgtypes:
+        instructions = message_instructions(msgtype)
+        if instructions is None:
+            continue
+        rt[msgtype] = compile_unpacker(instructions, converters, names)
+    return rt
+
 def packet_scanner(source):
     "Get a span of AIVDM packets with contiguous fragment numbers."
     payloads = {'A':'', 'B':''}
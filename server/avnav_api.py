@@ -198,6 +198,21 @@ class AVNApi(object):
     """
     raise NotImplemented()
 
+  def getChangesSince(self,generation,prefix):
+    """
+    get the changes in the internal store since the last call
+    @param generation: the generation returned by the last call, None for the first call
+    @type  generation: int
+    @param prefix: the prefix like for getDataByPrefix
+    @type  prefix: str
+    @return: a dict with the keys
+             generation: the current generation, provide this for the next call
+             full: True if changed contains all data (e.g. on the first call)
+             changed: a dict with the new or changed values (like getDataByPrefix)
+             removed: a list of the keys that have been removed (prefix removed)
+    """
+    raise NotImplemented()
+
   def getSingleValue(self,key,includeInfo=False):
     """
     get a single value from the store
@@ -434,6 +449,19 @@ class AVNApi(object):
     '''
     raise NotImplemented()
 
+  def registerNMEADecoder(self,sentence,callback):
+    '''
+    register a decoder for an NMEA0183 sentence type the builtin decoder does not handle
+    the callback will be called from the decoder thread for every sentence of this type
+    @param sentence: the sentence type without talker id (e.g. MDA)
+    @param callback: a function callback(fields,source) with fields being the list of
+                     comma separated fields (fields[0] is the talker+sentence, no checksum)
+                     it has to return a dict path->value (or None)
+                     the paths must have been registered in the same way as for addData
+    @return: None - raises an exception if there is already a decoder for this sentence
+    '''
+    raise NotImplemented()
+
   def registerConverter(self,converter:ConverterApi,name=None):
     '''
     register a chart converter
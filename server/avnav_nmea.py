@@ -38,6 +38,129 @@ __date__ ="$29.06.2014 21:28:01$"
 class EmptyPosition(Exception):
   pass
 
+class NMEAFilter(object):
+  '''
+  a compiled NMEA filter
+  the syntax is the same as for NMEAParser.checkFilter - a list of conditions:
+    $     matches all sentences starting with $
+    $XXX  matches sentences of type XXX (any talker)
+    other conditions match the start of the line
+    a leading ^ negates the condition
+  the filter fails if any negated condition matches or
+  if there is at least one positive condition and none of them matches
+  get instances via compile - equal filters will share one instance (and its result cache)
+  '''
+  MAX_CACHE=1000
+  MAX_INSTANCES=200
+  _instances={}
+  _instancesLock=threading.Lock()
+
+  class Conditions(object):
+    def __init__(self):
+      self.allNmea=False
+      self.types=set()
+      self.prefixes={} #trie, None as key marks the end of a prefix
+      self.maxLen=0
+
+    def add(self,condition):
+      if condition[0:1] == '$':
+        if len(condition) < 2:
+          self.allNmea=True
+        else:
+          self.types.add(condition[1:4])
+        return
+      if len(condition) > self.maxLen:
+        self.maxLen=len(condition)
+      node=self.prefixes
+      for c in condition:
+        node=node.setdefault(c,{})
+      node[None]=True
+
+    def matches(self,line):
+      if line[0:1] == '$':
+        if self.allNmea:
+          return True
+        if line[3:6] in self.types:
+          return True
+      node=self.prefixes
+      if None in node:
+        return True
+      for c in line:
+        node=node.get(c)
+        if node is None:
+          return False
+        if None in node:
+          return True
+      return False
+
+  @classmethod
+  def compile(cls,filter):
+    '''
+    get a compiled filter
+    @param filter: a list of conditions or a comma separated string, None for no filter
+    @return: the compiled filter or None if there is no condition
+    '''
+    if filter is None:
+      return None
+    if isinstance(filter,NMEAFilter):
+      return filter
+    if isinstance(filter,str):
+      filter=filter.split(',')
+    key=tuple(filter)
+    if len(key) < 1:
+      return None
+    with cls._instancesLock:
+      rt=cls._instances.get(key)
+      if rt is None:
+        if len(cls._instances) >= cls.MAX_INSTANCES:
+          cls._instances.clear()
+        rt=NMEAFilter(key)
+        cls._instances[key]=rt
+      return rt
+
+  def __init__(self,conditions):
+    self.conditions=conditions
+    self._positive=self.Conditions()
+    self._negative=self.Conditions()
+    self._hasPositive=False
+    for f in conditions:
+      if f[0:1] == '^':
+        self._negative.add(f[1:])
+      else:
+        self._hasPositive=True
+        self._positive.add(f)
+    #the result only depends on the first characters of a line
+    #so we can cache the results for those prefixes (i.e. talker+sentence type)
+    self._keyLen=max(6,self._positive.maxLen,self._negative.maxLen)
+    self._cache={}
+
+  def _check(self,line):
+    if self._negative.matches(line):
+      return False
+    if not self._hasPositive:
+      return True
+    return self._positive.matches(line)
+
+  def matches(self,line):
+    '''
+    check a line
+    @param line: the line as str or bytes
+    '''
+    key=line[0:self._keyLen]
+    if isinstance(key,bytes):
+      key=key.decode('ascii','ignore')
+    rt=self._cache.get(key)
+    if rt is None:
+      rt=self._check(key)
+      if len(self._cache) >= self.MAX_CACHE:
+        self._cache.clear()
+      self._cache[key]=rt
+    return rt
+
+  def __str__(self):
+    return ",".join(self.conditions)
+
+
 #an NMEA parser
 #parses some simple NMEA setences and uses ais from the gpsd project to parse AIS setences
 #adds parsed data to a navdata struct
@@ -59,8 +182,21 @@ class NMEAParser(object):
   NM=AVNUtil.NM
   #a translation table to strip unwanted chars from NMEA0183 input
   STRIPCHARS={i:None for i in range(0,32)}
+  #the same for bytes - use with translate(None,STRIPBYTES)
+  STRIPBYTES=bytes(range(0,32))
   #AIS field translations
   aisFieldTranslations={'msgtype':'type'}
+  #the compiled AIS unpackers for the types we store (msgtype->function)
+  aisUnpackers=ais.compile_unpackers(AVNStore.knownAISTypes,AVNUtil.ais_converters,aisFieldTranslations) if hasAisDecoder else {}
+  #the handlers for the sentence types (tag->handler)
+  #filled by registerSentenceHandler
+  SENTENCE_HANDLERS={}
+  #counters per tag: [parsed,failed,ignored]
+  C_PARSED=0
+  C_FAILED=1
+  C_IGNORED=2
+  MAX_COUNTED_TAGS=200
+  sentenceCounters={}
   K_HDGC=Key('headingCompass','compass heading','\N{DEGREE SIGN}','navigation.headingCompass',signalKConversion=AVNUtil.rad2deg)
   K_HDGM=Key('headingMag','magnetic heading','\N{DEGREE SIGN}','navigation.headingMagnetic',signalKConversion=AVNUtil.rad2deg)
   K_HDGT=Key('headingTrue','true heading','\N{DEGREE SIGN}','navigation.headingTrue',signalKConversion=AVNUtil.rad2deg)
@@ -122,6 +258,51 @@ class NMEAParser(object):
     for satkey in cls.SKY_SATELLITE_KEYS:
       navdata.registerKey(AVNStore.BASE_KEY_SKY+".satellites.*."+satkey,{'description':'sat status entry'},cls.__name__)
   
+  @classmethod
+  def registerSentenceHandler(cls,tag,handler,replace=True):
+    '''
+    register a handler for an NMEA0183 sentence type
+    @param tag: the sentence type without the talker id (e.g. RMC)
+    @param handler: a function handler(parser,tag,darray,source,basePriority,timestamp)
+                    with darray being the comma separated fields (without checksum)
+                    returning True if data has been stored
+                    to store data use parser.addToNavData
+    @param replace: if False, raise an exception if there is already a handler for this tag
+    '''
+    if not replace and tag in cls.SENTENCE_HANDLERS:
+      raise Exception("there is already a handler registered for %s"%tag)
+    if handler is None:
+      cls.SENTENCE_HANDLERS.pop(tag,None)
+      return
+    cls.SENTENCE_HANDLERS[tag]=handler
+
+  @classmethod
+  def getSentenceHandler(cls,tag):
+    return cls.SENTENCE_HANDLERS.get(tag)
+
+  @classmethod
+  def countSentence(cls,tag,counter):
+    counters=cls.sentenceCounters.get(tag)
+    if counters is None:
+      if len(cls.sentenceCounters) >= cls.MAX_COUNTED_TAGS:
+        tag='*'
+        counters=cls.sentenceCounters.get(tag)
+      if counters is None:
+        counters=[0,0,0]
+        cls.sentenceCounters[tag]=counters
+    counters[counter]+=1
+
+  @classmethod
+  def getSentenceStatistics(cls):
+    '''
+    get the counters for all sentence types we have seen
+    @return: a dict tag->{parsed,failed,ignored}
+    '''
+    rt={}
+    for tag,counters in list(cls.sentenceCounters.items()):
+      rt[tag]={'parsed':counters[cls.C_PARSED],'failed':counters[cls.C_FAILED],'ignored':counters[cls.C_IGNORED]}
+    return rt
+
   def __init__(self,navdata):
     self.payloads = {'A':'', 'B':''}    #AIS paylod data
     self.navdata=navdata # type: AVNStore
@@ -229,49 +410,19 @@ class NMEAParser(object):
   #check if the line matches a provided filter
   #filter entries starting with ^are considered as blacklist
   def checkFilter(cls,line,filter):
-    okMatch = False
-    inversMatch = False
-    #only consider the check to fail if nothing matches but we had at least one positive condition
-    hasPositiveCondition = False
+    '''
+    check a line against a filter
+    @param line: the NMEA line
+    @param filter: a list of conditions, a comma separated string or a compiled filter (see NMEAFilter)
+    prefer to compile the filter once with NMEAFilter.compile when checking many lines
+    '''
     try:
+      filter=NMEAFilter.compile(filter)
       if filter is None:
         return True
-      for f in filter:
-        invers=False
-        if f[0:1]=="^":
-          invers=True
-          f=f[1:]
-        else:
-          hasPositiveCondition=True
-        if f[0:1]=='$':
-          if line[0:1]!='$':
-            continue
-          if len(f) < 2:
-            if not invers:
-              okMatch=True
-            else:
-              inversMatch=True
-            continue
-          if f[1:4]==line[3:6]:
-            if not invers:
-              okMatch=True
-            else:
-              inversMatch=True
-            continue
-          continue
-        if line.startswith(f):
-          if not invers:
-            okMatch=True
-          else:
-            inversMatch=True
-          continue
+      return filter.matches(line)
     except:
-      pass
-    if inversMatch:
-      return False
-    if okMatch:
       return True
-    return not hasPositiveCondition
 
   #compute the NMEA checksum
   @classmethod
@@ -302,350 +453,389 @@ class NMEAParser(object):
         AVNLog.debug("cannot parse AIS data (no ais.py found)  %s",data)
         return False
       AVNLog.debug("parse AIS data %s",data)
-      return self.ais_packet_scanner(data,source=source,sourcePriority=sourcePriority,timestamp=timestamp)
+      rt=self.ais_packet_scanner(data,source=source,sourcePriority=sourcePriority,timestamp=timestamp)
+      self.countSentence(darray[0][3:],self.C_PARSED if rt else self.C_IGNORED)
+      return rt
       
     tag=darray[0][3:]
-    rt={}
-    #currently we only take the time from RMC
-    #as only with this one we have really a valid complete timestamp
+    handler=self.SENTENCE_HANDLERS.get(tag)
+    if handler is None:
+      self.countSentence(tag,self.C_IGNORED)
+      return False
     try:
-      if tag=='GGA':
-        mode=int(darray[6] or '0') #quality
-        if mode >= 1:
-          rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[2],darray[3])
-          rt[self.K_LON.key]=self.nmeaPosToFloat(darray[4],darray[5])
-        rt['satUsed']=int(darray[7] or '0')
-        self.addToNavData(rt,source=source,record=tag,timestamp=timestamp)
-        return True
-      if tag=='GSV':
-        rt['satInview']=int(darray[3] or '0')
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      if tag=='GLL':
-        mode=1
-        if len(darray) > 6:
-          mode= (0 if (darray[6] != 'A') else 2)
-        if mode >= 1:
-          rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[1],darray[2])
-          rt[self.K_LON.key]=self.nmeaPosToFloat(darray[3],darray[4])
-          self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      if tag=='VTG':
-        mode=darray[2]
-        rt[self.K_COG.key]=float(darray[1] or '0')
-        if (mode == 'T'):
-          #new mode
-          rt[self.K_SOG.key]=float(darray[5] or '0')*self.NM/3600
-        else:
-          rt[self.K_SOG.key]=float(darray[3]or '0')*self.NM/3600
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      if tag=='RMC':
-        #$--RMC,hhmmss.ss,A,llll.ll,a,yyyyy.yy,a,x.x,x.x,xxxx,x.x,a*hh
-        #this includes current date
-        mode=( 0 if darray[2] != 'A' else 2)
-        if mode >= 1:
-          rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[3],darray[4])
-          rt[self.K_LON.key]=self.nmeaPosToFloat(darray[5],darray[6])
-          if darray[7] != '':
-            rt[self.K_SOG.key]=float(darray[7] or '0')*self.NM/3600
-          if darray[8] != '':
-            rt[self.K_COG.key]=float(darray[8] or '0')
-        gpstime = darray[1]
-        gpsdate = darray[9]
-        if darray[10] != '':
-          if darray[11] == 'E':
-            rt[self.K_MVAR.key] = float(darray[10] or '0')
-          elif darray[11] == 'W':
-            rt[self.K_MVAR.key] = -float(darray[10] or '0')
-        if gpsdate != "" and gpstime != "":
-          rt['time']=self.formatTime(self.gpsTimeToTime(gpstime, gpsdate))
-        self.addToNavData(rt,source=source,priority=basePriority+1,record=tag,timestamp=timestamp)
-        return True
-      if tag == 'ZDA':
-        if darray[1] == '' or darray[2] == '' or darray[3] == '' or darray[4] == '':
-          return False
-        gpstime=darray[1]
-        #ensure each 2 digits for day and month
-        gpsdate=('0' + darray[2])[-2:] +('0' + darray[3])[-2:]+('0000'+darray[4])[-4:]
-        rt['time']=self.formatTime(self.gpsTimeToTime(gpstime,gpsdate))
-        self.addToNavData(rt,source=source,priority=basePriority,record=tag,timestamp=timestamp)
-        return True
-      if tag == 'VWR':
-        '''
-        VWR - Relative Wind Speed and Angle
-         1  2  3  4  5  6  7  8 9
-         |  |  |  |  |  |  |  | |
-        $--VWR,x.x,a,x.x,N,x.x,M,x.x,K*hh<CR><LF>
-      Field Number:
-      1 Wind direction magnitude in degrees
-      2 Wind direction Left/Right of bow
-      3 Speed(Knots)
-      4 N = Knots
-      5 Speed (m/s)
-      6 M = Meters Per Second
-      7 Speed (km/h)
-      8 K = Kilometers Per Hour
-        Checksum
-        '''
-        windAngle=float(darray[1] or '0')
-        dir=darray[2]
-        rt[self.K_AWA.key]= 360-windAngle if ( dir == 'L' or dir == 'l') else windAngle
-        priority=0
-        #we keep the speed im m/s
-        windspeed=None
-        if darray[3] != '':
-          windspeed=float(darray[3] or '0')
-          windspeed=windspeed*self.NM/3600
-        elif darray[5] != '':
-          windspeed=float(darray[5] or '0')
-          windspeed=windspeed/3.6
-        elif darray[7] != '':
-          windspeed=float(darray[7] or '0')
-        if windspeed is not None:
-          rt[self.K_AWS.key]=windspeed
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority+priority,timestamp=timestamp)
-        return True
-      if tag == 'MWV':
-        '''
-        $--MWV,x.x,a,x.x,a*hh<CR><LF>
-        Field Number:
-        1) Wind Angle, 0 to 360 degrees
-        2) Reference, R = Relative, T = True
-        3) Wind Speed
-        4) Wind Speed Units, K/M/N
-        5) Status, A = Data Valid
-        6) Checksum
-        '''
-        ref=darray[2]
-        angleKey=self.K_TWA if ref == 'T' else self.K_AWA
-        speedKey=self.K_TWS if ref == 'T' else self.K_AWS
-        rt[angleKey.key]=float(darray[1])
-        #we keep the speed im m/s
-        windspeed=float(darray[3] or '0')
-        if (darray[4] == 'K'):
-          windspeed=windspeed/3.6
-        if (darray[4] == 'N'):
-          windspeed=windspeed*self.NM/3600
-        rt[speedKey.key]=windspeed
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      if tag == 'MWD':
-        hasData=False
-        '''
-        $WIMWD,10.1,T,10.1,M,12,N,40,M*5D
-        https://github.com/adrianmo/go-nmea/blob/master/mwd.go
-        '''
-        if darray[1] != '':
-          rt[self.K_TWD.key]=float(darray[1])
-          hasData=True
-        else:
-          if darray[3] != '':
-            rt[self.K_TWD.key] = float(darray[3])
-            hasData=True
-        if ( darray[8] == 'M' or darray[8] == 'm') and darray[7] != '':
-          rt[self.K_TWS.key]=float(darray[7])
-          hasData=True
-        else:
-          if (darray[6] == 'N' or darray[6] == 'n') and darray[5] != '':
-            rt[self.K_TWS.key] = float(darray[5]) * self.NM/3600.0
-            hasData=True
-        if hasData:
-          self.addToNavData(rt, source=source, record=tag, priority=basePriority,timestamp=timestamp)
-        return True
-      if tag == 'DPT':
-        '''
-               DPT - Depth of water
-               1   2   3
-               |   |   |
-        $--DPT,x.x,x.x*hh<CR><LF>
-        Field Number:
-        1) Depth, meters
-        2) Offset from transducer,
-            positive means distance from tansducer to water line
-            negative means distance from transducer to keel
-        3) Checksum
-        '''
-        rt[self.K_DEPTHT.key] = float(darray[1] or '0')
-        if len(darray[2]) > 0:
-          if float(darray[2]) >= 0:
-            rt[self.K_DEPTHW.key] = float(darray[1] or '0') + float(darray[2] or '0')
-          else:
-            rt[self.K_DEPTHK.key] = float(darray[1] or '0') + float(darray[2] or '0')
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      if tag == 'DBT':
-        '''
-                DBT - Depth below transducer
-                1   2 3   4 5   6 7
-                |   | |   | |   | |
-        $--DBT,x.x,f,x.x,M,x.x,F*hh<CR><LF>
-        Field Number:
-         1) Depth, feet
-         2) f = feet
-         3) Depth, meters
-         4) M = meters
-         5) Depth, Fathoms
-         6) F = Fathoms
-         7) Checksum
-        '''
-        if len(darray[3]) > 0:
-          rt[self.K_DEPTHT.key] = float(darray[3] or '0')
-          self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-          return True
-        return False
-
-      #HDG - Heading - Deviation & Variation
-      #
-      #        1   2   3 4   5 6
-      #        |   |   | |   | |
-      # $--HDG,x.x,x.x,a,x.x,a*hh<CR><LF>
-
-      #Field Number:
-      # 1) Magnetic Sensor heading in degrees
-      #  2) Magnetic Deviation, degrees
-      #  3) Magnetic Deviation direction, E = Easterly, W = Westerly
-      #  4) Magnetic Variation degrees
-      #  5) Magnetic Variation direction, E = Easterly, W = Westerly
-      #  6) Checksum
-
-      if tag == 'HDG':
-        MagDevDir=None
-        heading_c=None
-        MagDeviation=0
-        MagVarDir=None
-        MagVariation=None
-        if(len(darray[1]) > 0):
-          heading_c = float(darray[1] or '0')
-          rt[self.K_HDGC.key] = heading_c
-        if(len(darray[2]) > 0):
-          MagDeviation = float(darray[2] or '0')  # --> Ablenkung
-          if(len(darray[3]) > 0):
-            MagDevDir = darray[3] or 'X'
-        if(len(darray[4]) > 0):
-          MagVariation = float(darray[4] or '0')  # --> Missweisung
-          if(len(darray[5]) > 0):
-            MagVarDir = darray[5] or 'X'
-        # Deviation
-        heading_m = heading_c
-        if MagDevDir == 'E':
-          heading_m += MagDeviation
-          rt[self.K_MDEV.key] = MagDeviation
-        elif MagDevDir == 'W':
-          heading_m -= MagDeviation
-          rt[self.K_MDEV.key] = -MagDeviation
-        rt[self.K_HDGM.key] = heading_m
-
-        # True course
-        heading_t = None
-        if MagVarDir is not None and MagVariation is not None:
-          if MagVarDir == 'E':
-            heading_t = heading_m + MagVariation
-            rt[self.K_MVAR.key] = MagVariation
-          elif MagVarDir == 'W':
-            heading_t = heading_m - MagVariation
-            rt[self.K_MVAR.key] = -MagVariation
-        if heading_t is not None:
-          rt[self.K_HDGT.key] = heading_t
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
+      rt=handler(self,tag,darray,source,basePriority,timestamp)
+      self.countSentence(tag,self.C_PARSED if rt else self.C_IGNORED)
+      return rt
+    except EmptyPosition:
+      AVNLog.ld("empty position in %s",str(data))
+      self.countSentence(tag,self.C_IGNORED)
+      return False
+    except Exception as e:
+      AVNLog.info(" error parsing nmea data " + str(data) + "\n" + traceback.format_exc())
+      self.countSentence(tag,self.C_FAILED)
 
-      if tag == 'HDM' or tag == 'HDT':
-        heading=None
-        if len(darray[1]) > 0:
-          heading = float(darray[1] or '0')
-        magortrue = darray[2]
-        if heading is not None:
-          if magortrue == 'T':
-            rt[self.K_HDGT.key]=heading
-          else:
-            rt[self.K_HDGM.key]=heading
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
+  #the sentence handlers
+  #currently we only take the time from RMC
+  #as only with this one we have really a valid complete timestamp
+  def _parseGGA(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    mode=int(darray[6] or '0') #quality
+    if mode >= 1:
+      rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[2],darray[3])
+      rt[self.K_LON.key]=self.nmeaPosToFloat(darray[4],darray[5])
+    rt['satUsed']=int(darray[7] or '0')
+    self.addToNavData(rt,source=source,record=tag,timestamp=timestamp)
+    return True
 
+  def _parseGSV(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    rt['satInview']=int(darray[3] or '0')
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
 
+  def _parseGLL(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    mode=1
+    if len(darray) > 6:
+      mode= (0 if (darray[6] != 'A') else 2)
+    if mode >= 1:
+      rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[1],darray[2])
+      rt[self.K_LON.key]=self.nmeaPosToFloat(darray[3],darray[4])
+      self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
 
-      if tag == 'VDR':
-        """ set and drift https://gpsd.gitlab.io/gpsd/NMEA.html#_vdr_set_and_drift
-                   1   2 3   4 5   6 7
-                   |   | |   | |   | |
-            $--VDR,x.x,T,x.x,M,x.x,N*hh<CR><LF>
-            1 set degrees true
-            3 set degrees magnetic
-            5 drift knots
-            """
-        if len(darray[1])>0 and darray[2]=="T":
-          rt[self.K_SET.key] = float(darray[1])
-        if len(darray[5])>0 and darray[6]=="N":
-          rt[self.K_DFT.key] = float(darray[5])
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
-      
-      #VHW - Water speed and heading
-
-      #        1   2 3   4 5   6 7   8 9
-      #        |   | |   | |   | |   | |
-      # $--VHW,x.x,T,x.x,M,x.x,N,x.x,K*hh<CR><LF>
-
-      # Field Number:
-      #  1) Degress True
-      #  2) T = True
-      #  3) Degrees Magnetic
-      #  4) M = Magnetic
-      #  5) Knots (speed of vessel relative to the water)
-      #  6) N = Knots
-      #  7) Kilometers (speed of vessel relative to the water)
-      #  8) K = Kilometers
-      #  9) Checksum
-
-
-      if tag == 'VHW':
-        if len(darray[1]) > 0:  # Heading True
-          rt[self.K_HDGT.key] = float(darray[1] or '0')
-        if(len(darray[3]) > 0):
-          rt[self.K_HDGM.key] = float(darray[3] or '0')  # Heading magnetic
-        if len(darray[5]) > 0:
-          rt[self.K_VHWS.key]= float(darray[5] or '0')*self.NM/3600
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
+  def _parseVTG(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    mode=darray[2]
+    rt[self.K_COG.key]=float(darray[1] or '0')
+    if (mode == 'T'):
+      #new mode
+      rt[self.K_SOG.key]=float(darray[5] or '0')*self.NM/3600
+    else:
+      rt[self.K_SOG.key]=float(darray[3]or '0')*self.NM/3600
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
 
-      if tag == 'MTW':
-        # $--MTW,x.x,C*hh<CR><LF>
-        if len(darray[1]) > 0:
-          rt[self.K_VWTT.key] = float(darray[1])+273.15
-        self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
-        return True
+  def _parseRMC(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    #$--RMC,hhmmss.ss,A,llll.ll,a,yyyyy.yy,a,x.x,x.x,xxxx,x.x,a*hh
+    #this includes current date
+    mode=( 0 if darray[2] != 'A' else 2)
+    if mode >= 1:
+      rt[self.K_LAT.key]=self.nmeaPosToFloat(darray[3],darray[4])
+      rt[self.K_LON.key]=self.nmeaPosToFloat(darray[5],darray[6])
+      if darray[7] != '':
+        rt[self.K_SOG.key]=float(darray[7] or '0')*self.NM/3600
+      if darray[8] != '':
+        rt[self.K_COG.key]=float(darray[8] or '0')
+    gpstime = darray[1]
+    gpsdate = darray[9]
+    if darray[10] != '':
+      if darray[11] == 'E':
+        rt[self.K_MVAR.key] = float(darray[10] or '0')
+      elif darray[11] == 'W':
+        rt[self.K_MVAR.key] = -float(darray[10] or '0')
+    if gpsdate != "" and gpstime != "":
+      rt['time']=self.formatTime(self.gpsTimeToTime(gpstime, gpsdate))
+    self.addToNavData(rt,source=source,priority=basePriority+1,record=tag,timestamp=timestamp)
+    return True
 
-      if tag == 'XDR':
-        # $--XDR,a,x.x,a,c--c, ..... *hh<CR><LF>
-        lf = len(darray)
-        i = 1
-        hasData=False
-        while i < (lf -3):
-          try:
-            # we need 4 fields
-            if darray[i + 1] is not None and darray[i] != "":
-              ttype = darray[i]
-              tdata = float(darray[i + 1] or '0')
-              tunit = darray[i + 2]
-              tname = darray[i + 3]
-              data=self.convertXdrValue(tdata,tunit)
-              if tname is not None and tname != "":
-                rt["transducers."+tname]=data
-                hasData=True
-          except Exception as e:
-            AVNLog.debug("decode %s at pos %d failed: %s"%(data,i,str(e)))
-            pass
-          i+=4
-        if hasData:
-          self.addToNavData(rt, source=source, record=tag,priority=basePriority,timestamp=timestamp)
-          return True
-        return False
-    except EmptyPosition:
-      AVNLog.ld("empty position in %s",str(data))
+  def _parseZDA(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    if darray[1] == '' or darray[2] == '' or darray[3] == '' or darray[4] == '':
       return False
-    except Exception as e:
-      AVNLog.info(" error parsing nmea data " + str(data) + "\n" + traceback.format_exc())
+    gpstime=darray[1]
+    #ensure each 2 digits for day and month
+    gpsdate=('0' + darray[2])[-2:] +('0' + darray[3])[-2:]+('0000'+darray[4])[-4:]
+    rt['time']=self.formatTime(self.gpsTimeToTime(gpstime,gpsdate))
+    self.addToNavData(rt,source=source,priority=basePriority,record=tag,timestamp=timestamp)
+    return True
+
+  def _parseVWR(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    '''
+    VWR - Relative Wind Speed and Angle
+     1  2  3  4  5  6  7  8 9
+     |  |  |  |  |  |  |  | |
+    $--VWR,x.x,a,x.x,N,x.x,M,x.x,K*hh<CR><LF>
+  Field Number:
+  1 Wind direction magnitude in degrees
+  2 Wind direction Left/Right of bow
+  3 Speed(Knots)
+  4 N = Knots
+  5 Speed (m/s)
+  6 M = Meters Per Second
+  7 Speed (km/h)
+  8 K = Kilometers Per Hour
+    Checksum
+    '''
+    windAngle=float(darray[1] or '0')
+    dir=darray[2]
+    rt[self.K_AWA.key]= 360-windAngle if ( dir == 'L' or dir == 'l') else windAngle
+    priority=0
+    #we keep the speed im m/s
+    windspeed=None
+    if darray[3] != '':
+      windspeed=float(darray[3] or '0')
+      windspeed=windspeed*self.NM/3600
+    elif darray[5] != '':
+      windspeed=float(darray[5] or '0')
+      windspeed=windspeed/3.6
+    elif darray[7] != '':
+      windspeed=float(darray[7] or '0')
+    if windspeed is not None:
+      rt[self.K_AWS.key]=windspeed
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority+priority,timestamp=timestamp)
+    return True
+
+  def _parseMWV(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    '''
+    $--MWV,x.x,a,x.x,a*hh<CR><LF>
+    Field Number:
+    1) Wind Angle, 0 to 360 degrees
+    2) Reference, R = Relative, T = True
+    3) Wind Speed
+    4) Wind Speed Units, K/M/N
+    5) Status, A = Data Valid
+    6) Checksum
+    '''
+    ref=darray[2]
+    angleKey=self.K_TWA if ref == 'T' else self.K_AWA
+    speedKey=self.K_TWS if ref == 'T' else self.K_AWS
+    rt[angleKey.key]=float(darray[1])
+    #we keep the speed im m/s
+    windspeed=float(darray[3] or '0')
+    if (darray[4] == 'K'):
+      windspeed=windspeed/3.6
+    if (darray[4] == 'N'):
+      windspeed=windspeed*self.NM/3600
+    rt[speedKey.key]=windspeed
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseMWD(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    hasData=False
+    '''
+    $WIMWD,10.1,T,10.1,M,12,N,40,M*5D
+    https://github.com/adrianmo/go-nmea/blob/master/mwd.go
+    '''
+    if darray[1] != '':
+      rt[self.K_TWD.key]=float(darray[1])
+      hasData=True
+    else:
+      if darray[3] != '':
+        rt[self.K_TWD.key] = float(darray[3])
+        hasData=True
+    if ( darray[8] == 'M' or darray[8] == 'm') and darray[7] != '':
+      rt[self.K_TWS.key]=float(darray[7])
+      hasData=True
+    else:
+      if (darray[6] == 'N' or darray[6] == 'n') and darray[5] != '':
+        rt[self.K_TWS.key] = float(darray[5]) * self.NM/3600.0
+        hasData=True
+    if hasData:
+      self.addToNavData(rt, source=source, record=tag, priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseDPT(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    '''
+           DPT - Depth of water
+           1   2   3
+           |   |   |
+    $--DPT,x.x,x.x*hh<CR><LF>
+    Field Number:
+    1) Depth, meters
+    2) Offset from transducer,
+        positive means distance from tansducer to water line
+        negative means distance from transducer to keel
+    3) Checksum
+    '''
+    rt[self.K_DEPTHT.key] = float(darray[1] or '0')
+    if len(darray[2]) > 0:
+      if float(darray[2]) >= 0:
+        rt[self.K_DEPTHW.key] = float(darray[1] or '0') + float(darray[2] or '0')
+      else:
+        rt[self.K_DEPTHK.key] = float(darray[1] or '0') + float(darray[2] or '0')
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseDBT(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    '''
+            DBT - Depth below transducer
+            1   2 3   4 5   6 7
+            |   | |   | |   | |
+    $--DBT,x.x,f,x.x,M,x.x,F*hh<CR><LF>
+    Field Number:
+     1) Depth, feet
+     2) f = feet
+     3) Depth, meters
+     4) M = meters
+     5) Depth, Fathoms
+     6) F = Fathoms
+     7) Checksum
+    '''
+    if len(darray[3]) > 0:
+      rt[self.K_DEPTHT.key] = float(darray[3] or '0')
+      self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+      return True
+    return False
+
+
+  #HDG - Heading - Deviation & Variation
+  #
+  #        1   2   3 4   5 6
+  #        |   |   | |   | |
+  # $--HDG,x.x,x.x,a,x.x,a*hh<CR><LF>
+
+  #Field Number:
+  # 1) Magnetic Sensor heading in degrees
+  #  2) Magnetic Deviation, degrees
+  #  3) Magnetic Deviation direction, E = Easterly, W = Westerly
+  #  4) Magnetic Variation degrees
+  #  5) Magnetic Variation direction, E = Easterly, W = Westerly
+  #  6) Checksum
+
+  def _parseHDG(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    MagDevDir=None
+    heading_c=None
+    MagDeviation=0
+    MagVarDir=None
+    MagVariation=None
+    if(len(darray[1]) > 0):
+      heading_c = float(darray[1] or '0')
+      rt[self.K_HDGC.key] = heading_c
+    if(len(darray[2]) > 0):
+      MagDeviation = float(darray[2] or '0')  # --> Ablenkung
+      if(len(darray[3]) > 0):
+        MagDevDir = darray[3] or 'X'
+    if(len(darray[4]) > 0):
+      MagVariation = float(darray[4] or '0')  # --> Missweisung
+      if(len(darray[5]) > 0):
+        MagVarDir = darray[5] or 'X'
+    # Deviation
+    heading_m = heading_c
+    if MagDevDir == 'E':
+      heading_m += MagDeviation
+      rt[self.K_MDEV.key] = MagDeviation
+    elif MagDevDir == 'W':
+      heading_m -= MagDeviation
+      rt[self.K_MDEV.key] = -MagDeviation
+    rt[self.K_HDGM.key] = heading_m
+
+    # True course
+    heading_t = None
+    if MagVarDir is not None and MagVariation is not None:
+      if MagVarDir == 'E':
+        heading_t = heading_m + MagVariation
+        rt[self.K_MVAR.key] = MagVariation
+      elif MagVarDir == 'W':
+        heading_t = heading_m - MagVariation
+        rt[self.K_MVAR.key] = -MagVariation
+    if heading_t is not None:
+      rt[self.K_HDGT.key] = heading_t
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseHDM(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    heading=None
+    if len(darray[1]) > 0:
+      heading = float(darray[1] or '0')
+    magortrue = darray[2]
+    if heading is not None:
+      if magortrue == 'T':
+        rt[self.K_HDGT.key]=heading
+      else:
+        rt[self.K_HDGM.key]=heading
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseVDR(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    """ set and drift https://gpsd.gitlab.io/gpsd/NMEA.html#_vdr_set_and_drift
+               1   2 3   4 5   6 7
+               |   | |   | |   | |
+        $--VDR,x.x,T,x.x,M,x.x,N*hh<CR><LF>
+        1 set degrees true
+        3 set degrees magnetic
+        5 drift knots
+        """
+    if len(darray[1])>0 and darray[2]=="T":
+      rt[self.K_SET.key] = float(darray[1])
+    if len(darray[5])>0 and darray[6]=="N":
+      rt[self.K_DFT.key] = float(darray[5])
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  
+  #VHW - Water speed and heading
+
+  #        1   2 3   4 5   6 7   8 9
+  #        |   | |   | |   | |   | |
+  # $--VHW,x.x,T,x.x,M,x.x,N,x.x,K*hh<CR><LF>
+
+  # Field Number:
+  #  1) Degress True
+  #  2) T = True
+  #  3) Degrees Magnetic
+  #  4) M = Magnetic
+  #  5) Knots (speed of vessel relative to the water)
+  #  6) N = Knots
+  #  7) Kilometers (speed of vessel relative to the water)
+  #  8) K = Kilometers
+  #  9) Checksum
+
+
+  def _parseVHW(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    if len(darray[1]) > 0:  # Heading True
+      rt[self.K_HDGT.key] = float(darray[1] or '0')
+    if(len(darray[3]) > 0):
+      rt[self.K_HDGM.key] = float(darray[3] or '0')  # Heading magnetic
+    if len(darray[5]) > 0:
+      rt[self.K_VHWS.key]= float(darray[5] or '0')*self.NM/3600
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseMTW(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    # $--MTW,x.x,C*hh<CR><LF>
+    if len(darray[1]) > 0:
+      rt[self.K_VWTT.key] = float(darray[1])+273.15
+    self.addToNavData(rt,source=source,record=tag,priority=basePriority,timestamp=timestamp)
+    return True
+
+  def _parseXDR(self,tag,darray,source,basePriority,timestamp):
+    rt={}
+    # $--XDR,a,x.x,a,c--c, ..... *hh<CR><LF>
+    lf = len(darray)
+    i = 1
+    hasData=False
+    while i < (lf -3):
+      try:
+        # we need 4 fields
+        if darray[i + 1] is not None and darray[i] != "":
+          ttype = darray[i]
+          tdata = float(darray[i + 1] or '0')
+          tunit = darray[i + 2]
+          tname = darray[i + 3]
+          value=self.convertXdrValue(tdata,tunit)
+          if tname is not None and tname != "":
+            rt["transducers."+tname]=value
+            hasData=True
+      except Exception as e:
+        AVNLog.debug("decode %s at pos %d failed: %s"%(",".join(darray),i,str(e)))
+        pass
+      i+=4
+    if hasData:
+      self.addToNavData(rt, source=source, record=tag,priority=basePriority,timestamp=timestamp)
+      return True
+    return False
 
   @classmethod
   def convertXdrValue(self, value, unit):
@@ -664,14 +854,19 @@ class NMEAParser(object):
       value=value*100*1000
     return value
 
-  #parse one line of AIS data 
-  #taken from ais.py and adapted to our input handling     
-  def ais_packet_scanner(self,line,source='internal',sourcePriority=DEFAULT_SOURCE_PRIORITY,timestamp=None):
-    basePriority=sourcePriority*10
+  #assemble AIS payloads from one line of AIS data
+  #taken from ais.py and adapted to our input handling
+  def assembleAisPayload(self,line):
+    '''
+    add a line of AIS data to the payload of its channel
+    @param line: the NMEA line
+    @return: None for invalid data, True if we wait for more fragments,
+             (payload,pad) if the payload is complete
+    '''
     "Get a span of AIVDM packets with contiguous fragment numbers."
     if not line.startswith("!"):
       AVNLog.debug("ignore unknown AIS data %s",line)
-      return False
+      return None
     line = line.strip()
     # Strip off USCG metadata 
     line = re.sub(r"(?<=\*[0-9A-F][0-9A-F]),.*", "", line)
@@ -703,77 +898,111 @@ class NMEAParser(object):
         crc = fields[6].split('*')[1].strip()
     except IndexError as e:
         AVNLog.debug("malformed line: %s: %sn",line.strip(),traceback.format_exc())
-        return False
+        return None
     if csum != crc:
         AVNLog.debug("bad checksum %s, expecting %s: %s\n",crc, csum, line.strip())
-        return False
+        return None
     if fragment < expect:
         AVNLog.debug("waiting for more fragments on channel %s: %s",channel,line.strip())
         return True
     else:
       if fragment > '1':
         AVNLog.debug("fragments now complete on channel %s with number %s: %s", channel, fragment,line.strip())
-    # Render assembled payload to packed bytes
-    bits = ais.BitVector()
-    bits.from_sixbit(self.payloads[channel], pad)
-    rt=self.parse_ais_messages(self.payloads[channel], bits,source=source,priority=basePriority,timestamp=timestamp)
+    payload=self.payloads[channel]
     self.payloads[channel]=''
-    return rt
+    return (payload,pad)
 
+  #parse one line of AIS data 
+  def ais_packet_scanner(self,line,source='internal',sourcePriority=DEFAULT_SOURCE_PRIORITY,timestamp=None):
+    basePriority=sourcePriority*10
+    payload=self.assembleAisPayload(line)
+    if payload is None:
+      return False
+    if payload is True:
+      return True
+    return self.storeAISdata(decodeAisPayload(*payload),source=source,priority=basePriority,timestamp=timestamp)
 
-  #basically taken from ais.py but changed to decode one message at a time
-  def parse_ais_messages(self,raw,bits,source='internal',priority=0,timestamp=None):
-      "Generator code - read forever from source stream, parsing AIS messages."
-      values = {}
-      values['length'] = bits.bitlen
-      # Without the following magic, we'd have a subtle problem near
-      # certain variable-length messages: DSV reports would
-      # sometimes have fewer fields than expected, because the
-      # unpacker would never generate cooked tuples for the omitted
-      # part of the message.  Presently a known issue for types 15
-      # and 16 only.  (Would never affect variable-length messages in
-      # which the last field type is 'string' or 'raw').
-      bits.extend_to(168)
-      # Magic recursive unpacking operation
-      try:
-          cooked = ais.aivdm_unpack(0, bits, 0, values, ais.aivdm_decode)
-          # Apply the postprocessor stage
-          cooked = ais.postprocess(cooked)
-          expected = ais.lengths.get(values['msgtype'], None)
-          # Check length; has to be done after so we have the type field 
-          bogon = False
-          if expected is not None:
-              if type(expected) == type(0):
-                  expected_range = (expected, expected)
-              else:
-                  expected_range = expected
-              actual = values['length']
-              if not (actual >= expected_range[0] and actual <= expected_range[1]):
-                  raise Exception("invalid length %d(%d..%d)"%(actual,expected_range[0],expected_range[1]))
-          # We're done, hand back a decoding
-          #AVNLog.ld('decoded AIS data',cooked)
-          self.storeAISdata(cooked,source=source,priority=priority,timestamp=timestamp)
-          return True
-      except:
-          AVNLog.debug("exception %s while decoding AIS data %s",traceback.format_exc())
-          return False
-  
-  def storeAISdata(self,bitfield,source='internal',priority=0,timestamp=None):
-    rt={'class':'AIS'}
-    storeData=False
-    for bfe in bitfield:
-      try:
-        name=bfe[0].name
-        tname=self.aisFieldTranslations.get(name)
-        if tname is not None:
-          name=tname
-        val=str(bfe[1])
-        rt[name]=val
-      except:
-        AVNLog.debug("exception in getting AIS message: %s",traceback.format_exc())
-    mmsi=rt.get('mmsi')
-    if mmsi is None:
+  @classmethod
+  def unpackAisMessage(cls,bits):
+    '''
+    unpack an AIS message using the compiled unpackers (see aisUnpackers)
+    messages of types we do not store are rejected after the type field
+    @param bits: the ais.BitVector with the message
+    @return: the AIS dict, None if the message is not valid or of an unknown type
+    '''
+    if bits.bitlen < 1:
+      return None
+    msgtype=bits.ubits(0,6)
+    unpacker=cls.aisUnpackers.get(msgtype)
+    if unpacker is None:
+      AVNLog.debug("ignoring AIS message of type %d",msgtype)
+      return None
+    expected=ais.lengths.get(msgtype)
+    if expected is not None:
+      if type(expected) == type(0):
+        expected=(expected,expected)
+      if bits.bitlen < expected[0] or bits.bitlen > expected[1]:
+        AVNLog.debug("invalid AIS length %d(%d..%d) for type %d",bits.bitlen,expected[0],expected[1],msgtype)
+        return None
+    # see ais.parse_ais_messages for the reason of this magic
+    bits.extend_to(168)
+    try:
+      rt=unpacker(bits,{'class':'AIS'})
+    except:
+      AVNLog.debug("exception %s while decoding AIS data",traceback.format_exc())
+      return None
+    if rt.get('mmsi') is None:
       AVNLog.debug("ignoring AIS data without mmsi, %s"%rt)
-      return
-    self.navdata.setAisValue(mmsi,AVNUtil.convertAIS(rt),source=source,priority=priority,timestamp=timestamp)
-    
+      return None
+    try:
+      rt["beam"] = rt["to_port"] + rt["to_starboard"]
+      rt["length"] = rt["to_bow"] + rt["to_stern"]
+    except:
+      pass
+    return rt
+
+  def storeAISdata(self,data,source='internal',priority=0,timestamp=None):
+    '''
+    store a decoded AIS message
+    @param data: the result of decodeAisPayload
+    @return: True if stored
+    '''
+    if data is None:
+      return False
+    self.navdata.setAisValue(data.get('mmsi'),data,source=source,priority=priority,timestamp=timestamp)
+    return True
+
+
+def decodeAisPayload(payload,pad):
+  '''
+  decode an assembled AIS payload
+  this is the CPU intensive part of the AIS decoding and does not need any state
+  so it can run in a separate process (see AVNDecoder)
+  @param payload: the armored payload
+  @param pad: the number of pad bits
+  @return: the AIS dict or None
+  '''
+  bits = ais.BitVector()
+  bits.from_sixbit(payload, pad)
+  return NMEAParser.unpackAisMessage(bits)
+
+
+#register the builtin sentence handlers
+NMEAParser.registerSentenceHandler('GGA',NMEAParser._parseGGA)
+NMEAParser.registerSentenceHandler('GSV',NMEAParser._parseGSV)
+NMEAParser.registerSentenceHandler('GLL',NMEAParser._parseGLL)
+NMEAParser.registerSentenceHandler('VTG',NMEAParser._parseVTG)
+NMEAParser.registerSentenceHandler('RMC',NMEAParser._parseRMC)
+NMEAParser.registerSentenceHandler('ZDA',NMEAParser._parseZDA)
+NMEAParser.registerSentenceHandler('VWR',NMEAParser._parseVWR)
+NMEAParser.registerSentenceHandler('MWV',NMEAParser._parseMWV)
+NMEAParser.registerSentenceHandler('MWD',NMEAParser._parseMWD)
+NMEAParser.registerSentenceHandler('DPT',NMEAParser._parseDPT)
+NMEAParser.registerSentenceHandler('DBT',NMEAParser._parseDBT)
+NMEAParser.registerSentenceHandler('HDG',NMEAParser._parseHDG)
+NMEAParser.registerSentenceHandler('HDM',NMEAParser._parseHDM)
+NMEAParser.registerSentenceHandler('HDT',NMEAParser._parseHDM)
+NMEAParser.registerSentenceHandler('VDR',NMEAParser._parseVDR)
+NMEAParser.registerSentenceHandler('VHW',NMEAParser._parseVHW)
+NMEAParser.registerSentenceHandler('MTW',NMEAParser._parseMTW)
+NMEAParser.registerSentenceHandler('XDR',NMEAParser._parseXDR)
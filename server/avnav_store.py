@@ -26,7 +26,11 @@
 ###############################################################################
 
 
+import heapq
+import itertools
+import math
 import time
+import weakref
 
 from avnav_util import *
 
@@ -38,11 +42,14 @@ class AVNStore(object):
   BASE_KEY_SKY = 'sky'
 
   AIS_AGE_KEY='age'
+  AIS_DISTANCE_KEY='distance'
+  #cell size (degrees) for the AIS grid
+  AIS_GRID=0.25
 
   KEY_VERSION= BASE_KEY_GPS+".version"
 
   # AIS messages we store
-  knownAISTypes = (1, 2, 3, 5, 18, 19, 24)
+  knownAISTypes = (1, 2, 3, 4, 5, 18, 19, 21, 24)
   class DataEntry(object):
     def __init__(self,value,source=None,priority=0,keepAlways=False,record=None,timestamp=None):
       self.value=value
@@ -54,29 +61,115 @@ class AVNStore(object):
       self.priority=priority
       self.keepAlways=keepAlways
       self.record=record
+      self.generation=0 #the store generation of the last change
 
   class AisDataEntry(object):
+    '''
+    an AIS target
+    entries are never changed after being stored (readers use them without a lock),
+    a change will create a new entry (see update)
+    '''
     def __init__(self,data,priority=0,timestamp=None):
       self.value=data
       self.timestamp = timestamp if timestamp is not None else time.monotonic()
       self.priority=priority
-    def add(self,name,value,timestamp=None):
-      if self.value.get(name) == value:
-        return False
-      self.timestamp = timestamp if timestamp is not None else time.monotonic()
-      self.value[name]=value
-      return True
+      self.cell=None #the cell in the AIS grid
+      self.generation=0 #the store generation of the last change
+    def update(self,data,timestamp=None):
+      '''
+      create a new entry with updated values
+      @param data: the new values
+      @param timestamp: the new timestamp, None to keep the existing one
+      '''
+      value=self.value.copy()
+      value.update(data)
+      rt=AVNStore.AisDataEntry(value,self.priority,timestamp if timestamp is not None else self.timestamp)
+      rt.cell=self.cell
+      rt.generation=self.generation
+      return rt
     def getMmsi(self):
       if not type(self.value) is dict:
         return None
       return self.value.get('mmsi')
 
+  class KeyNode(object):
+    '''
+    a node in the key tree
+    the path from the root to the node is the key split at the dots
+    '''
+    __slots__=('children','entry','generation','owner')
+    def __init__(self,children=None,entry=None,generation=0,owner=None):
+      self.children=children if children is not None else {}
+      self.entry=entry
+      self.generation=generation #the newest generation in this subtree
+      self.owner=owner #nodes are only changed in place by their owner (see __setInTree)
+
+  class Snapshot(object):
+    '''
+    an immutable state of the data entries or the AIS targets
+    readers use it without a lock
+    writers only change their own data and drop the snapshot, a new snapshot
+    is created when a reader needs one (see __getSnapshot, __getAisSnapshot)
+    '''
+    __slots__=('data','removed','horizon','generation')
+    def __init__(self,data,removed,horizon,generation):
+      self.data=data #the KeyNode tree or the AIS buckets
+      self.removed=removed #removed keys: key -> (generation,time)
+      self.horizon=horizon #we do not know all changes before this generation
+      self.generation=generation #the generation of the last change
+
   CHANGE_COUNTER = ['alarm', 'leg', 'route','config']
+  #interval in seconds for the expiry thread
+  EXPIRY_INTERVAL=1
+  #time in seconds we remember removed keys for getChangesSince
+  REMOVED_PERIOD=60
+  #number of buckets for the AIS targets
+  #a change after a new snapshot copies one bucket
+  AIS_BUCKETS=64
   def __init__(self,expiryTime,aisExpiryTime,ownMMSI,useAisAge):
+    # the data entries by key, only used by writers (and single value reads)
     self.__list={}
+    # expiry heap for __list: (expiry time,key), at most one item per key
+    self.__expiryHeap=[]
+    self.__expiryScheduled=set()
+    # the store generation, increased with every change
+    # we start with the current time to make generations from an earlier run invalid
+    self.__generationCounter=itertools.count(int(time.time()*1000))
+    generation=next(self.__generationCounter)
+    # the tree of KeyNode for the data entries, only used by writers
+    # nodes owned by __owner are not part of a published snapshot and are changed in place,
+    # all others are copied on change
+    self.__owner=object()
+    self.__tree=AVNStore.KeyNode(owner=self.__owner)
+    # removed keys: key -> (generation,time), copied on change if published
+    self.__removed={}
+    self.__removedShared=False
+    self.__horizon=generation
+    self.__generation=generation
+    # the snapshot for readers, None if it has to be created from the tree
+    self.__snapshot=None
+    # the AIS targets by key, only used by writers
     self.__aisList={}
+    # the AIS targets in AIS_BUCKETS dicts key->AisDataEntry, only used by writers
+    # buckets not in __aisOwnedBuckets are part of a published snapshot and are copied on change
+    self.__aisBuckets=self.__emptyAisBuckets()
+    self.__aisOwnedBuckets=set(range(0,self.AIS_BUCKETS))
+    self.__aisRemoved={}
+    self.__aisRemovedShared=False
+    self.__aisHorizon=generation
+    self.__aisGeneration=generation
+    # the AIS snapshot for readers, None if it has to be created
+    self.__aisSnapshot=None
+    # spatial index for the AIS targets: cell -> set of keys
+    self.__aisGrid={}
+    # expiry heap for __aisList, see __expiryHeap
+    self.__aisExpiryHeap=[]
+    self.__aisExpiryScheduled=set()
     self.__listLock=threading.Lock()
     self.__aisLock = threading.Lock()
+    # for waitForChange
+    self.__changeCondition=threading.Condition()
+    self.__changeWaiters=0
     self.__expiryTime=expiryTime
     self.__aisExpiryTime=aisExpiryTime
     self.__ownMMSI=ownMMSI
@@ -94,6 +187,23 @@ class AVNStore(object):
     self.__registerInternalKeys()
     for ck in self.CHANGE_COUNTER:
       self.updateChangeCounter(ck)
+    self.__expiryThread=threading.Thread(target=AVNStore.__expiryLoop,args=(weakref.ref(self),),
+                                         name="AVNStoreExpiry",daemon=True)
+    self.__expiryThread.start()
+
+  @staticmethod
+  def __expiryLoop(storeRef):
+    #we only keep a weak reference to the store to allow it to be garbage collected
+    while True:
+      time.sleep(AVNStore.EXPIRY_INTERVAL)
+      store=storeRef()
+      if store is None:
+        return
+      try:
+        store.expireEntries()
+      except:
+        AVNLog.error("error in store expiry: %s",traceback.format_exc())
+      store=None
 
   def __registerInternalKeys(self):
     self.registerKey(self.BASE_KEY_AIS+".count","AIS count",self.__class__.__name__)
@@ -113,13 +223,259 @@ class AVNStore(object):
     et=now - self.__aisExpiryTime
     return aisEntry.timestamp < et
 
+  @classmethod
+  def __splitKey(cls,key):
+    parts=key.split('.')
+    while len(parts) > 1 and parts[-1] == '':
+      parts.pop()
+    return parts
+
+  @classmethod
+  def __ownNode(cls,node,owner):
+    '''
+    get a node that can be changed by owner
+    a node from a published snapshot is copied (only once until the next snapshot)
+    '''
+    if node is None:
+      return AVNStore.KeyNode(owner=owner)
+    if node.owner is owner:
+      return node
+    return AVNStore.KeyNode(node.children.copy(),node.entry,node.generation,owner)
+
+  @classmethod
+  def __setInTree(cls,root,parts,entry,owner):
+    '''
+    set the entry at the path parts below root
+    @return: root or its copy
+    '''
+    generation=entry.generation
+    rt=cls.__ownNode(root,owner)
+    node=rt
+    for part in parts:
+      if node.generation < generation:
+        node.generation=generation
+      child=node.children.get(part)
+      if child is None or child.owner is not owner:
+        child=cls.__ownNode(child,owner)
+        node.children[part]=child
+      node=child
+    node.entry=entry
+    if node.generation < generation:
+      node.generation=generation
+    return rt
+
+  @classmethod
+  def __removeFromTree(cls,node,parts,index,entry,owner):
+    '''
+    remove the entry at parts[index:] below node
+    @return: the node or its copy, None if it is empty now
+    '''
+    if index >= len(parts):
+      if node.entry is not entry:
+        return node
+      rt=cls.__ownNode(node,owner)
+      rt.entry=None
+    else:
+      child=node.children.get(parts[index])
+      if child is None:
+        return node
+      rt=cls.__ownNode(node,owner)
+      child=cls.__removeFromTree(child,parts,index+1,entry,owner)
+      if child is None:
+        del rt.children[parts[index]]
+      else:
+        rt.children[parts[index]]=child
+    if rt.entry is None and len(rt.children) == 0:
+      return None
+    return rt
+
+  def __getRemoved(self):
+    '''
+    get the removed keys for changing them
+    must be called with the list lock held
+    '''
+    if self.__removedShared:
+      self.__removed=self.__removed.copy()
+      self.__removedShared=False
+    return self.__removed
+
+  def __publishSnapshot(self):
+    '''
+    create the snapshot of the data entries if it has been dropped by a change
+    the nodes of the tree belong to the snapshot afterwards - the next write will
+    copy the nodes on its path once
+    must be called with the list lock held
+    '''
+    if self.__snapshot is None:
+      self.__snapshot=AVNStore.Snapshot(self.__tree,self.__removed,self.__horizon,self.__generation)
+      self.__owner=object()
+      self.__removedShared=True
+    return self.__snapshot
+
+  def __getSnapshot(self):
+    '''
+    get the snapshot of the data entries for readers
+    so we only copy once per reader request and not for each write
+    '''
+    snapshot=self.__snapshot
+    if snapshot is not None:
+      return snapshot
+    with self.__listLock:
+      return self.__publishSnapshot()
+
+  def __storeEntry(self,key,entry,newGeneration=True):
+    '''
+    store an entry in the list and the tree
+    must be called with the list lock held
+    @param newGeneration: if False, the entry keeps its generation
+    '''
+    if newGeneration:
+      self.__generation=next(self.__generationCounter)
+      entry.generation=self.__generation
+    self.__list[key]=entry
+    if key in self.__removed:
+      del self.__getRemoved()[key]
+    if not entry.keepAlways and key not in self.__expiryScheduled:
+      self.__expiryScheduled.add(key)
+      heapq.heappush(self.__expiryHeap,(entry.timestamp+self.__expiryTime,key))
+    self.__tree=self.__setInTree(self.__tree,self.__splitKey(key),entry,self.__owner)
+    self.__snapshot=None
+    if newGeneration:
+      self.__notifyChange()
+
+  def __removeEntry(self,key):
+    '''
+    remove an entry from the list and the tree
+    must be called with the list lock held
+    '''
+    entry=self.__list.pop(key,None)
+    if entry is None:
+      return
+    self.__generation=next(self.__generationCounter)
+    self.__getRemoved()[key]=(self.__generation,time.monotonic())
+    tree=self.__removeFromTree(self.__tree,self.__splitKey(key),0,entry,self.__owner)
+    if tree is None:
+      tree=AVNStore.KeyNode(owner=self.__owner)
+    self.__tree=tree
+    self.__snapshot=None
+    self.__notifyChange()
+
+  def __notifyChange(self):
+    '''
+    wake up waitForChange after a change
+    '''
+    if self.__changeWaiters > 0:
+      with self.__changeCondition:
+        self.__changeCondition.notify_all()
+
+  def waitForChange(self,generation,aisGeneration,timeout):
+    '''
+    wait until the data entries or the AIS targets change
+    @param generation: the last known generation of the data entries (see getGeneration)
+    @param aisGeneration: the last known generation of the AIS targets (see getAisGeneration)
+    @param timeout: max time to wait in seconds
+    @return: (generation,aisGeneration)
+    '''
+    with self.__changeCondition:
+      self.__changeWaiters+=1
+      try:
+        self.__changeCondition.wait_for(lambda: self.__generation != generation or
+                                                self.__aisGeneration != aisGeneration,timeout)
+      finally:
+        self.__changeWaiters-=1
+    return (self.__generation,self.__aisGeneration)
+
+  def __expireHeap(self,heap,scheduled,entries,expiryPeriod,remove,now):
+    '''
+    remove the entries from a heap that are expired
+    entries can have a newer timestamp than their heap item (they are updated
+    without touching the heap), those are scheduled again
+    must be called with the lock for the entries held
+    @return: the number of removed entries
+    '''
+    rt=0
+    while len(heap) > 0 and heap[0][0] < now:
+      expiry,key=heapq.heappop(heap)
+      scheduled.discard(key)
+      entry=entries.get(key)
+      if entry is None or getattr(entry,'keepAlways',False):
+        continue
+      expiry=entry.timestamp+expiryPeriod
+      if expiry < now:
+        remove(key)
+        rt+=1
+      else:
+        scheduled.add(key)
+        heapq.heappush(heap,(expiry,key))
+    return rt
+
+  def __rescheduleAll(self,heap,scheduled,entries,expiryPeriod):
+    del heap[:]
+    scheduled.clear()
+    for key,entry in entries.items():
+      if getattr(entry,'keepAlways',False):
+        continue
+      heap.append((entry.timestamp+expiryPeriod,key))
+      scheduled.add(key)
+    heapq.heapify(heap)
+
+  def expireEntries(self,now=None):
+    '''
+    remove all expired entries
+    called from the expiry thread every EXPIRY_INTERVAL seconds
+    @return: the number of removed entries
+    '''
+    if now is None:
+      now=time.monotonic()
+    with self.__listLock:
+      rt=self.__expireHeap(self.__expiryHeap,self.__expiryScheduled,self.__list,
+                           self.__expiryTime,self.__removeEntry,now)
+      removed,horizon=self.__forgetRemoved(self.__removed,self.__horizon,now)
+      if removed is not None:
+        self.__removed=removed
+        self.__removedShared=False
+        self.__horizon=horizon
+        self.__snapshot=None
+    with self.__aisLock:
+      rt+=self.__expireHeap(self.__aisExpiryHeap,self.__aisExpiryScheduled,self.__aisList,
+                            self.__aisExpiryTime,self.__removeAisEntry,now)
+      removed,horizon=self.__forgetRemoved(self.__aisRemoved,self.__aisHorizon,now)
+      if removed is not None:
+        self.__aisRemoved=removed
+        self.__aisRemovedShared=False
+        self.__aisHorizon=horizon
+        self.__aisSnapshot=None
+    return rt
+
+  def __forgetRemoved(self,removed,horizon,now):
+    '''
+    forget removed keys after REMOVED_PERIOD
+    @return: (removed,horizon) - removed is a new dict, None if nothing changed
+    '''
+    limit=now-self.REMOVED_PERIOD
+    rt=None
+    for key,(generation,removeTime) in removed.items():
+      if removeTime < limit:
+        if rt is None:
+          rt=removed.copy()
+        del rt[key]
+        if generation > horizon:
+          horizon=generation
+    return (rt,horizon)
+
   def getExpiryPeriod(self):
     return self.__expiryTime
   def getAisExpiryPeriod(self):
     return self.__aisExpiryTime
   def updateBaseConfig(self,expiry,aisExpiry,ownMMSI,useAisAge):
-    self.__expiryTime=expiry
-    self.__aisExpiryTime=aisExpiry
+    with self.__listLock:
+      if expiry != self.__expiryTime:
+        self.__expiryTime=expiry
+        self.__rescheduleAll(self.__expiryHeap,self.__expiryScheduled,self.__list,expiry)
+    with self.__aisLock:
+      if aisExpiry != self.__aisExpiryTime:
+        self.__aisExpiryTime=aisExpiry
+        self.__rescheduleAll(self.__aisExpiryHeap,self.__aisExpiryScheduled,self.__aisList,aisExpiry)
     self.__ownMMSI=ownMMSI
     self.__useAisAge=useAisAge
 
@@ -133,9 +489,9 @@ class AVNStore(object):
       entry = self.__list.get(listKey)
       if entry is None:
         entry=AVNStore.DataEntry(time.monotonic(),keepAlways=True)
-        self.__list[listKey]=entry
+        self.__storeEntry(listKey,entry)
       else:
-        entry.value+=1
+        self.__storeEntry(listKey,AVNStore.DataEntry(entry.value+1,keepAlways=True))
     except:
       pass
     self.__listLock.release()
@@ -177,7 +533,13 @@ class AVNStore(object):
               doUpdate=False
           if doUpdate:
             hasUpdate=True
-            self.__list[listKey]=AVNStore.DataEntry(dataValue, keepAlways=keepAlways,priority=priority,source=source)
+            newEntry=AVNStore.DataEntry(dataValue, keepAlways=keepAlways,priority=priority,source=source)
+            if existing is not None and existing.value == dataValue:
+              #no change for getChangesSince
+              newEntry.generation=existing.generation
+              self.__storeEntry(listKey,newEntry,False)
+            else:
+              self.__storeEntry(listKey,newEntry)
           else:
             AVNLog.debug("AVNavData: keeping existing entry for %s",listKey)
         return hasUpdate
@@ -203,20 +565,22 @@ class AVNStore(object):
       existing=self.__aisList.get(key)
       if existing is None:
         existing=AVNStore.AisDataEntry({'mmsi':mmsi},priority,timestamp=timestamp)
-        self.__aisList[key]=existing
       elif existing.priority > priority:
         AVNLog.debug("ignore ais for %s due to higher prio %d",mmsi,existing.priority)
         return
+      newTimestamp=None
       if all(k in data for k in ("lat","lon")): # use timestamp is bound to dynamic data
-        existing.timestamp = now if timestamp is None else timestamp
+        newTimestamp = now if timestamp is None else timestamp
         if self.__useAisAge and "second" in data:
           sec=data.get("second",60) # 60=timestamp not available
           if 0<=sec<60: # use timestamp from ais seconds
             delay = (now%60-sec)%60 # delay of message (up to 59s)
-            existing.timestamp -= delay # shift timestamp back
+            newTimestamp -= delay # shift timestamp back
       else:
         del data["type"] # do not update type from static data
-      existing.value.update(data) # update existing data with new data
+      existing=existing.update(data,newTimestamp) # update existing data with new data
+      self.__updateAisIndex(key,existing)
+      self.__putAisEntry(key,existing)
       self.__lastAisSource=source
 
   def addAisItem(self,mmsi,values,source,priority,timestamp=None):
@@ -226,48 +590,405 @@ class AVNStore(object):
     key=AVNStore.BASE_KEY_AIS+"."+str(mmsi)
     with self.__aisLock:
       existing=self.__aisList.get(key)
-      if existing is None:
+      isNew=existing is None
+      if isNew:
         existing=AVNStore.AisDataEntry({'mmsi':mmsi},priority,timestamp=timestamp)
-        self.__aisList[key]=existing
       else:
         if existing.priority > priority:
           AVNLog.debug("ignore ais for %s due to higher prio %d",mmsi,existing.priority)
           return
+      changes={}
       for name,value in values.items():
-        existing.add(name,value,timestamp=timestamp)
+        if existing.value.get(name) != value:
+          changes[name]=value
+      if len(changes) > 0:
+        existing=existing.update(changes,timestamp if timestamp is not None else time.monotonic())
+      if isNew or len(changes) > 0:
+        self.__updateAisIndex(key,existing)
+        self.__putAisEntry(key,existing)
       self.__lastAisSource=source
 
 
   def getAisData(self, asDict=False):
     rt=[] if not asDict else {}
-    keysToRemove=[]
     now=time.monotonic()
-    self.__aisLock.acquire()
-    try:
-      for key in list(self.__aisList.keys()):
-        aisEntry=self.__aisList[key]
-        if self.__isAisExpired(aisEntry, now) or aisEntry.getMmsi() == self.__ownMMSI:
-          keysToRemove.append(key)
+    expiryTime=now-self.__aisExpiryTime
+    for bucket in self.__getAisSnapshot().data:
+      for key,aisEntry in bucket.items():
+        if aisEntry.timestamp < expiryTime or aisEntry.getMmsi() == self.__ownMMSI:
+          continue
+        val=aisEntry.value.copy()
+        val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
+        if asDict:
+          rt[key] = val
         else:
-          val=aisEntry.value.copy()
-          val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
-          if asDict:
-            rt[key] = val
-          else:
-            rt.append(val)
-      for rkey in keysToRemove:
-        del self.__aisList[rkey]
+          rt.append(val)
+    return rt
+
+  def __aisCell(self,value):
+    try:
+      lat=value.get('lat')
+      lon=value.get('lon')
+      return (math.floor(lat/self.AIS_GRID),math.floor(((lon+180)%360)/self.AIS_GRID))
     except:
-      AVNLog.error("error when reading AIS data %s",traceback.format_exc())
-      self.__aisLock.release()
-      raise
-    self.__aisLock.release()
+      return None
+
+  def __updateAisIndex(self,key,aisEntry):
+    '''
+    move an AIS entry to the cell for its current position
+    must be called with the AIS lock held
+    '''
+    cell=self.__aisCell(aisEntry.value)
+    if cell == aisEntry.cell:
+      return
+    self.__removeFromAisGrid(key,aisEntry.cell)
+    aisEntry.cell=cell
+    if cell is not None:
+      keys=self.__aisGrid.get(cell)
+      if keys is None:
+        keys=set()
+        self.__aisGrid[cell]=keys
+      keys.add(key)
+
+  def __removeFromAisGrid(self,key,cell):
+    if cell is None:
+      return
+    keys=self.__aisGrid.get(cell)
+    if keys is not None:
+      keys.discard(key)
+      if len(keys) == 0:
+        del self.__aisGrid[cell]
+
+  def __emptyAisBuckets(self):
+    return [{} for i in range(0,self.AIS_BUCKETS)]
+
+  def __publishAisSnapshot(self):
+    '''
+    create the AIS snapshot if it has been dropped by a change
+    must be called with the AIS lock held
+    '''
+    if self.__aisSnapshot is None:
+      self.__aisSnapshot=AVNStore.Snapshot(tuple(self.__aisBuckets),self.__aisRemoved,
+                                           self.__aisHorizon,self.__aisGeneration)
+      self.__aisOwnedBuckets.clear()
+      self.__aisRemovedShared=True
+    return self.__aisSnapshot
+
+  def __getAisSnapshot(self):
+    '''
+    get the AIS snapshot for readers, see __getSnapshot
+    '''
+    snapshot=self.__aisSnapshot
+    if snapshot is not None:
+      return snapshot
+    with self.__aisLock:
+      return self.__publishAisSnapshot()
+
+  def __getAisBucket(self,key):
+    '''
+    get the bucket for a key for changing it
+    must be called with the AIS lock held
+    '''
+    index=hash(key) % self.AIS_BUCKETS
+    if index not in self.__aisOwnedBuckets:
+      self.__aisBuckets[index]=self.__aisBuckets[index].copy()
+      self.__aisOwnedBuckets.add(index)
+    return self.__aisBuckets[index]
+
+  def __getAisRemoved(self):
+    '''
+    get the removed AIS keys for changing them
+    must be called with the AIS lock held
+    '''
+    if self.__aisRemovedShared:
+      self.__aisRemoved=self.__aisRemoved.copy()
+      self.__aisRemovedShared=False
+    return self.__aisRemoved
+
+  def __putAisEntry(self,key,aisEntry):
+    '''
+    store an AIS entry
+    must be called with the AIS lock held
+    '''
+    self.__aisGeneration=next(self.__generationCounter)
+    aisEntry.generation=self.__aisGeneration
+    self.__aisList[key]=aisEntry
+    if key not in self.__aisExpiryScheduled:
+      self.__aisExpiryScheduled.add(key)
+      heapq.heappush(self.__aisExpiryHeap,(aisEntry.timestamp+self.__aisExpiryTime,key))
+    if key in self.__aisRemoved:
+      del self.__getAisRemoved()[key]
+    self.__getAisBucket(key)[key]=aisEntry
+    self.__aisSnapshot=None
+    self.__notifyChange()
+
+  def __removeAisEntry(self,key):
+    '''
+    remove an AIS entry
+    must be called with the AIS lock held
+    '''
+    aisEntry=self.__aisList.pop(key,None)
+    if aisEntry is None:
+      return
+    self.__removeFromAisGrid(key,aisEntry.cell)
+    self.__aisGeneration=next(self.__generationCounter)
+    self.__getAisRemoved()[key]=(self.__aisGeneration,time.monotonic())
+    self.__getAisBucket(key).pop(key,None)
+    self.__aisSnapshot=None
+    self.__notifyChange()
+
+  def __aisCellsInBox(self,minLat,minLon,maxLat,maxLon):
+    '''
+    get the keys of all AIS targets in cells touching a box
+    must be called with the AIS lock held
+    '''
+    minLatCell=math.floor(max(minLat,-90)/self.AIS_GRID)
+    maxLatCell=math.floor(min(maxLat,90)/self.AIS_GRID)
+    numLonCells=int(round(360/self.AIS_GRID))
+    if (maxLon - minLon) >= (360 - self.AIS_GRID):
+      lonCells=None
+    else:
+      minLonCell=math.floor(((minLon+180)%360)/self.AIS_GRID)
+      maxLonCell=math.floor(((maxLon+180)%360)/self.AIS_GRID)
+      if maxLonCell < minLonCell:
+        maxLonCell+=numLonCells
+      lonCells=[c % numLonCells for c in range(minLonCell,maxLonCell+1)]
+    numCells=(maxLatCell-minLatCell+1)*(numLonCells if lonCells is None else len(lonCells))
+    rt=[]
+    if numCells > len(self.__aisGrid):
+      lonSet=set(lonCells) if lonCells is not None else None
+      for cell,keys in self.__aisGrid.items():
+        if minLatCell <= cell[0] <= maxLatCell and (lonSet is None or cell[1] in lonSet):
+          rt.extend(keys)
+      return rt
+    if lonCells is None:
+      lonCells=range(0,numLonCells)
+    for latCell in range(minLatCell,maxLatCell+1):
+      for lonCell in lonCells:
+        keys=self.__aisGrid.get((latCell,lonCell))
+        if keys is not None:
+          rt.extend(keys)
+    return rt
+
+  def __getAisCandidates(self,snapshot,keys,now,check,checkKey=None):
+    '''
+    get copies of the AIS targets for some keys
+    @param snapshot: the AIS snapshot to read from
+    @param check: a function returning None for targets to be omitted
+    @param checkKey: if set, the result of check will be stored with this key
+    '''
+    rt=[]
+    expiryTime=now-self.__aisExpiryTime
+    buckets=snapshot.data
+    for key in keys:
+      aisEntry=buckets[hash(key) % self.AIS_BUCKETS].get(key)
+      if aisEntry is None or aisEntry.timestamp < expiryTime or aisEntry.getMmsi() == self.__ownMMSI:
+        continue
+      try:
+        checkResult=check(aisEntry.value)
+      except:
+        AVNLog.debug("unable to check ais data: %s",traceback.format_exc())
+        continue
+      if checkResult is None:
+        continue
+      val=aisEntry.value.copy()
+      val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
+      if checkKey is not None:
+        val[checkKey]=checkResult
+      rt.append(val)
+    return rt
+
+  def getAisDataInBox(self,minLat,minLon,maxLat,maxLon):
+    '''
+    get the AIS targets within a lat/lon box
+    @param minLat,minLon: the south west corner
+    @param maxLat,maxLon: the north east corner, maxLon < minLon crosses the 180 meridian
+    @return: a list of AIS dicts
+    '''
+    if maxLon < minLon:
+      maxLon+=360
+    def check(value):
+      lat=value.get('lat')
+      lon=value.get('lon')
+      if lat < minLat or lat > maxLat:
+        return None
+      if lon < minLon:
+        lon+=360
+      if lon > maxLon:
+        return None
+      return True
+    now=time.monotonic()
+    with self.__aisLock:
+      snapshot=self.__publishAisSnapshot()
+      keys=self.__aisCellsInBox(minLat,minLon,maxLat,maxLon)
+    return self.__getAisCandidates(snapshot,keys,now,check)
+
+  def getAisDataInRange(self,centers,distance):
+    '''
+    get the AIS targets within a distance from one of some points
+    @param centers: a list of (lat,lon) tuples
+    @param distance: the distance in NM
+    @return: a list of AIS dicts, AIS_DISTANCE_KEY is the distance to the first
+             point that is in range (in m)
+    '''
+    now=time.monotonic()
+    with self.__aisLock:
+      snapshot=self.__publishAisSnapshot()
+      keys=self.__aisCellsInRange(centers,distance)
+    return self.__getAisCandidates(snapshot,keys,now,
+                                   self.__aisRangeCheck(centers,distance),self.AIS_DISTANCE_KEY)
+
+  @classmethod
+  def __aisRangeCheck(cls,centers,distance):
+    def check(value):
+      position=(value.get('lat'),value.get('lon'))
+      for center in centers:
+        mdist=AVNUtil.distance(position,center)
+        if mdist <= distance:
+          return mdist*AVNUtil.NM
+      return None
+    return check
+
+  def __aisCellsInRange(self,centers,distance):
+    '''
+    get the keys of all AIS targets in cells touching the range around some points
+    must be called with the AIS lock held
+    '''
+    dlat=math.degrees(distance*AVNUtil.NM/AVNUtil.R)
+    keys=set()
+    for lat,lon in centers:
+      minLat=lat-dlat
+      maxLat=lat+dlat
+      maxAbsLat=max(abs(minLat),abs(maxLat))
+      if maxAbsLat >= 90 or dlat >= 90:
+        minLon=-180
+        maxLon=180
+      else:
+        dlon=dlat/math.cos(math.radians(maxAbsLat))
+        minLon=lon-dlon
+        maxLon=lon+dlon
+        if dlon >= 180:
+          minLon=-180
+          maxLon=180
+      keys.update(self.__aisCellsInBox(minLat,minLon,maxLat,maxLon))
+    return keys
+
+  @classmethod
+  def __isFullDelta(cls,generation,horizon,current):
+    return generation is None or generation < horizon or generation > current
+
+  def getAisChangesSince(self,generation,centers=None,distance=None):
+    '''
+    get the changed AIS targets since a generation
+    see getChangesSince
+    @param centers: if set, a list of (lat,lon) tuples to limit the targets like for getAisDataInRange
+                    changed targets outside the range are reported as removed
+    @param distance: the distance in NM for centers
+    @return: a dict like getChangesSince with the keys from getAisData(True)
+    '''
+    check=self.__aisRangeCheck(centers,distance) if centers else None
+    now=time.monotonic()
+    expiryTime=now-self.__aisExpiryTime
+    changed={}
+    removed=[]
+    snapshot=self.__getAisSnapshot()
+    current=snapshot.generation
+    full=self.__isFullDelta(generation,snapshot.horizon,current)
+    if full:
+      if check is not None:
+        with self.__aisLock:
+          keys=self.__aisCellsInRange(centers,distance)
+        entries=[]
+        for key in keys:
+          aisEntry=snapshot.data[hash(key) % self.AIS_BUCKETS].get(key)
+          if aisEntry is not None:
+            entries.append((key,aisEntry))
+      else:
+        entries=[item for bucket in snapshot.data for item in bucket.items()]
+    else:
+      entries=[item for bucket in snapshot.data for item in bucket.items() if item[1].generation > generation]
+      for key,(keyGeneration,removeTime) in snapshot.removed.items():
+        if keyGeneration > generation:
+          removed.append(key)
+    for key,aisEntry in entries:
+      if aisEntry.timestamp < expiryTime or aisEntry.getMmsi() == self.__ownMMSI:
+        continue
+      checkResult=None
+      if check is not None:
+        try:
+          checkResult=check(aisEntry.value)
+        except:
+          pass
+        if checkResult is None:
+          if not full:
+            removed.append(key)
+          continue
+      val=aisEntry.value.copy()
+      val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
+      if checkResult is not None:
+        val[self.AIS_DISTANCE_KEY]=checkResult
+      changed[key]=val
+    return {'generation':current,'full':full,'changed':changed,'removed':removed}
+
+  def __collectChanges(self,node,generation,expiryTime):
+    rt={}
+    for name,child in node.children.items():
+      if child.generation <= generation:
+        continue
+      entry=child.entry
+      if entry is not None and (entry.generation <= generation or
+                                (not entry.keepAlways and entry.timestamp < expiryTime)):
+        entry=None
+      sub=None
+      if len(child.children) > 0:
+        sub=self.__collectChanges(child,generation,expiryTime)
+      if sub:
+        if entry is not None:
+          sub['value']=entry.value
+        rt[name]=sub
+      elif entry is not None:
+        rt[name]=entry.value
     return rt
 
+  def getChangesSince(self,generation,prefix):
+    '''
+    get the changes in the store since a generation
+    @param generation: the generation returned by the last call, None to get all data
+    @param prefix: the prefix like for getDataByPrefix
+    @return: a dict with
+               generation: the current generation, use this for the next call
+               full: True if changed contains all data (the changes since generation are unknown)
+               changed: the new or changed entries in the format of getDataByPrefix
+               removed: the list of removed keys (with the prefix removed)
+    '''
+    if prefix == self.BASE_KEY_AIS:
+      return self.getAisChangesSince(generation)
+    changed={}
+    removed=[]
+    snapshot=self.__getSnapshot()
+    current=snapshot.generation
+    full=self.__isFullDelta(generation,snapshot.horizon,current)
+    expiryTime=time.monotonic()-self.__expiryTime
+    node=snapshot.data
+    for part in prefix.split('.'):
+      node=node.children.get(part)
+      if node is None:
+        break
+    if node is not None:
+      if full:
+        changed=self.__collect(node,expiryTime,None)
+      else:
+        changed=self.__collectChanges(node,generation,expiryTime)
+    if not full:
+      keyPrefix=prefix+"."
+      plen=len(keyPrefix)
+      for key,(keyGeneration,removeTime) in snapshot.removed.items():
+        if keyGeneration > generation and key.startswith(keyPrefix):
+          removed.append(key[plen:])
+    return {'generation':current,'full':full,'changed':changed,'removed':removed}
+
   def getSingleValue(self,key,includeInfo=False):
-    rt=None
-    with self.__listLock:
-      rt=self.__list.get(key)
+    rt=self.__list.get(key) #entries are never changed, so we do not need the lock
     if rt is None:
       return None
     if self.__isExpired(rt):
@@ -278,59 +999,46 @@ class AVNStore(object):
       return rt
     return rt.value
 
+  def __collect(self,node,expiryTime,levels):
+    rt={}
+    for name,child in node.children.items():
+      entry=child.entry
+      if entry is not None and not entry.keepAlways and entry.timestamp < expiryTime:
+        entry=None
+      sub=None
+      if len(child.children) > 0 and (levels is None or levels > 1):
+        sub=self.__collect(child,expiryTime,levels-1 if levels is not None else None)
+      if sub:
+        if entry is not None:
+          sub['value']=entry.value
+        rt[name]=sub
+      elif entry is not None:
+        rt[name]=entry.value
+    return rt
+
   def getDataByPrefix(self,prefix,levels=None):
     """
     get all entries with a certain prefix
     the prefix must exactly be a part of the key until a . (but not including it)
+    expired entries are skipped (they are removed by expireEntries)
     @param prefix: the prefix
     @param levels: the number of levels to be returned (default: all)
     @return: a dict with all entries, keys having the prefix removed
+             if a key has a value and sub keys, the value is returned as 'value'
     """
     if prefix == self.BASE_KEY_AIS:
       rt=self.getAisData(True)
       return rt
-    prefix=prefix+"."
-    plen=len(prefix)
-    rt={}
-    with self.__listLock:
-      try:
-        now=time.monotonic()
-        keysToRemove=[]
-        for key in list(self.__list.keys()):
-          if not key.startswith(prefix):
-            continue
-          entry=self.__list[key]
-          if self.__isExpired(entry, now):
-            keysToRemove.append(key)
-          else:
-            nkey=key[plen:]
-            if nkey.find(".") >= 0:
-              nkey=re.sub('\.*$','',nkey)
-            if nkey.find(".") >= 0:
-              #compound key
-              keyparts=nkey.split(".")
-              numparts=len(keyparts)
-              current=rt
-              for i in range(0,numparts-1):
-                if current.get(keyparts[i]) is None:
-                  current[keyparts[i]]={}
-                nextV=current[keyparts[i]]
-                if not type(nextV) == dict:
-                  #AVNLog.error("inconsistent data , found normal value and dict with key %s"%(".".join(keyparts[0:i])))
-                  current[keyparts[i]]={'value':nextV}
-                  current=current[keyparts[i]]
-                else:
-                  current=nextV
-              if type(current) == dict:
-                current[keyparts[-1]]=entry.value
-            else:
-              rt[nkey]=entry.value
-        for rkey in keysToRemove:
-          del self.__list[rkey]
-      except:
-        AVNLog.error("error getting value with prefix %s: %s"%(prefix,traceback.format_exc()))
-        raise
-      return rt
+    try:
+      node=self.__getSnapshot().data
+      for part in prefix.split('.'):
+        node=node.children.get(part)
+        if node is None:
+          return {}
+      return self.__collect(node,time.monotonic()-self.__expiryTime,levels)
+    except:
+      AVNLog.error("error getting value with prefix %s: %s"%(prefix,traceback.format_exc()))
+      raise
 
   #delete all entries from the list (e.g. when we have to set the time)
   def reset(self):
@@ -340,15 +1048,38 @@ class AVNStore(object):
             if not v.keepAlways:
                 keysToRemove.append(k)
           for k in keysToRemove:
-            try:
-                del self.__list[k]
-            except:
-                pass
-          self.__aisList.clear()
+            self.__removeEntry(k)
+          with self.__aisLock:
+            self.__aisList.clear()
+            self.__aisGrid.clear()
+            del self.__aisExpiryHeap[:]
+            self.__aisExpiryScheduled.clear()
+            generation=next(self.__generationCounter)
+            self.__aisBuckets=self.__emptyAisBuckets()
+            self.__aisOwnedBuckets=set(range(0,self.AIS_BUCKETS))
+            self.__aisRemoved={}
+            self.__aisRemovedShared=False
+            self.__aisHorizon=generation
+            self.__aisGeneration=generation
+            self.__aisSnapshot=None
+          self.__notifyChange()
 
   def getAisCounter(self):
     return len(self.__aisList)
 
+  def getGeneration(self):
+    '''
+    the generation of the last change of the data entries
+    (without the AIS targets)
+    '''
+    return self.__generation
+
+  def getAisGeneration(self):
+    '''
+    the generation of the last change of the AIS targets
+    '''
+    return self.__aisGeneration
+
 
   def getLastSource(self,key):
     rt=self.__list.get(key)
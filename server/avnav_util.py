@@ -518,8 +518,11 @@ class AVNUtil(object):
     return dt + datetime.timedelta(microseconds=us)
   
   #return a regex to be used to check for NMEA data
+  #with binary=True the regex can be used for bytes
   @classmethod
-  def getNMEACheck(cls):
+  def getNMEACheck(cls,binary=False):
+    if binary:
+      return re.compile(b"[!$][A-Z][A-Z][A-Z][A-Z]")
     return re.compile("[!$][A-Z][A-Z][A-Z][A-Z]")
   
   #run an external command and and log the output
@@ -659,6 +662,19 @@ class ChartFile(object):
     return None
   def getAvnavXml(self,upzoom=None):
     return None
+  def getStatus(self):
+    '''
+    a status line for the server status (None if nothing to report)
+    '''
+    return None
+  def getTileDataBatch(self,tiles,source):
+    '''
+    read multiple tiles
+    @param tiles: list of (z,x,y)
+    @return: list of tile data (None for missing tiles)
+    raises an exception if the tiles cannot be read - errors must not be cached as missing tiles
+    '''
+    return [self.getTileData(tile,source) for tile in tiles]
 
 
 class AVNDownload(object):
@@ -682,6 +698,13 @@ class AVNDownload(object):
         self.size=self.lastBytes
     return self.size
 
+  def isPlainFile(self):
+    '''
+    true if the complete file will be sent
+    (allows for range requests)
+    '''
+    return self.filename is not None and self.stream is None and self.lastBytes is None
+
   def getStream(self):
     if self.stream is None:
       self.stream=open(self.filename, 'rb')
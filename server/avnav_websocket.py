@@ -37,10 +37,11 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
+import collections
 import socket  # for socket exceptions
 import struct
 import threading
-import time
+import zlib
 from base64 import b64encode
 from hashlib import sha1
 from http.server import SimpleHTTPRequestHandler
@@ -56,40 +57,181 @@ class QueueMessage:
     self.message=message
     self.isClose=isClose
 
+class WebSocketStatistics(object):
+  '''
+  counters for all websocket connections
+  '''
+  def __init__(self):
+    self.lock=threading.Lock()
+    self.messages=0
+    self.writes=0
+    self.dropped=0
+    self.payloadBytes=0
+    self.sentBytes=0
+
+  def count(self,messages=0,writes=0,dropped=0,payloadBytes=0,sentBytes=0):
+    with self.lock:
+      self.messages+=messages
+      self.writes+=writes
+      self.dropped+=dropped
+      self.payloadBytes+=payloadBytes
+      self.sentBytes+=sentBytes
+
+  def getStatus(self):
+    with self.lock:
+      return "%d messages in %d writes, %d dropped, %d bytes sent (%d bytes uncompressed)"%(
+        self.messages,self.writes,self.dropped,self.sentBytes,self.payloadBytes)
+
+class PerMessageDeflate(object):
+  '''
+  the permessage-deflate extension (RFC 7692) for one connection
+  '''
+  NAME='permessage-deflate'
+  #smaller messages are sent uncompressed
+  MIN_SIZE=64
+  LEVEL=6
+  MAX_MESSAGE=16*1024*1024
+  TRAILER=b'\x00\x00\xff\xff'
+  def __init__(self,noContextTakeover=False,windowBits=15):
+    self.noContextTakeover=noContextTakeover
+    self.windowBits=windowBits
+    self.compressor=None
+    #we can always use the max window, the client does not use a bigger one
+    self.decompressor=zlib.decompressobj(-15)
+
+  @classmethod
+  def negotiate(cls,header):
+    '''
+    check the extension offers of a client
+    @param header: the Sec-WebSocket-Extensions header
+    @return: (PerMessageDeflate,response header) or None if no offer is acceptable
+    '''
+    if not header:
+      return None
+    for offer in header.split(','):
+      params=[p.strip() for p in offer.split(';')]
+      if params[0].lower() != cls.NAME:
+        continue
+      response=[cls.NAME]
+      noContextTakeover=False
+      windowBits=15
+      accepted=True
+      for param in params[1:]:
+        name,_,value=param.partition('=')
+        name=name.strip().lower()
+        value=value.strip().strip('"')
+        if name == 'server_no_context_takeover':
+          noContextTakeover=True
+          response.append(name)
+        elif name == 'client_no_context_takeover':
+          response.append(name)
+        elif name == 'server_max_window_bits':
+          try:
+            windowBits=int(value)
+          except ValueError:
+            windowBits=0
+          #zlib cannot handle a window of 8 bits
+          if windowBits < 9 or windowBits > 15:
+            accepted=False
+            break
+          response.append("%s=%d"%(name,windowBits))
+        elif name == 'client_max_window_bits':
+          pass
+        else:
+          accepted=False
+          break
+      if accepted:
+        return (cls(noContextTakeover,windowBits),'; '.join(response))
+    return None
+
+  def compress(self,data):
+    compressor=self.compressor
+    if compressor is None or self.noContextTakeover:
+      compressor=zlib.compressobj(self.LEVEL,zlib.DEFLATED,-self.windowBits)
+      if not self.noContextTakeover:
+        self.compressor=compressor
+    rt=compressor.compress(data)+compressor.flush(zlib.Z_SYNC_FLUSH)
+    if rt.endswith(self.TRAILER):
+      rt=rt[:-len(self.TRAILER)]
+    return rt
+
+  def decompress(self,data):
+    rt=self.decompressor.decompress(data+self.TRAILER,self.MAX_MESSAGE)
+    if self.decompressor.unconsumed_tail:
+      raise WebSocketError("compressed message too large")
+    return rt
+
+def createFrame(opcode,message,deflate=None):
+  '''
+  create an unmasked websocket frame
+  @param opcode: the opcode
+  @param message: str or bytes
+  @param deflate: a PerMessageDeflate to compress data frames
+  @return: the frame (bytes)
+  '''
+  if type(message) is str:
+    message=message.encode('utf-8')
+  first=0x80 + opcode
+  if deflate is not None and opcode < 0x8 and len(message) >= deflate.MIN_SIZE:
+    message=deflate.compress(message)
+    first|=0x40
+  length=len(message)
+  if length <= 125:
+    header=bytes([first,length])
+  elif length <= 65535:
+    header=bytes([first,126])+struct.pack(">H",length)
+  else:
+    header=bytes([first,127])+struct.pack(">Q",length)
+  return header+message
+
+def unmask(payload,mask):
+  length=len(payload)
+  if length == 0:
+    return payload
+  mask=(mask*(length//4+1))[0:length]
+  return (int.from_bytes(payload,'big') ^ int.from_bytes(mask,'big')).to_bytes(length,'big')
+
 class OutQueue:
-  def __init__(self,size):
+  def __init__(self,size,statistics=None):
     self.condition=threading.Condition()
-    self.data=[]
+    self.data=collections.deque()
     self.size=size
+    self.dropped=0
+    self.statistics=statistics
 
   def clear(self):
-    self.condition.acquire()
-    self.data=[]
-    self.condition.notifyAll()
-    self.condition.release()
+    with self.condition:
+      self.data.clear()
+      self.condition.notify_all()
+
   def add(self,item):
-    self.condition.acquire()
-    try:
+    with self.condition:
+      if len(self.data) >= self.size:
+        #the client is too slow - drop the oldest message
+        self.data.popleft()
+        self.dropped+=1
+        if self.statistics is not None:
+          self.statistics.count(dropped=1)
       self.data.append(item)
-      self.condition.notifyAll()
-      if len(self.data) > self.size:
-        self.data.pop(0)
-    finally:
-      self.condition.release()
+      self.condition.notify_all()
 
   def read(self,timeout=1):
-    now=time.time()
-    loopCount=timeout*5
-    while loopCount > 0:
-      self.condition.acquire()
-      try:
-        if len(self.data) > 0:
-          return self.data.pop(0)
-        self.condition.wait(0.2)
-        loopCount=loopCount-1
-      finally:
-        self.condition.release()
-    return None
+    with self.condition:
+      if not self.condition.wait_for(lambda: len(self.data) > 0,timeout):
+        return None
+      return self.data.popleft()
+
+  def readAll(self,timeout=1):
+    '''
+    wait for messages and return all that are queued
+    @return: a list of QueueMessage (empty on timeout)
+    '''
+    with self.condition:
+      if not self.condition.wait_for(lambda: len(self.data) > 0,timeout):
+        return []
+      rt=list(self.data)
+      self.data.clear()
+      return rt
 
 
 
@@ -102,6 +244,7 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
   _opcode_close = 0x8
   _opcode_ping = 0x9
   _opcode_pong = 0xa
+  statistics = WebSocketStatistics()
 
   @classmethod
   def send_queue_len(cls):
@@ -128,6 +271,15 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
   def allow_ws(self):
     return True
 
+  def allow_deflate(self):
+    """Override this handler to disable permessage-deflate."""
+    return True
+
+  def hand_over_ws(self):
+    """Override this handler to read the messages in a different thread.
+       return True if _read_messages will be called later on"""
+    return False
+
   def send_message(self, message):
     if self.send_queue_len() > 0:
       self.queue.add(QueueMessage(message))
@@ -142,19 +294,32 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
       self._ws_close()
   def _fetch_messages(self):
     while self.connected:
-      message=self.queue.read()
-      if message != None:
+      messages=self.queue.readAll()
+      if len(messages) < 1:
+        continue
+      # send all queued messages with one write
+      texts=[]
+      close=False
+      for message in messages:
         if message.isClose:
-          self._ws_close()
-        else:
-          self._send_message(self._opcode_text, message.message)
+          close=True
+          break
+        texts.append(message.message)
+      if len(texts) > 0:
+        self._send_messages(self._opcode_text, texts)
+      if close:
+        self._ws_close()
 
   def setup(self):
     SimpleHTTPRequestHandler.setup(self)
     self.connected = False
+    self.deflate = None
+    self.fragments = None
+    self.fragmentOpcode = None
     if self.send_queue_len() > 0:
-      self.queue=OutQueue(self.send_queue_len())
+      self.queue=OutQueue(self.send_queue_len(),self.statistics)
     self.mutex = threading.Lock()
+    self.send_mutex = threading.Lock()
 
 
   def checkAuthentication(self):
@@ -178,6 +343,8 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
         return
       self._handshake()
       self.wfile.flush()
+      if self.connected and self.hand_over_ws():
+        return
       # This handler is in websocket mode now.
       # do_GET only returns after client close or socket error.
       self._read_messages()
@@ -205,17 +372,36 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
     # self.rfile.read(n) is blocking.
     # it returns however immediately when the socket is closed.
     try:
-      self.opcode = ord(self.rfile.read(1)) & 0x0F
+      first = ord(self.rfile.read(1))
+      opcode = first & 0x0F
       length = ord(self.rfile.read(1)) & 0x7F
       if length == 126:
         length = struct.unpack(">H", self.rfile.read(2))[0]
       elif length == 127:
         length = struct.unpack(">Q", self.rfile.read(8))[0]
-      masks = [byte for byte in self.rfile.read(4)]
-      decoded = ""
-      for char in self.rfile.read(length):
-        decoded += chr(char ^ masks[len(decoded) % 4])
-      self._on_message(decoded)
+      masks = self.rfile.read(4)
+      payload = unmask(self.rfile.read(length), masks)
+      if opcode >= self._opcode_close:
+        # control frames can be sent between fragments
+        self.opcode = opcode
+        self._on_message(payload)
+        return
+      if opcode != self._opcode_continu or self.fragments is None:
+        # keep the opcode, control frames in between will change self.opcode
+        self.fragmentOpcode = opcode
+        self.fragments = []
+        self.compressed = (first & 0x40) != 0
+        if self.compressed and self.deflate is None:
+          raise WebSocketError("compressed frame without permessage-deflate")
+      self.fragments.append(payload)
+      if (first & 0x80) == 0:
+        return
+      data = b''.join(self.fragments)
+      self.fragments = None
+      if self.compressed:
+        data = self.deflate.decompress(data)
+      self.opcode = self.fragmentOpcode
+      self._on_message(data.decode('utf-8', errors='replace'))
     except (struct.error, TypeError) as e:
       # catch exceptions from ord() and struct.unpack()
       if self.connected:
@@ -226,22 +412,24 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
         pass
 
   def _send_message(self, opcode, message):
+    self._send_messages(opcode, [message])
+
+  def _send_messages(self, opcode, messages):
     try:
-      # use of self.wfile.write gives socket exception after socket is closed. Avoid.
-      self.request.send(bytes([0x80 + opcode]))
-      if type(message) is str:
-        message=message.encode('utf-8')
-      length = len(message)
-      if length <= 125:
-        self.request.send(bytes([length]))
-      elif length >= 126 and length <= 65535:
-        self.request.send(bytes([126]))
-        self.request.send(struct.pack(">H", length))
-      else:
-        self.request.send(bytes([127]))
-        self.request.send(struct.pack(">Q", length))
-      if length > 0:
-        self.request.send(message)
+      with self.send_mutex:
+        # compress in the order of sending
+        deflate = self.deflate if opcode < self._opcode_close else None
+        payloadBytes = 0
+        frames = []
+        for message in messages:
+          if type(message) is str:
+            message = message.encode('utf-8')
+          payloadBytes += len(message)
+          frames.append(createFrame(opcode, message, deflate))
+        data = b''.join(frames)
+        # use of self.wfile.write gives socket exception after socket is closed. Avoid.
+        self.request.sendall(data)
+      self.statistics.count(messages=len(messages), writes=1, payloadBytes=payloadBytes, sentBytes=len(data))
     except socket.error as e:
       # websocket content error, time-out or disconnect.
       self.log_message("SND: Close connection: Socket Error %s" % str(e.args))
@@ -261,6 +449,11 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
     self.send_header('Upgrade', 'websocket')
     self.send_header('Connection', 'Upgrade')
     self.send_header('Sec-WebSocket-Accept', digest.decode())
+    if self.allow_deflate():
+      negotiated = PerMessageDeflate.negotiate(headers.get('Sec-WebSocket-Extensions'))
+      if negotiated is not None:
+        self.deflate = negotiated[0]
+        self.send_header('Sec-WebSocket-Extensions', negotiated[1])
     self.end_headers()
     self.connected = True
     self.close_connection = False
@@ -313,8 +506,6 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
 
   def _send_close(self):
     # Dedicated _send_close allows for catch all exception handling
-    msg = bytearray()
-    msg.append(0x80 + self._opcode_close)
-    msg.append(0x00)
-    self.request.send(msg)
+    with self.send_mutex:
+      self.request.sendall(createFrame(self._opcode_close, b''))
 
@@ -26,6 +26,7 @@
 
 # read gemf files and provide them for access via http
 # see http://www.cgtk.co.uk/gemf
+import bisect
 import sys
 import os
 import struct
@@ -36,7 +37,43 @@ import create_overview
 from avnav_util import AVNLog, ChartFile
 
 
+class RangeIndex(object):
+  '''
+  find the range for a tile in the ranges of one zoom level
+  the x axis is split into segments at all range borders,
+  for each segment we have the covering ranges sorted by ymin
+  '''
+  def __init__(self,ranges):
+    '''
+    @param ranges: list of (xmin,xmax,ymin,ymax,offset)
+    '''
+    self.borders=sorted(set([r[0] for r in ranges]+[r[1]+1 for r in ranges]))
+    segments=[[] for i in range(len(self.borders))]
+    for r in ranges:
+      for i in range(bisect.bisect_left(self.borders,r[0]),bisect.bisect_left(self.borders,r[1]+1)):
+        segments[i].append(r)
+    self.segments=[]
+    for segment in segments:
+      segment.sort(key=lambda r: r[2])
+      self.segments.append(([r[2] for r in segment],segment))
+
+  def find(self,x,y):
+    i=bisect.bisect_right(self.borders,x)-1
+    if i < 0:
+      return None
+    ymins,segment=self.segments[i]
+    j=bisect.bisect_right(ymins,y)-1
+    while j >= 0:
+      #only more than one step for overlapping ranges
+      if y <= segment[j][3]:
+        return segment[j]
+      j-=1
+    return None
+
+
 class GemfFile(ChartFile):
+  #without pread we must serialize seek+read
+  HAS_PREAD=hasattr(os,'pread')
   def __init__(self,filename):
     self.filename=filename
     self.handles=[]
@@ -46,6 +83,10 @@ class GemfFile(ChartFile):
     self.sourceranges={}
     self.ranges=[]
     self.lengthes=[]
+    #the offsets of the files in the combined data
+    self.starts=[]
+    #source -> zoom -> RangeIndex
+    self.rangeIndex={}
     self.isOpen=False
     self.numsources=0
     self.rangenum=0
@@ -116,9 +157,27 @@ class GemfFile(ChartFile):
         self.handles.append(h)
       else:
         break
+    start=0
     for h in self.handles:
       st=os.fstat(h.fileno())
       self.lengthes.append(st.st_size)
+      self.starts.append(start)
+      start+=st.st_size
+    self.rangeIndex={}
+    for sname,zooms in self.sourceranges.items():
+      self.rangeIndex[sname]={zoom:RangeIndex(ranges) for zoom,ranges in zooms.items()}
+
+  def _read(self,handle,offset,length):
+    if self.HAS_PREAD:
+      #no lock needed, the file position is not used
+      rt=os.pread(handle.fileno(),length,offset)
+    else:
+      with self.lock:
+        handle.seek(offset)
+        rt=handle.read(length)
+    if len(rt) != length:
+      raise Exception("short read in %s: %d bytes instead of %d at %d"%(self.filename,len(rt),length,offset))
+    return rt
 
 
   #find a range for a tile
@@ -127,18 +186,14 @@ class GemfFile(ChartFile):
   #return the range data (xmin,xmax,ymin,ymax,offset)
   def findRangeForTile(self,tile,source):
     if not self.isOpen:
+      raise Exception("GEMF file %s not open" %(self.filename))
+    z,x,y=tile
+    index=self.rangeIndex.get(source,{}).get(z)
+    if index is None:
       return None
-    try:
-      z,x,y=tile
-      rangelist=self.sourceranges[source][z]
-      for range in rangelist:
-        if x < range[0] or x > range[1] or y < range[2] or y > range[3]:
-          continue
-        return range
-    except:
-      return None
-    idx=-1
-    
+    return index.find(x,y)
+
+
   def getTileOffsetLen(self,tile,source):
     rdata=self.findRangeForTile(tile,source)
     if rdata is None:
@@ -150,42 +205,27 @@ class GemfFile(ChartFile):
     idxr=idxx*ynum+idxy;
     #each range entry has 12 bytes (offset 8 , len 4)
     offset=12*idxr+rdata[4]
-    try:
-      self.lock.acquire()
-      self.handles[0].seek(offset)
-      buf=self.handles[0].read(12)
-      self.lock.release()
-      offset,flen=struct.unpack_from("!ql",buf,0)
-      return (offset,flen)
-    except:
-      self.lock.release()
-      raise
- 
+    buf=self._read(self.handles[0],offset,12)
+    offset,flen=struct.unpack_from("!ql",buf,0)
+    return (offset,flen)
+
+
   #find the file and offset to fetch data
   def getFileAndOffset(self,offset):
-    for i in range(len(self.lengthes)):
-      if offset < self.lengthes[i]:
-        return (self.handles[i],offset)
-      offset-=self.lengthes[i]
-    return (None,None)
+    i=bisect.bisect_right(self.starts,offset)-1
+    if i < 0 or offset >= self.starts[i]+self.lengthes[i]:
+      return (None,None)
+    return (self.handles[i],offset-self.starts[i])
 
+  #return None if the tile does not exist, raise an exception on errors
   def getTileData(self,tile,source):
     offset,flen=self.getTileOffsetLen(tile,source)
     if offset is None or flen is None:
       return None
-    try:
-      #todo: handle multiple locks
-      fhandle,foffset=self.getFileAndOffset(offset)
-      if fhandle is None or foffset is None:
-        return None
-      self.lock.acquire()
-      fhandle.seek(foffset)
-      buf=fhandle.read(flen)
-      self.lock.release()
-      return buf
-    except:
-      self.lock.release()
-      raise
+    fhandle,foffset=self.getFileAndOffset(offset)
+    if fhandle is None or foffset is None:
+      raise Exception("invalid offset %d for tile %s in %s"%(offset,str(tile),self.filename))
+    return self._read(fhandle,foffset,flen)
 
   #get a list of sources and their assigned ranges
   def getSources(self):
@@ -214,6 +254,8 @@ class GemfFile(ChartFile):
       h.close()
     self.handles=[]
     self.lengthes=[]
+    self.starts=[]
+    self.rangeIndex={}
     self.ranges=[]
     self.sources=[]
     self.rangenum=0
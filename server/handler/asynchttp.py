@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+###############################################################################
+# Copyright (c) 2012,2021 Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+###############################################################################
+'''
+an asyncio based front end for the HTTP server
+connections and websockets are handled in the event loop,
+the requests are handled by the normal AVNHTTPHandler in an executor thread
+so idle keep alive connections and websockets do not need a thread
+'''
+
+import asyncio
+import concurrent.futures
+import http.client
+import io
+import os
+import struct
+import threading
+import traceback
+import zlib
+from base64 import b64encode
+from hashlib import sha1
+
+from avnav_util import AVNLog
+from avnav_websocket import HTTPWebSocketsHandler, PerMessageDeflate, WebSocketError, createFrame, unmask
+from httphandler import AVNHTTPHandler
+
+
+class RequestInput(io.RawIOBase):
+  '''
+  the input for one request: the already read header
+  followed by the body (read from the event loop)
+  '''
+  def __init__(self,loop,reader,head,bodyLength):
+    super().__init__()
+    self.loop=loop
+    self.reader=reader
+    self.head=head
+    self.bodyLength=bodyLength
+    self.timeout=None
+
+  def readable(self):
+    return True
+
+  def readinto(self,b):
+    if len(self.head) > 0:
+      rt=min(len(b),len(self.head))
+      b[0:rt]=self.head[0:rt]
+      self.head=self.head[rt:]
+      return rt
+    if self.bodyLength <= 0:
+      return 0
+    future=asyncio.run_coroutine_threadsafe(self.reader.read(min(len(b),self.bodyLength)),self.loop)
+    data=future.result(self.timeout)
+    rt=len(data)
+    b[0:rt]=data
+    self.bodyLength-=rt
+    if rt == 0:
+      self.bodyLength=0
+    return rt
+
+
+class ResponseOutput(io.RawIOBase):
+  '''
+  write the response to the transport of the event loop
+  the writing thread will wait until the data has been handed over to the transport
+  '''
+  def __init__(self,loop,writer):
+    super().__init__()
+    self.loop=loop
+    self.writer=writer
+
+  def writable(self):
+    return True
+
+  async def _write(self,data):
+    self.writer.write(data)
+    await self.writer.drain()
+
+  def write(self,b):
+    data=bytes(b)
+    asyncio.run_coroutine_threadsafe(self._write(data),self.loop).result()
+    return len(data)
+
+
+class AsyncConnection(object):
+  '''
+  used as the connection of the AsyncHTTPHandler
+  '''
+  def __init__(self,input,output):
+    self.input=input
+    self.output=output
+  def settimeout(self,timeout):
+    self.input.timeout=timeout
+  def sendfile(self,file,offset=0,count=None):
+    '''
+    like socket.sendfile, the transport must have been drained before
+    '''
+    loop=self.output.loop
+    return asyncio.run_coroutine_threadsafe(loop.sendfile(self.output.writer.transport,file,offset,count),loop).result()
+
+
+class AsyncHTTPHandler(AVNHTTPHandler):
+  '''
+  an AVNHTTPHandler for one request from the async front end
+  '''
+  def __init__(self,input,output,client_address,server):
+    self.initHandler(server)
+    self.client_address=client_address
+    self.server=server
+    self.directory=os.getcwd()
+    self.request=None
+    self.connection=AsyncConnection(input,output)
+    self.rfile=io.BufferedReader(input)
+    self.wfile=io.BufferedWriter(output)
+    self.close_connection=True
+
+  def handleRequest(self):
+    '''
+    handle the request
+    @return: True if the connection can be kept open
+    '''
+    try:
+      self.handle_one_request()
+      self.wfile.flush()
+    finally:
+      self.rfile.detach()
+      self.wfile.detach()
+    return not self.close_connection
+
+
+class AsyncWebSocket(object):
+  '''
+  a websocket connection in the async front end
+  provides the methods a WebSocketHandler uses from the request handler
+  messages are collected and written in one batch from the loop
+  '''
+  #we drop messages if the client does not read
+  MAX_BUFFER=1000000
+  def __init__(self,loop,writer):
+    self.loop=loop
+    self.writer=writer
+    self.closed=False
+    self.dropped=0
+    self.deflate=None
+    self.lock=threading.Lock()
+    self.pending=[]
+    self.flushScheduled=False
+
+  def _write(self,frame,close=False):
+    if self.closed:
+      return
+    if close:
+      self.closed=True
+    try:
+      self.writer.write(frame)
+      if close:
+        self.writer.close()
+    except Exception as e:
+      AVNLog.debug("websocket write error %s",str(e))
+      self.closed=True
+
+  def _flush(self):
+    with self.lock:
+      messages=self.pending
+      self.pending=[]
+      self.flushScheduled=False
+    if self.closed or len(messages) < 1:
+      return
+    if self.writer.transport.get_write_buffer_size() > self.MAX_BUFFER:
+      self.dropped+=len(messages)
+      HTTPWebSocketsHandler.statistics.count(dropped=len(messages))
+      return
+    payloadBytes=0
+    frames=[]
+    for message in messages:
+      if type(message) is str:
+        message=message.encode('utf-8')
+      payloadBytes+=len(message)
+      frames.append(createFrame(HTTPWebSocketsHandler._opcode_text,message,self.deflate))
+    data=b''.join(frames)
+    self._write(data)
+    HTTPWebSocketsHandler.statistics.count(messages=len(messages),writes=1,
+                                           payloadBytes=payloadBytes,sentBytes=len(data))
+
+  def _callInLoop(self,func,*args):
+    try:
+      self.loop.call_soon_threadsafe(func,*args)
+    except RuntimeError:
+      #loop already closed
+      self.closed=True
+
+  def send_message(self,message):
+    '''
+    can be called from any thread
+    '''
+    if self.closed:
+      return
+    with self.lock:
+      self.pending.append(message)
+      if self.flushScheduled:
+        return
+      self.flushScheduled=True
+    self._callInLoop(self._flush)
+
+  def close_ws(self):
+    self._callInLoop(self._write,createFrame(HTTPWebSocketsHandler._opcode_close,b''),True)
+
+
+class AsyncHTTPFrontend(object):
+  '''
+  serve the AVNHttpServer from an asyncio event loop
+  '''
+  MAX_HEADER=65536
+  def __init__(self,server,numThreads,keepAliveTimeout=None):
+    '''
+    @param server: the AVNHttpServer
+    @param numThreads: the number of threads for handling requests
+    @param keepAliveTimeout: close idle connections after this time, None to keep them
+    '''
+    self.server=server
+    self.numThreads=numThreads
+    self.keepAliveTimeout=keepAliveTimeout
+    self.executor=None
+    self.loop=None
+    self.lock=threading.Lock()
+    self.connections=0
+    self.websockets=set()
+    self.busy=0
+    self.requests=0
+
+  def serve(self,sock):
+    '''
+    run the event loop on a listening socket
+    only returns when the loop is stopped
+    '''
+    self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=self.numThreads,thread_name_prefix="HTTPAsync")
+    try:
+      asyncio.run(self._serve(sock))
+    finally:
+      self.executor.shutdown(wait=False)
+
+  async def _serve(self,sock):
+    self.loop=asyncio.get_running_loop()
+    server=await asyncio.start_server(self._handleConnection,sock=sock,limit=self.MAX_HEADER)
+    async with server:
+      await server.serve_forever()
+
+  async def _runInExecutor(self,func,*args):
+    with self.lock:
+      self.busy+=1
+    try:
+      return await self.loop.run_in_executor(self.executor,func,*args)
+    finally:
+      with self.lock:
+        self.busy-=1
+
+  async def _handleConnection(self,reader,writer):
+    clientAddress=writer.get_extra_info('peername')
+    with self.lock:
+      self.connections+=1
+    try:
+      while True:
+        try:
+          head=await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),self.keepAliveTimeout)
+        except (asyncio.IncompleteReadError,asyncio.TimeoutError,ConnectionError):
+          break
+        except asyncio.LimitOverrunError:
+          writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+          break
+        requestLine,sep,rest=head.partition(b'\r\n')
+        words=requestLine.decode('iso-8859-1').split()
+        headers=http.client.parse_headers(io.BytesIO(rest))
+        if len(words) == 3 and words[0] == 'GET' and headers.get('Upgrade') == 'websocket':
+          await self._handleWebSocket(reader,writer,words[1],headers)
+          break
+        try:
+          bodyLength=int(headers.get('Content-Length') or 0)
+        except ValueError:
+          bodyLength=0
+        input=RequestInput(self.loop,reader,head,bodyLength)
+        handler=AsyncHTTPHandler(input,ResponseOutput(self.loop,writer),clientAddress,self.server)
+        with self.lock:
+          self.requests+=1
+        try:
+          keepOpen=await self._runInExecutor(handler.handleRequest)
+        except Exception as e:
+          AVNLog.debug("error in async request %s: %s",requestLine,traceback.format_exc())
+          break
+        if not keepOpen:
+          break
+        if input.bodyLength > 0:
+          #skip the body if the handler did not read it
+          try:
+            await reader.readexactly(input.bodyLength)
+          except (asyncio.IncompleteReadError,ConnectionError):
+            break
+    finally:
+      with self.lock:
+        self.connections-=1
+      try:
+        writer.close()
+      except:
+        pass
+
+  async def _handleWebSocket(self,reader,writer,url,headers):
+    path,query=self.server.pathQueryFromUrl(url)
+    ws=AsyncWebSocket(self.loop,writer)
+    wsHandler=await self._runInExecutor(self.server.getWebSocketsHandler,path,query,ws)
+    if wsHandler is None or headers.get('Sec-WebSocket-Key') is None:
+      AVNLog.debug("invalid websocket request at %s",path)
+      writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+      return
+    digest=b64encode(sha1((headers['Sec-WebSocket-Key']+HTTPWebSocketsHandler._ws_GUID).encode()).digest())
+    extension=""
+    negotiated=PerMessageDeflate.negotiate(headers.get('Sec-WebSocket-Extensions'))
+    if negotiated is not None:
+      ws.deflate=negotiated[0]
+      extension="Sec-WebSocket-Extensions: %s\r\n"%negotiated[1]
+    writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"+
+                  "Sec-WebSocket-Accept: %s\r\n%s\r\n"%(digest.decode(),extension)).encode('iso-8859-1'))
+    with self.lock:
+      self.websockets.add(ws)
+    try:
+      await self._runInExecutor(wsHandler.on_ws_connected)
+      parts=[]
+      compressed=False
+      while not ws.closed:
+        try:
+          header=await reader.readexactly(2)
+          opcode=header[0] & 0x0F
+          final=(header[0] & 0x80) != 0
+          length=header[1] & 0x7F
+          if length == 126:
+            length=struct.unpack(">H",await reader.readexactly(2))[0]
+          elif length == 127:
+            length=struct.unpack(">Q",await reader.readexactly(8))[0]
+          mask=await reader.readexactly(4) if header[1] & 0x80 else None
+          payload=await reader.readexactly(length)
+        except (asyncio.IncompleteReadError,ConnectionError):
+          break
+        if mask is not None:
+          payload=unmask(payload,mask)
+        if opcode == HTTPWebSocketsHandler._opcode_close:
+          ws.close_ws()
+          break
+        if opcode == HTTPWebSocketsHandler._opcode_ping:
+          ws._write(createFrame(HTTPWebSocketsHandler._opcode_pong,payload))
+          continue
+        if opcode == HTTPWebSocketsHandler._opcode_pong:
+          continue
+        if len(parts) == 0:
+          compressed=(header[0] & 0x40) != 0
+        parts.append(payload)
+        if not final:
+          continue
+        message=b''.join(parts)
+        parts=[]
+        if compressed:
+          if ws.deflate is None:
+            AVNLog.debug("compressed websocket frame without permessage-deflate")
+            break
+          try:
+            message=ws.deflate.decompress(message)
+          except (WebSocketError,zlib.error) as e:
+            AVNLog.debug("unable to decompress websocket message: %s",str(e))
+            break
+        message=message.decode('utf-8',errors='replace')
+        await self._runInExecutor(wsHandler.on_ws_message,message)
+    finally:
+      ws.closed=True
+      with self.lock:
+        self.websockets.discard(ws)
+      try:
+        await self._runInExecutor(wsHandler.on_ws_closed)
+      except Exception:
+        AVNLog.debug("error closing websocket %s",traceback.format_exc())
+
+  def getStatus(self):
+    with self.lock:
+      dropped=sum(ws.dropped for ws in self.websockets)
+      return "%d connections, %d websockets (%d dropped messages), %d/%d threads busy, %d requests"%(
+        self.connections,len(self.websockets),dropped,self.busy,self.numThreads,self.requests)
@@ -24,7 +24,11 @@
 #  parts from this software (AIS decoding) are taken from the gpsd project
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
+import collections
+import multiprocessing
+
 from avnav_util import MovingSum
+from avnav_nmea import decodeAisPayload, hasAisDecoder
 from avnav_worker import *
 from avnqueue import Fetcher
 import avnav_handlerList
@@ -43,7 +47,14 @@ class NmeaEntry(object):
 #a Worker for feeding data trough gpsd (or directly to the navdata)
 class AVNDecoder(AVNWorker):
   P_FILTER=WorkerParameter('decoderFilter',default='',type=WorkerParameter.T_FILTER)
-  P_ALL=[P_FILTER]
+  P_AISWORKERS=WorkerParameter('aisWorkers',default=0,type=WorkerParameter.T_NUMBER,
+                               description='number of processes for decoding AIS data, 0 to decode AIS in the decoder thread',
+                               rangeOrList=[0,16])
+  P_ALL=[P_FILTER,P_AISWORKERS]
+  #number of entries we fetch at once when decoding AIS in worker processes
+  AIS_FETCH=100
+  #max number of AIS batches waiting for the workers before we wait for the oldest one
+  AIS_PENDING=8
   @classmethod
   def getConfigParam(cls, child=None):
     return cls.P_ALL
@@ -68,25 +79,97 @@ class AVNDecoder(AVNWorker):
       self._fetcher.updateParam(nmeaFilter=self.P_FILTER.fromDict(self.param))
     return rt
 
+  def getStatusProperties(self):
+    rt={}
+    for tag,counters in sorted(NMEAParser.getSentenceStatistics().items()):
+      rt[tag]="parsed=%d, failed=%d, ignored=%d"%(counters['parsed'],counters['failed'],counters['ignored'])
+    return rt
+
+  def _createPool(self,numWorkers):
+    if numWorkers < 1 or not hasAisDecoder:
+      return None
+    AVNLog.info("starting %d AIS decoder processes",numWorkers)
+    #use spawn to avoid forking a process with many threads
+    return multiprocessing.get_context('spawn').Pool(numWorkers)
+
+  def _applyAisResults(self,nmeaParser,pending,wait=False):
+    '''
+    store the results of finished AIS batches
+    we always take the oldest batch first to keep the order
+    @param pending: a deque of (asyncResult,[(source,priority,timestamp)])
+    @param wait: wait for all batches
+    '''
+    while len(pending) > 0:
+      result,meta=pending[0]
+      if not wait and not result.ready() and len(pending) <= self.AIS_PENDING:
+        return
+      pending.popleft()
+      try:
+        values=result.get()
+      except Exception as e:
+        AVNLog.error("error in AIS decoder process: %s",str(e))
+        continue
+      for value,(source,priority,timestamp) in zip(values,meta):
+        if nmeaParser.storeAISdata(value,source=source,priority=priority,timestamp=timestamp):
+          self.decoded.add(1)
+
   def run(self):
     self._fetcher=Fetcher(self.queue,self,includeSource=True,nmeaFilter=self.P_FILTER.fromDict(self.param) )
     AVNLog.info("decoder started")
     nmeaParser=NMEAParser(self.navdata)
     self.setInfo('main', "running", WorkerStatus.RUNNING)
-    while not self.shouldStop():
-      try:
-        nmealist=self._fetcher.fetch()
-        for data in nmealist:
-          if not data is None and not data.omitDecode:
-            if nmeaParser.parseData(data.data,timestamp=data.timestamp,source=data.source,sourcePriority=data.sourcePriority):
-              self.decoded.add(1)
-      except Exception as e:
-        AVNLog.warn("feeder exception - retrying %s",traceback.format_exc())
-      if self.decoded.shouldUpdate():
-        self.setInfo('decoder',
-                     "decoded %.4g/s"%self.decoded.avg(),
-                     WorkerStatus.NMEA if self.decoded.val()>0 else WorkerStatus.INACTIVE)
-      self._fetcher.report()
+    numWorkers=0
+    pool=None
+    pending=collections.deque()
+    try:
+      while not self.shouldStop():
+        try:
+          newWorkers=self.P_AISWORKERS.fromDict(self.param)
+          if newWorkers != numWorkers:
+            if pool is not None:
+              self._applyAisResults(nmeaParser,pending,wait=True)
+              pool.close()
+            numWorkers=newWorkers
+            pool=self._createPool(numWorkers)
+          if pool is None:
+            nmealist=self._fetcher.fetch()
+            for data in nmealist:
+              if not data is None and not data.omitDecode:
+                if nmeaParser.parseData(data.data,timestamp=data.timestamp,source=data.source,sourcePriority=data.sourcePriority):
+                  self.decoded.add(1)
+          else:
+            #AIS payloads are assembled here but decoded in the pool
+            #everything else is directly parsed
+            nmealist=self._fetcher.fetch(maxEntries=self.AIS_FETCH)
+            jobs=[]
+            meta=[]
+            for data in nmealist:
+              if data is None or data.omitDecode:
+                continue
+              line=data.data
+              if not line.startswith('!'):
+                if nmeaParser.parseData(line,timestamp=data.timestamp,source=data.source,sourcePriority=data.sourcePriority):
+                  self.decoded.add(1)
+                continue
+              payload=nmeaParser.assembleAisPayload(line)
+              nmeaParser.countSentence(line[3:6],NMEAParser.C_IGNORED if payload is None else NMEAParser.C_PARSED)
+              if payload is None or payload is True:
+                continue
+              jobs.append(payload)
+              meta.append((data.source,data.sourcePriority*10,data.timestamp))
+            if len(jobs) > 0:
+              pending.append((pool.starmap_async(decodeAisPayload,jobs),meta))
+            self._applyAisResults(nmeaParser,pending)
+        except Exception as e:
+          AVNLog.warn("feeder exception - retrying %s",traceback.format_exc())
+        if self.decoded.shouldUpdate():
+          self.setInfo('decoder',
+                       "decoded %.4g/s"%self.decoded.avg(),
+                       WorkerStatus.NMEA if self.decoded.val()>0 else WorkerStatus.INACTIVE)
+        self._fetcher.report()
+    finally:
+      if pool is not None:
+        pool.terminate()
 
 class AVNGpsdFeeder(AVNDecoder):
   '''
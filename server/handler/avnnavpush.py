@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+###############################################################################
+# Copyright (c) 2012,2021 Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+###############################################################################
+'''
+push the navigation data to websocket clients
+instead of polling gps and ais data the client subscribes to store prefixes
+or AIS areas and gets the changes whenever the store changes.
+
+client messages (json):
+  {"type":"subscribe","id":"x","prefix":"gps","interval":0.5}
+  {"type":"subscribe","id":"y","prefix":"ais","centers":[[lat,lon],...],"distance":nm,"interval":2}
+  {"type":"unsubscribe","id":"x"}
+  {"type":"resync","id":"x"}
+server messages (json):
+  {"type":"data","id":"x","base":...,"generation":...,"full":...,"changed":{...},"removed":[...]}
+  {"type":"error","id":"x","error":"..."}
+A data message contains the changes between base and generation (see AVNStore.getChangesSince).
+If full is set the client has to replace all its data.
+Changes are coalesced per subscription - a slow client (or a large interval) will only get
+the latest state. If the base of a message does not match the generation of the last
+message the client has seen (e.g. because the websocket dropped messages), it must send a resync.
+'''
+import json
+import threading
+import time
+
+import avnav_handlerList
+from avnav_store import AVNStore
+from avnav_util import AVNLog
+from avnav_worker import AVNWorker, WorkerParameter, WorkerStatus
+from httpserver import WebSocketHandler
+
+
+class Subscription(object):
+  def __init__(self,id,prefix,interval,centers=None,distance=None):
+    self.id=id
+    self.prefix=prefix
+    self.interval=interval
+    self.centers=centers
+    self.distance=distance
+    self.generation=None #the generation of the last message sent
+    self.lastSend=0
+
+  def isAis(self):
+    return self.prefix == AVNStore.BASE_KEY_AIS
+
+  def getChanges(self,navdata):
+    if self.isAis():
+      return navdata.getAisChangesSince(self.generation,self.centers,self.distance)
+    return navdata.getChangesSince(self.generation,self.prefix)
+
+
+class PushConnection(WebSocketHandler):
+  MAX_SUBSCRIPTIONS=20
+  def __init__(self,handler,pusher):
+    '''
+    @type pusher: AVNNavPushHandler
+    '''
+    super().__init__(handler)
+    self.pusher=pusher
+    self.lock=threading.Lock()
+    self.subscriptions={}
+
+  def on_ws_message(self, message):
+    id=None
+    try:
+      request=json.loads(message)
+      id=request.get('id')
+      if id is None:
+        raise Exception("missing parameter id")
+      type=request.get('type')
+      if type == 'subscribe':
+        self.subscribe(id,request)
+      elif type == 'unsubscribe':
+        with self.lock:
+          self.subscriptions.pop(id,None)
+      elif type == 'resync':
+        with self.lock:
+          subscription=self.subscriptions.get(id)
+          if subscription is None:
+            raise Exception("unknown subscription %s"%id)
+          subscription.generation=None
+          self.sendChanges(subscription,time.monotonic())
+      else:
+        raise Exception("invalid type %s"%type)
+    except Exception as e:
+      AVNLog.debug("invalid navpush request %s: %s",message,e)
+      self.send_message(json.dumps({'type':'error','id':id,'error':str(e)}))
+
+  def subscribe(self,id,request):
+    prefix=request.get('prefix')
+    if prefix is None or prefix == '':
+      raise Exception("missing parameter prefix")
+    interval=max(float(request.get('interval',1)),self.pusher.getMinInterval())
+    centers=None
+    distance=None
+    if prefix == AVNStore.BASE_KEY_AIS and request.get('centers') is not None:
+      centers=[(float(c[0]),float(c[1])) for c in request.get('centers')]
+      distance=float(request.get('distance',10))
+    subscription=Subscription(id,prefix,interval,centers,distance)
+    with self.lock:
+      if not id in self.subscriptions and len(self.subscriptions) >= self.MAX_SUBSCRIPTIONS:
+        raise Exception("too many subscriptions")
+      self.subscriptions[id]=subscription
+      self.sendChanges(subscription,time.monotonic())
+    self.pusher.wakeUp()
+
+  def sendChanges(self,subscription,now):
+    '''
+    send the changes since the last message
+    must be called with the lock held
+    @type subscription: Subscription
+    '''
+    base=subscription.generation
+    changes=subscription.getChanges(self.pusher.navdata)
+    subscription.generation=changes['generation']
+    if not changes['full'] and len(changes['changed']) == 0 and len(changes['removed']) == 0:
+      #changes for other prefixes only - do not delay the next real change
+      return
+    changes['type']='data'
+    changes['id']=subscription.id
+    changes['base']=base
+    subscription.lastSend=now
+    self.send_message(json.dumps(changes))
+
+  def hasSubscriptions(self):
+    return len(self.subscriptions) > 0
+
+  def push(self,generation,aisGeneration,now):
+    '''
+    send the changes for all subscriptions that are due
+    @param generation: the current store generation
+    @param aisGeneration: the current AIS generation
+    @param now: monotonic time
+    @return: the time when the next rate limited subscription is due, None if none is waiting
+    '''
+    nextDue=None
+    with self.lock:
+      for subscription in self.subscriptions.values():
+        current=aisGeneration if subscription.isAis() else generation
+        if subscription.generation == current:
+          continue
+        due=subscription.lastSend+subscription.interval
+        if due > now:
+          if nextDue is None or due < nextDue:
+            nextDue=due
+          continue
+        try:
+          self.sendChanges(subscription,now)
+        except Exception as e:
+          AVNLog.error("unable to push %s: %s",subscription.prefix,e)
+    return nextDue
+
+  def on_ws_closed(self):
+    super().on_ws_closed()
+    self.pusher.removeConnection(self)
+
+
+class AVNNavPushHandler(AVNWorker):
+  PREFIX='navpush'
+  MAX_WAIT=1
+  MIN_INTERVAL_PARAM=WorkerParameter('minInterval',0.2,type=WorkerParameter.T_FLOAT,
+                                     description="the minimal interval (s) a client can request for a subscription")
+
+  def __init__(self, cfgparam):
+    super().__init__(cfgparam)
+    self.connections=[]
+    self.lock=threading.Lock()
+
+  @classmethod
+  def autoInstantiate(cls):
+    return True
+
+  @classmethod
+  def canEdit(cls):
+    return True
+
+  @classmethod
+  def canDisable(cls):
+    return True
+
+  @classmethod
+  def preventMultiInstance(cls):
+    return True
+
+  @classmethod
+  def getConfigParam(cls, child=None):
+    return [
+      cls.MIN_INTERVAL_PARAM
+    ]
+
+  def getMinInterval(self):
+    return self.MIN_INTERVAL_PARAM.fromDict(self.param)
+
+  def _setStatus(self):
+    with self.lock:
+      cl=len(self.connections)
+    st=WorkerStatus.NMEA if cl > 0 else WorkerStatus.RUNNING
+    self.setInfo('main',"%d connections"%cl,st)
+
+  def removeConnection(self,connection):
+    with self.lock:
+      try:
+        self.connections.remove(connection)
+      except ValueError:
+        pass
+    self._setStatus()
+
+  def stop(self):
+    super().stop()
+    with self.lock:
+      connections=self.connections.copy()
+    for c in connections:
+      try:
+        c.handler.close_ws()
+      except:
+        pass
+
+  def _hasSubscriptions(self):
+    with self.lock:
+      connections=self.connections.copy()
+    for connection in connections:
+      if connection.hasSubscriptions():
+        return True
+    return False
+
+  def run(self):
+    self._setStatus()
+    generation=None
+    aisGeneration=None
+    nextDue=None
+    while not self.shouldStop():
+      #without subscriptions we do not watch the store at all
+      #subscribe will wake us up
+      with self.condition:
+        self.condition.wait_for(lambda: self.shouldStop() or self._hasSubscriptions())
+      if self.shouldStop():
+        break
+      waitTime=self.MAX_WAIT
+      if nextDue is not None:
+        #there are changes waiting for rate limited subscriptions
+        #wake up when the first one is due - or earlier on a new change
+        #for the other subscriptions
+        waitTime=max(0,min(nextDue-time.monotonic(),self.MAX_WAIT))
+      generation,aisGeneration=self.navdata.waitForChange(generation,aisGeneration,waitTime)
+      with self.lock:
+        connections=self.connections.copy()
+      now=time.monotonic()
+      nextDue=None
+      for connection in connections:
+        due=connection.push(generation,aisGeneration,now)
+        if due is not None and (nextDue is None or due < nextDue):
+          nextDue=due
+
+  def getHandledCommands(self):
+    return {
+      'websocket':"/"+self.PREFIX
+    }
+
+  def handleApiRequest(self, type, command, requestparam, **kwargs):
+    if type != 'websocket':
+      raise Exception("can only handle websocket requests")
+    handler=kwargs.get('handler')
+    if handler is None:
+      raise Exception("need the request handler for websocket requests")
+    connection=PushConnection(handler,self)
+    with self.lock:
+      self.connections.append(connection)
+    self._setStatus()
+    self.wakeUp()
+    AVNLog.info("added navpush connection")
+    return connection
+
+avnav_handlerList.registerHandler(AVNNavPushHandler)
@@ -25,20 +25,99 @@
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
 
+import weakref
+
 from avnav_worker import *
 from avnav_util import MovingSum
+from avnav_nmea import NMEAFilter
 import avnav_handlerList
 
 
 class NmeaEntry(object):
+  '''
+  an entry in the queue
+  the record can be given as str or as bytes (as received)
+  the other representation is only created on first access
+  so readers can hand over bytes and writers can send the same bytes
+  to all clients without encoding them again
+  '''
   def __init__(self,data,source=None,omitDecode=False,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,subsource=None):
-    self.data=data
+    if isinstance(data,bytes):
+      self._data=None
+      self._raw=data
+    else:
+      self._data=data
+      self._raw=None
     self.source=source
     self.omitDecode=omitDecode
     self.sourcePriority=sourcePriority
     self.timestamp=time.monotonic()
     self.subsource=subsource
 
+  @property
+  def data(self):
+    if self._data is None:
+      self._data=self._raw.decode('ascii','ignore')
+    return self._data
+
+  @data.setter
+  def data(self,value):
+    self._data=value
+    self._raw=None
+
+  @property
+  def raw(self):
+    if self._raw is None:
+      self._raw=self._data.encode('ascii','ignore')
+    return self._raw
+
+
+
+class FetcherStatistics(object):
+  '''
+  statistics for one consumer of the queue
+  updated by AVNQueue.fetchFromHistory
+  '''
+  #upper bounds (in s) for the latency histogram, the last bucket takes the rest
+  LATENCY_BUCKETS=[0.01,0.05,0.1,0.5,1,2,5]
+
+  def __init__(self,name=None):
+    self.name=name
+    self.clear()
+
+  def clear(self):
+    self.fetched=0
+    self.droppedAge=0
+    self.droppedOverrun=0
+    self.behind=0
+    self.lockTime=0
+    self.maxLatency=0
+    self.latency=[0]*(len(self.LATENCY_BUCKETS)+1)
+
+  def addLatency(self,latency):
+    if latency > self.maxLatency:
+      self.maxLatency=latency
+    for idx in range(0,len(self.LATENCY_BUCKETS)):
+      if latency <= self.LATENCY_BUCKETS[idx]:
+        self.latency[idx]+=1
+        return
+    self.latency[-1]+=1
+
+  def serialize(self):
+    histogram={}
+    for idx in range(0,len(self.LATENCY_BUCKETS)):
+      histogram[str(self.LATENCY_BUCKETS[idx])]=self.latency[idx]
+    histogram['inf']=self.latency[-1]
+    return {
+      'name':self.name,
+      'fetched':self.fetched,
+      'behind':self.behind,
+      'droppedAge':self.droppedAge,
+      'droppedOverrun':self.droppedOverrun,
+      'lockTime':self.lockTime,
+      'maxLatency':self.maxLatency,
+      'latency':histogram
+    }
 
 
 #a Worker for feeding data trough gpsd (or directly to the navdata)
@@ -74,13 +153,17 @@ class AVNQueue(AVNWorker):
     super().__init__(cfgparam)
     self.type=AVNWorker.Type.FEEDER
     self.listlock=threading.Condition()
+    #the history is a ring buffer with a fixed capacity (maxList)
+    #the entry with sequence s is stored at slot s % capacity
     self.history=[]
+    self.numEntries=0
     #sequence semantics:
     #the last entry in the list has the sequence stored here
-    #the first entry has self.sequence-len(self.history)+1
+    #the first entry has self.sequence-self.numEntries+1
     #so if there is one entry in the list
     #current sequence and first sequence are identical
     self.sequence=1
+    self.fetchers=weakref.WeakSet()
     self.readConfig()
 
   def _firstSequence(self):
@@ -89,7 +172,86 @@ class AVNQueue(AVNWorker):
     only call when the list is locked
     @return:
     '''
-    return self.sequence-len(self.history)+1
+    return self.sequence-self.numEntries+1
+
+  def _entry(self,sequence):
+    '''
+    get the entry for a sequence
+    only call when the list is locked and the sequence is in the list
+    '''
+    return self.history[sequence % len(self.history)]
+
+  def _slice(self,first,last):
+    '''
+    get the entries from first to last (including)
+    only call when the list is locked and both sequences are in the list
+    '''
+    capacity=len(self.history)
+    start=first % capacity
+    end=last % capacity
+    if start <= end:
+      return self.history[start:end+1]
+    return self.history[start:]+self.history[:end+1]
+
+  def _findAge(self,first,allowedAge):
+    '''
+    binary search for the first sequence >= first
+    with a timestamp not older then allowedAge
+    only call when the list is locked
+    @return: the sequence, self.sequence+1 if all entries are too old
+    '''
+    low=first
+    high=self.sequence+1
+    while low < high:
+      mid=(low+high)//2
+      if self._entry(mid).timestamp < allowedAge:
+        low=mid+1
+      else:
+        high=mid
+    return low
+
+  def _resize(self,capacity):
+    '''
+    change the capacity of the ring buffer
+    keeping the newest entries
+    only call when the list is locked
+    '''
+    if capacity < 1:
+      capacity=1
+    if capacity == len(self.history):
+      return
+    keep=min(self.numEntries,capacity)
+    history=[None]*capacity
+    for sequence in range(self.sequence-keep+1,self.sequence+1):
+      history[sequence % capacity]=self._entry(sequence)
+    self.history=history
+    self.numEntries=keep
+  def registerFetcher(self,fetcher):
+    '''
+    register a fetcher to be included in getStatistics
+    we only keep weak references
+    '''
+    self.fetchers.add(fetcher)
+
+  def getStatistics(self):
+    '''
+    get the queue state and the statistics of all registered fetchers
+    @return: a dict
+    '''
+    with self.listlock:
+      rt={
+        'name':self.getStatusName(),
+        'sequence':self.sequence,
+        'entries':self.numEntries,
+        'capacity':len(self.history),
+        'maxAge':self.maxAge
+      }
+    fetchers=[]
+    for fetcher in list(self.fetchers):
+      fetchers.append(fetcher.getStatistics().serialize())
+    rt['fetchers']=fetchers
+    return rt
+
   def updateConfig(self, param, child=None):
     rt=super().updateConfig(param, child)
     self.readConfig()
@@ -99,6 +261,8 @@ class AVNQueue(AVNWorker):
     self.maxlist = self.P_MAXLIST.fromDict(self.param)
     self.waitTime= self.P_SLEEP.fromDict(self.param)
     self.maxAge= self.P_AGE.fromDict(self.param)
+    with self.listlock:
+      self._resize(int(self.maxlist))
 
   def stop(self):
     super().stop()
@@ -110,37 +274,87 @@ class AVNQueue(AVNWorker):
 
 
 
+  def _prepareEntry(self,entry,addCheckSum=False):
+    '''
+    check and normalize an NMEA record before adding it
+    @param entry: the record (str or bytes)
+    @param addCheckSum: add the NMEA checksum
+    @return: the record to be added or None if it should be ignored
+    '''
+    if len(entry) < 5:
+      AVNLog.debug("addNMEA: ignoring short data %s",entry)
+      return None
+    if isinstance(entry,bytes):
+      if not addCheckSum:
+        if not entry[-2:]==b"\r\n":
+          entry=entry+b"\r\n"
+        return entry
+      entry=entry.decode('ascii','ignore')
+    if addCheckSum:
+      entry= entry.replace("\r","").replace("\n","")
+      entry+= "*" + NMEAParser.nmeaChecksum(entry) + "\r\n"
+    else:
+      if not entry[-2:]=="\r\n":
+        entry=entry+"\r\n"
+    return entry
+
+  def _append(self,nentry):
+    '''
+    append an entry to the ring buffer
+    only call when the list is locked
+    '''
+    self.sequence+=1
+    self.history[self.sequence % len(self.history)]=nentry
+    if self.numEntries < len(self.history):
+      self.numEntries+=1
+
   def addNMEA(self, entry,source=None,addCheckSum=False,omitDecode=False,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,subsource=None):
     """
     add an NMEA record to our internal queue
-    @param entry: the record
+    @param entry: the record (str or bytes)
     @param source: the source where the record comes from
     @param addCheckSum: add the NMEA checksum
     @return:
     """
     rt=False
     hl=0
-    if len(entry) < 5:
-      AVNLog.debug("addNMEA: ignoring short data %s",entry)
+    entry=self._prepareEntry(entry,addCheckSum)
+    if entry is None:
       return False
-    if addCheckSum:
-      entry= entry.replace("\r","").replace("\n","")
-      entry+= "*" + NMEAParser.nmeaChecksum(entry) + "\r\n"
-    else:
-      if not entry[-2:]=="\r\n":
-        entry=entry+"\r\n"
-    nentry=NmeaEntry(entry,source,omitDecode,sourcePriority,subsource=subsource)
     with self.listlock:
-      self.sequence+=1
-      if len(self.history) >= self.maxlist:
-        self.history.pop(0)
-      self.history.append(nentry)
-      hl=len(self.history)
+      #create the entry inside the lock to keep the timestamps ordered
+      nentry=NmeaEntry(entry,source,omitDecode,sourcePriority,subsource=subsource)
+      self._append(nentry)
+      hl=self.numEntries
       rt=True
       self.listlock.notify_all()
     AVNLog.debug("addNMEA history=%d data=%s",hl,entry)
     return rt
 
+  def addNMEABatch(self, entries,source=None,addCheckSum=False,omitDecode=False,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,subsource=None):
+    """
+    add a list of NMEA records to our internal queue
+    all records are added with one lock and the fetchers are only notified once
+    @param entries: the list of records (str or bytes)
+    @param source: the source where the records come from
+    @param addCheckSum: add the NMEA checksum
+    @return: the number of records that have been added
+    """
+    prepared=[]
+    for entry in entries:
+      entry=self._prepareEntry(entry,addCheckSum)
+      if entry is not None:
+        prepared.append(entry)
+    if len(prepared) < 1:
+      return 0
+    with self.listlock:
+      for entry in prepared:
+        self._append(NmeaEntry(entry,source,omitDecode,sourcePriority,subsource=subsource))
+      hl=self.numEntries
+      self.listlock.notify_all()
+    AVNLog.debug("addNMEABatch history=%d, %d entries",hl,len(prepared))
+    return len(prepared)
+
   def wakeUp(self):
     super().wakeUp()
     with self.listlock:
@@ -157,18 +371,22 @@ class AVNQueue(AVNWorker):
                        blackList=None,
                        returnError=False,
                        maxAge=None,
-                       omitsubsource=None):
+                       omitsubsource=None,
+                       returnBytes=False,
+                       statistics: FetcherStatistics=None):
     '''
     fetch data from the queue
     @param sequence: the last read sequence
     @param maxEntries: the max number of entries we read
     @param includeSource: include the meta information with the entries
     @param waitTime: time to wait (in s) if no data is available
-    @param nmeafilter: an nmeafilter (list) to only filter messages matching
+    @param nmeafilter: an nmeafilter (list or compiled NMEAFilter) to only filter messages matching
     @param blackList: a list of source names to be omitted
     @param returnError: return an error flag
     @param maxAge: max age (in s) of the messages, defaults to the configured maxAge
     @param omitsubsource: if set do not fetch records from this subsource
+    @param returnBytes: if includeSource is not set, return the records as bytes
+    @param statistics: if set, update this FetcherStatistics
     @return:
     '''
     seq=0
@@ -181,20 +399,24 @@ class AVNQueue(AVNWorker):
       maxEntries=0
     if sequence is None:
       sequence=0
+    nmeafilter=NMEAFilter.compile(nmeafilter)
     now=time.monotonic()
     stop = now + waitTime
     numErrors=0
+    numOverrun=0
+    lockTime=0
     def shouldInclude(item: NmeaEntry):
       if omitsubsource is not None and item.subsource is not None and item.subsource == omitsubsource:
         return False
       if nmeafilter is not None:
-        if not NMEAParser.checkFilter(item.data,nmeafilter):
+        if not nmeafilter.matches(item.data):
           return False
       if blackList is not None:
         if item.source in blackList:
           return False
       return True
     with self.listlock:
+      lockStart=time.monotonic()
       if sequence <= 0:
         #if a new connection is opened - always wait for a new entry before sending out
         #sequence = 0 or sequence = None is a new connection
@@ -213,22 +435,23 @@ class AVNQueue(AVNWorker):
             startSequence=self._firstSequence()
             if (sequence >= startSequence):
               #good we still have our expected sequence in the queue
-              startPoint=sequence-startSequence
+              first=sequence
             else:
               #our requested sequence is not in the list any more
               numErrors=startSequence-sequence
-              startPoint=0
+              numOverrun=numErrors
+              first=startSequence
             allowedAge=time.monotonic()-maxAge #maybe better related to return point
-            while startPoint < len(self.history) and self.history[startPoint].timestamp < allowedAge:
-              numErrors+=1
-              startPoint+=1
-            if startPoint < len(self.history):
+            startPoint=self._findAge(first,allowedAge)
+            numErrors+=startPoint-first
+            if startPoint <= self.sequence:
               #something to return
-              numrt=len(self.history)-startPoint
+              numrt=self.sequence-startPoint+1
               if numrt > maxEntries:
                 numrt=maxEntries
-              seq=startSequence+startPoint+numrt-1
-              rtlist=self.history[startPoint:startPoint+numrt]
+              seq=startPoint+numrt-1
+              if numrt > 0:
+                rtlist=self._slice(startPoint,seq)
               break
             #if we did not find anything
             #we start the next time at the topmost sequence+1
@@ -238,9 +461,21 @@ class AVNQueue(AVNWorker):
             wait = stop - time.monotonic()
             if wait <= 0:
               break
+            lockTime+=time.monotonic()-lockStart
             self.listlock.wait(wait)
+            lockStart=time.monotonic()
       except Exception as e:
         pass
+      if statistics is not None:
+        statistics.behind=self.sequence-seq if seq <= self.sequence else 0
+    if statistics is not None:
+      now=time.monotonic()
+      statistics.lockTime+=lockTime+now-lockStart
+      statistics.droppedOverrun+=numOverrun
+      statistics.droppedAge+=numErrors-numOverrun
+      statistics.fetched+=len(rtlist)
+      for entry in rtlist:
+        statistics.addLatency(now-entry.timestamp)
     if len(rtlist) < 1:
       if returnError:
         return (numErrors,seq,rtlist)
@@ -258,7 +493,7 @@ class AVNQueue(AVNWorker):
       rt=[]
       for le in rtlist:
         if shouldInclude(le):
-          rt.append(le.data)
+          rt.append(le.raw if returnBytes else le.data)
       if returnError:
         return (numErrors,seq,rt)
       return (seq,rt)
@@ -285,6 +520,9 @@ class Fetcher:
       return None
     return rt
 
+  def _compile(self,param):
+    return NMEAFilter.compile(self._split(param))
+
   def __init__(self,queue:AVNQueue,
                infoHandler:InfoHandler,
                maxEntries=10,
@@ -295,13 +533,15 @@ class Fetcher:
                maxAge=None,
                returnErrors=False,
                sumKey='received',
-               ownsubsource=None):
+               ownsubsource=None,
+               returnBytes=False,
+               name=None):
     self._queue=queue
     self._info=infoHandler
     self._maxEntries=maxEntries
     self._includeSource=includeSource
     self._waitTime=waitTime
-    self._nmeaFilter=self._split(nmeaFilter)
+    self._nmeaFilter=self._compile(nmeaFilter)
     self._blackList=self._split(blackList)
     self._maxAge=maxAge if maxAge is not None else queue.maxAge
     self._returnErrors=returnErrors
@@ -311,6 +551,13 @@ class Fetcher:
       self._nmeaSum=MovingSum()
       self._nmeaErrors=MovingSum()
     self._ownsubsource=ownsubsource
+    self._returnBytes=returnBytes
+    if name is None:
+      name=infoHandler.getStatusName() if isinstance(infoHandler,AVNWorker) else infoHandler.__class__.__name__
+      if sumKey is not None:
+        name+=":"+sumKey
+    self._statistics=FetcherStatistics(name)
+    queue.registerFetcher(self)
 
   def __del__(self):
     if self._sumKey is not None:
@@ -333,7 +580,7 @@ class Fetcher:
     if waitTime is not None:
       self._waitTime=waitTime
     if nmeaFilter is not None:
-      self._nmeaFilter=self._split(nmeaFilter)
+      self._nmeaFilter=self._compile(nmeaFilter)
     if maxAge is not None:
       self._maxAge=maxAge
     if returnErrors is not None:
@@ -355,7 +602,9 @@ class Fetcher:
       blackList=self._blackList,
       returnError=True,
       maxEntries=self._maxEntries if maxEntries is None else maxEntries,
-      omitsubsource=self._ownsubsource
+      omitsubsource=self._ownsubsource,
+      returnBytes=self._returnBytes,
+      statistics=self._statistics
       )
     if self._nmeaErrors is not None:
       self._nmeaErrors.add(numErrors)
@@ -366,8 +615,12 @@ class Fetcher:
     else:
       return nmeaList
 
+  def getStatistics(self) -> FetcherStatistics:
+    return self._statistics
+
   def reset(self):
     self._sequence=None
+    self._statistics.clear()
     if self._nmeaSum is not None:
       self._nmeaSum.clear()
     if self._nmeaErrors is not None:
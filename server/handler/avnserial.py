@@ -210,6 +210,17 @@ class SerialReader(object):
     #if not os.name=='posix':
     return serialDevice.readline(300)
 
+  def hasPendingInput(self,serialDevice):
+    '''
+    check if there is more data already received
+    in this case we continue to collect lines into a batch
+    before adding them to the queue
+    '''
+    try:
+      return serialDevice.in_waiting > 0
+    except:
+      return False
+
 
   #the run method - just try forever  
   def run(self):
@@ -223,7 +234,7 @@ class SerialReader(object):
     filterstr = self.P_FILTER.fromDict(self.param)
     filter = None
     if filterstr != "":
-      filter = filterstr.split(',')
+      filter = NMEAFilter.compile(filterstr)
     try:
       while not self.doStop:
         portname = self.P_PORT.fromDict(self.param,rangeOrListCheck=False)
@@ -275,6 +286,15 @@ class SerialReader(object):
         MAXLEN = 500
         buffer = b''
         nmeaSum = MovingSum()
+        MAXBATCH = 50
+        #max time (s) a record waits in the batch on a busy line
+        MAXBATCHTIME = 0.1
+        batch = []
+        batchStart = 0
+        def flushBatch():
+          if len(batch) > 0:
+            self.queue.addNMEABatch(batch, source=self.sourceName, sourcePriority=priority)
+            batch.clear()
         def nmeaInfo():
           if nmeaSum.shouldUpdate():
             self.infoHandler.setInfo('reader',
@@ -284,6 +304,9 @@ class SerialReader(object):
           nmeaSum.add(0)
           nmeaInfo()
           bytes = b''
+          if len(batch) >= MAXBATCH or (time.monotonic() - batchStart) >= MAXBATCHTIME \
+              or not self.hasPendingInput(self.device):
+            flushBatch()
           try:
             bytes = self.readLine(self.device, timeout)
             if len(buffer) > 0:
@@ -331,7 +354,9 @@ class SerialReader(object):
               if not NMEAParser.checkFilter(data, filter):
                 continue
               nmeaSum.add(1)
-              self.queue.addNMEA(data, source=self.sourceName, sourcePriority=priority)
+              if len(batch) == 0:
+                batchStart = time.monotonic()
+              batch.append(data)
           if (time.monotonic() - lastTime) > porttimeout:
             self.infoHandler.setInfo(INAME,"timeout", WorkerStatus.ERROR)
             self.device.close()
@@ -342,6 +367,7 @@ class SerialReader(object):
             else:
               AVNLog.debug("reopen port %s - timeout elapsed", portname)
             break
+        flushBatch()
 
     except:
       AVNLog.info("exception in receiver %s" % traceback.format_exc())
@@ -27,12 +27,15 @@
 import io
 import json
 import shutil
+import struct
 import urllib.request, urllib.parse, urllib.error
 
 
 import avnav_handlerList
 import gemf_reader
 import mbtiles_reader
+from tilecache import TileCache
+from tileprefetcher import TilePrefetcher
 from avnav_util import *
 from avnav_worker import WorkerStatus
 from avndirectorybase import AVNDirectoryHandlerBase, AVNDirectoryListEntry
@@ -270,12 +273,15 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
   itemList = None
   PATH_PREFIX="/chart"
   DEFAULT_CHART_CFG="default.cfg"
+  MAX_BATCH_TILES=128
   ALLOWED_EXTENSIONS=[".gemf",".mbtiles",".xml",ChartDescription.OVL_EXT]
   def __init__(self,param):
     self.param=param
     self.externalProviders={}
     self.importer=None
     AVNDirectoryHandlerBase.__init__(self, param,'chart')
+    self.tileCache=TileCache(self.getIntParam('tileCacheSize')*1024*1024)
+    self.prefetcher=TilePrefetcher(self,self.getIntParam('prefetchMinutes'),self.getIntParam('prefetchBudget'))
   @classmethod
   def getConfigName(cls):
     return "AVNChartHandler"
@@ -285,7 +291,11 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
       return None
     return {
             'period': 5, #how long to sleep between 2 checks
-            'upzoom': 2 #zoom up in charts
+            'upzoom': 2, #zoom up in charts
+            'mbtilesConnections': 4, #parallel readers for each mbtiles file
+            'tileCacheSize': 32, #memory for the tile cache (MB), 0 to disable
+            'prefetchMinutes': 10, #load the tiles along the course for this time, 0 to disable
+            'prefetchBudget': 100 #max number of tiles to prefetch every 10s
     }
 
 
@@ -318,8 +328,13 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
   def run(self):
     self.baseDir = self.httpServer.getChartBaseDir()
     self.importer = self.findHandlerByName("AVNImporter")
+    self.prefetcher.start()
     super().run()
 
+  def stop(self):
+    self.prefetcher.stop()
+    super().stop()
+
   def wakeUp(self):
     super().wakeUp()
     #we need to wake all threads that are sitting at conditions
@@ -341,12 +356,24 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
     for extProvider in list(self.externalProviders.keys()):
       self.externalProviders[extProvider].queryProvider()
 
+  def getStatusProperties(self):
+    rt={'tile cache':self.tileCache.getStatus(),
+        'tile prefetch':self.prefetcher.getStatus()}
+    for item in list(self.itemList.values()):
+      chart=item.getChart()
+      if isinstance(chart,ChartFile):
+        status=chart.getStatus()
+        if status is not None:
+          rt[item.name]=status
+    return rt
+
   def onItemAdd(self, itemDescription):
     # type: (ChartDescription) -> ChartDescription or None
     if itemDescription is None:
       return None
     if itemDescription.name.startswith(self.TMP_PREFIX):
       return None
+    self.tileCache.invalidate(itemDescription.name)
     try:
       fullname=os.path.join(self.baseDir,itemDescription.name)
       chart=None
@@ -358,7 +385,7 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
         if fullname.endswith(".gemf"):
           chart = gemf_reader.GemfFile(fullname)
         elif fullname.endswith(".mbtiles"):
-          chart = mbtiles_reader.MBTilesFile(fullname)
+          chart = mbtiles_reader.MBTilesFile(fullname,numConnections=self.getIntParam('mbtilesConnections'))
         elif fullname.endswith(".xml"):
           chart = XmlChartFile(fullname)
       if chart is None:
@@ -389,6 +416,7 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
     # type: (ChartDescription) -> None
     if itemDescription.isChart():
       itemDescription.getChart().close()
+      self.tileCache.invalidate(itemDescription.name)
 
   def deleteFromOverlays(self,type,name):
     """
@@ -488,6 +516,7 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
     #basically we can today handle 2 types of requests:
     #get the overview /chart/int/<name>/avnav.xml
     #get a tile /chart/int/<name>/<srcname>/z/x/y.png
+    #get multiple tiles /chart/int/<name>/<srcname>/z/batch (see handleTileBatch)
     if parts[1] == AVNUtil.NAVXML:
       AVNLog.debug("avnav request for chart %s",chartDescription.name)
       data=chartDescription.getData()
@@ -497,15 +526,89 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
       rsp={'status':'OK','sequence':chartDescription.getChart().getChangeCount()}
       handler.sendNavResponse(json.dumps(rsp))
       return True
+    if len(parts) == 4 and parts[3] == "batch":
+      self.prefetcher.recordRequest(name,parts[1],int(parts[2]))
+      self.handleTileBatch(chartDescription,parts[1],int(parts[2]),handler,requestParam)
+      return True
     if len(parts) != 5:
       raise Exception("invalid request to chart file %s: %s" %(chartDescription.name,path))
-    data=chartDescription.getChart().getTileData((int(parts[2]),int(parts[3]),int(parts[4].replace(".png",""))),parts[1])
+    chart=chartDescription.getChart()
+    tile=(int(parts[2]),int(parts[3]),int(parts[4].replace(".png","")))
+    self.prefetcher.recordRequest(name,parts[1],tile[0])
+    try:
+      data=self.tileCache.getTile(TileCache.createKey(name,chart.getChangeCount(),parts[1],tile),
+                                  lambda: chart.getTileData(tile,parts[1]))
+    except Exception as e:
+      #not cached - the next request will try again
+      AVNLog.error("unable to read tile %s: %s",path,str(e))
+      handler.send_error(500,"unable to read tile %s"%(path))
+      return True
     if data is None:
       handler.send_error(404,"File %s not found"%(path))
       return True
     handler.writeData(data, "image/png", )
     return True
 
+  def getBatchTiles(self,requestParam):
+    '''
+    the tiles for a batch request, either
+    tiles=x1,y1,x2,y2,... or
+    xmin=..&xmax=..&ymin=..&ymax=..
+    @return: a list of (x,y)
+    '''
+    tiles=AVNUtil.getHttpRequestParam(requestParam,'tiles')
+    if tiles is not None:
+      values=[int(v) for v in tiles.split(',') if v != '']
+      if len(values) % 2 != 0:
+        raise Exception("invalid tiles parameter")
+      rt=list(zip(values[0::2],values[1::2]))
+    else:
+      xmin=int(AVNUtil.getHttpRequestParam(requestParam,'xmin',True))
+      xmax=int(AVNUtil.getHttpRequestParam(requestParam,'xmax',True))
+      ymin=int(AVNUtil.getHttpRequestParam(requestParam,'ymin',True))
+      ymax=int(AVNUtil.getHttpRequestParam(requestParam,'ymax',True))
+      if (xmax-xmin+1)*(ymax-ymin+1) > self.MAX_BATCH_TILES:
+        raise Exception("too many tiles, max %d"%self.MAX_BATCH_TILES)
+      rt=[(x,y) for x in range(xmin,xmax+1) for y in range(ymin,ymax+1)]
+    if len(rt) > self.MAX_BATCH_TILES:
+      raise Exception("too many tiles, max %d"%self.MAX_BATCH_TILES)
+    return rt
+
+  def handleTileBatch(self,chartDescription,source,zoom,handler,requestParam):
+    '''
+    send multiple tiles of one zoom level in one response
+    the response (application/octet-stream) contains
+      number of tiles (4 bytes)
+      for each tile: x (4 bytes), y (4 bytes), length (4 bytes, -1 for a missing tile), data
+    all numbers are signed big endian
+    '''
+    coordinates=self.getBatchTiles(requestParam)
+    chart=chartDescription.getChart()
+    changeCount=chart.getChangeCount()
+    keys=[TileCache.createKey(chartDescription.name,changeCount,source,(zoom,x,y)) for x,y in coordinates]
+    result=[None]*len(coordinates)
+    missing=[]
+    for i in range(len(keys)):
+      found=False
+      if self.tileCache.isEnabled():
+        found,result[i]=self.tileCache.get(keys[i])
+      if not found:
+        missing.append(i)
+    if len(missing) > 0:
+      #on errors this raises and we do not cache anything
+      loaded=chart.getTileDataBatch([(zoom,)+coordinates[i] for i in missing],source)
+      for i,data in zip(missing,loaded):
+        result[i]=data
+        self.tileCache.put(keys[i],data)
+    parts=[struct.pack("!l",len(coordinates))]
+    for (x,y),data in zip(coordinates,result):
+      if data is None:
+        parts.append(struct.pack("!3l",x,y,-1))
+      else:
+        parts.append(struct.pack("!3l",x,y,len(data)))
+        parts.append(data)
+    handler.writeData(b''.join(parts),"application/octet-stream")
+
   def getChartDescriptionByKey(self, chartKey, requestIp="localhost"):
     '''
     find a chart by given key
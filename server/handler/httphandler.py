@@ -1,11 +1,14 @@
 import http.server
 import io
 import cgi
+import hashlib
 import json
 import os
 import posixpath
 import re
+import stat
 import threading
+import time
 import traceback
 import urllib.request, urllib.parse, urllib.error
 import urllib.parse
@@ -14,6 +17,7 @@ from avnav_store import AVNStore
 from avnav_util import AVNUtil, AVNLog, AVNDownload
 from avnav_websocket import HTTPWebSocketsHandler
 from avnav_worker import AVNWorker
+from avnqueue import AVNQueue
 
 class WebSocketHandler(object):
   def __init__(self,handler):
@@ -45,20 +49,103 @@ class Encoder(json.JSONEncoder):
       return o.serialize()
     return super(Encoder, self).default(o)
 
+class NavResponse(object):
+  '''
+  an encoded json response that can be sent multiple times
+  '''
+  __slots__=('data','etag','generation','timestamp')
+  def __init__(self,data,generation):
+    self.data=data
+    self.etag='"%s"'%hashlib.sha1(data).hexdigest()[0:20]
+    self.generation=generation
+    self.timestamp=time.monotonic()
+
+class NavResponseCache(object):
+  '''
+  a cache for the encoded responses of nav requests
+  an entry is valid as long as the store generation it has been created for
+  did not change and it is not older then maxAge seconds
+  (AIS responses contain the age of the targets)
+  '''
+  #request parameters that do not change the response
+  IGNORED_PARAMETERS=('callback','_')
+  def __init__(self,maxAge=1,maxEntries=200):
+    self.maxAge=maxAge
+    self.maxEntries=maxEntries
+    self.entries={}
+    self.lock=threading.Lock()
+    self.hits=0
+    self.misses=0
+
+  @classmethod
+  def requestKey(cls,requestParam):
+    rt=[]
+    for k,v in requestParam.items():
+      if k in cls.IGNORED_PARAMETERS:
+        continue
+      rt.append((k,tuple(v) if isinstance(v,list) else v))
+    rt.sort()
+    return tuple(rt)
+
+  def get(self,key,generation,creator):
+    '''
+    get a response from the cache or create it
+    @param key: the key from requestKey
+    @param generation: the current generation of the data, None to only use maxAge
+    @param creator: a function returning the json string for the response
+    @return: a NavResponse
+    '''
+    now=time.monotonic()
+    with self.lock:
+      rt=self.entries.get(key)
+      if rt is not None and rt.generation == generation and rt.timestamp >= (now-self.maxAge):
+        self.hits+=1
+        return rt
+      self.misses+=1
+    rt=NavResponse(creator().encode('utf-8'),generation)
+    with self.lock:
+      self.entries.pop(key,None)
+      if len(self.entries) >= self.maxEntries:
+        limit=now-self.maxAge
+        for k,v in list(self.entries.items()):
+          if v.timestamp < limit:
+            del self.entries[k]
+        while len(self.entries) >= self.maxEntries:
+          #dicts are ordered by insertion - remove the oldest
+          del self.entries[next(iter(self.entries))]
+      self.entries[key]=rt
+    return rt
+
+  def getStatistics(self):
+    with self.lock:
+      return {'entries':len(self.entries),'hits':self.hits,'misses':self.misses}
+
 
 class AVNHTTPHandler(HTTPWebSocketsHandler):
   wsHandler: WebSocketHandler
   protocol_version = "HTTP/1.1" #necessary for websockets!
   def __init__(self,request,client_address,server):
+    self.initHandler(server)
+    if server.requestPool is None:
+      threading.current_thread().setName("HTTPHandler")
+    AVNLog.ld("receiver thread started",client_address)
+    http.server.SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
+
+  def initHandler(self,server):
     #allow write buffering
     #see https://lautaportti.wordpress.com/2011/04/01/basehttprequesthandler-wastes-tcp-packets/
     self.wbufsize=-1
     self.id=None
     self.getRequestParam=AVNUtil.getHttpRequestParam
-    threading.current_thread().setName("HTTPHandler")
-    AVNLog.ld("receiver thread started",client_address)
-    http.server.SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
     self.wsHandler=None
+    #set if another thread will handle the websocket (see runHandedOverWebSocket)
+    self.wsHandedOver=False
+    #set if the server waits for the next request on the connection (see resumeParked)
+    self.parked=False
+    #close idle keep alive connections when running in a pool
+    self.timeout=server.getKeepAliveTimeout()
+    #the (offset,count) for the file returned by send_head
+    self.sendRange=None
 
   def log_message(self, format, *args):
     AVNLog.debug(format,*args)
@@ -75,6 +162,78 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     except Exception as e:
       return False
 
+  def hand_over_ws(self):
+    if not self.server.canHandOverWebSocket():
+      return False
+    self.wsHandedOver=True
+    #stop the request loop in this thread
+    self.close_connection=True
+    return True
+
+  def runHandedOverWebSocket(self):
+    '''
+    read the websocket messages after hand_over_ws
+    to be called by the server after the handler for the connection returned
+    '''
+    self.wsHandedOver=False
+    try:
+      self.connection.settimeout(None)
+      self.close_connection=False
+      self._read_messages()
+    finally:
+      try:
+        self.finish()
+      except:
+        pass
+      self.server.shutdown_request(self.request)
+
+  def handle(self):
+    '''
+    when running in a pool we only handle the requests that are already available,
+    an idle keep alive connection is parked in the server instead of blocking the thread
+    '''
+    if not self.server.canParkConnection():
+      super().handle()
+      return
+    self.close_connection=True
+    self.handle_one_request()
+    while not self.close_connection:
+      if not self.hasPendingRequest():
+        self.parked=True
+        return
+      self.handle_one_request()
+
+  def hasPendingRequest(self):
+    '''
+    check without blocking if the next request is already buffered or received
+    '''
+    try:
+      self.connection.setblocking(False)
+      try:
+        return len(self.rfile.peek(1)) > 0
+      finally:
+        self.connection.settimeout(self.timeout)
+    except OSError:
+      return False
+
+  def resumeParked(self):
+    '''
+    handle the next requests after the server found data on a parked connection
+    to be called by the server, finish will be called unless the connection is parked again
+    '''
+    self.parked=False
+    try:
+      self.handle()
+    finally:
+      if not self.parked:
+        self.finish()
+
+  def finish(self):
+    if self.wsHandedOver or self.parked:
+      #will be done when the websocket is closed or the connection is resumed
+      return
+    super().finish()
+
   def on_ws_message(self, message):
     if self.wsHandler is None:
       raise Exception("no websocket handler")
@@ -130,8 +289,17 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
       ctype = self.guess_type(path)
     return ctype
 
+  #overwrite this from SimpleHTTPRequestHandler
+  #the range of a previous request must not survive (e.g. a HEAD request on a keep alive connection)
+  def do_HEAD(self):
+    try:
+      super().do_HEAD()
+    finally:
+      self.sendRange=None
+
   #overwrite this from SimpleHTTPRequestHandler
   def send_head(self):
+    self.sendRange=None
     path=self.translate_path(self.path)
     if path is None:
       return
@@ -172,16 +340,119 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     except IOError:
         self.send_error(404, "File not found")
         return None
-    self.send_response(200)
-    self.send_header("Content-type", ctype)
     fs = os.fstat(f.fileno())
-    self.send_header("Content-Length", str(fs[6]))
+    lastModified=self.date_time_string(fs.st_mtime)
+    self.sendRange=self.sendRangeResponse(fs[6],lastModified)
+    if self.sendRange is None:
+      f.close()
+      return None
+    self.send_header("Content-type", ctype)
     if path.endswith(".js") or path.endswith(".css"):
       self.send_header("cache-control","private, max-age=0, no-cache")
-    self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+    self.send_header("Last-Modified", lastModified)
     self.end_headers()
     return f
 
+  #overwrite this from SimpleHTTPRequestHandler
+  #to send the range from send_head
+  def copyfile(self, source, outputfile):
+    if outputfile is self.wfile and self.sendRange is not None:
+      (offset,count)=self.sendRange
+      self.sendRange=None
+      self.copyRange(source,offset,count)
+      return
+    super().copyfile(source,outputfile)
+
+  def parseRange(self,size,lastModified=None):
+    '''
+    parse the Range header of the request
+    we only handle a single byte range
+    @param size: the size of the file
+    @param lastModified: the Last-Modified header we send, to check If-Range
+    @return: None for the complete file, False if the range cannot be satisfied,
+             (start,end) otherwise (end inclusive)
+    '''
+    rangeHeader=self.headers.get('Range')
+    if rangeHeader is None:
+      return None
+    ifRange=self.headers.get('If-Range')
+    if ifRange is not None and ifRange != lastModified:
+      return None
+    match=re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$',rangeHeader)
+    if match is None:
+      return None
+    start,end=match.group(1),match.group(2)
+    if start == '':
+      if end == '':
+        return None
+      suffix=int(end)
+      if suffix == 0:
+        return False
+      return (max(0,size-suffix),size-1)
+    start=int(start)
+    if end != '' and int(end) < start:
+      return None
+    if start >= size:
+      return False
+    end=int(end) if end != '' else size-1
+    return (start,min(end,size-1))
+
+  def sendRangeResponse(self,size,lastModified=None):
+    '''
+    send the response code, Content-Length and the range headers for a file
+    the caller has to send the other headers
+    @return: (offset,count) to be sent,
+             None if the range cannot be satisfied (response already sent)
+    '''
+    range=self.parseRange(size,lastModified)
+    if range is False:
+      self.send_response(416)
+      self.send_header("Content-Range","bytes */%d"%size)
+      self.send_header("Content-Length","0")
+      self.end_headers()
+      return None
+    if range is None:
+      self.send_response(200)
+      self.send_header("Accept-Ranges","bytes")
+      self.send_header("Content-Length",str(size))
+      return (0,size)
+    (start,end)=range
+    self.send_response(206)
+    self.send_header("Accept-Ranges","bytes")
+    self.send_header("Content-Range","bytes %d-%d/%d"%(start,end,size))
+    self.send_header("Content-Length",str(end-start+1))
+    return (start,end-start+1)
+
+  @classmethod
+  def canSendFile(cls,fh):
+    try:
+      return stat.S_ISREG(os.fstat(fh.fileno()).st_mode)
+    except (AttributeError,io.UnsupportedOperation,OSError):
+      return False
+
+  def copyRange(self,fh,offset,count):
+    '''
+    send count bytes from fh starting at offset
+    regular files are sent with sendfile (without copying them through python)
+    '''
+    if count <= 0:
+      return
+    if self.canSendFile(fh):
+      self.wfile.flush()
+      sent=self.connection.sendfile(fh,offset,count)
+      if sent < count:
+        raise Exception("no more data")
+      return
+    if offset != 0:
+      fh.seek(offset)
+    maxread = 1000000
+    while count > 0:
+      buf = fh.read(maxread if count > maxread else count)
+      if buf is None or len(buf) == 0:
+        raise Exception("no more data")
+      self.wfile.write(buf)
+      count -= len(buf)
+
   def getPageRoot(self):
     path = self.server.getStringParam('index')
     return re.sub("/[^/]*$", "", path)
@@ -229,24 +500,57 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
 
 
   #send a json encoded response
+  #rtj can be a json string or a NavResponse
+  #for a NavResponse we send an ETag and answer If-None-Match with 304
   def sendNavResponse(self,rtj,requestParam=None):
     if not rtj is None:
+      etag=None
+      if isinstance(rtj,NavResponse):
+        etag=rtj.etag
+        wbytes=rtj.data
+      else:
+        wbytes=rtj.encode('utf-8')
+      callback=None
+      if requestParam is not None:
+        callback=requestParam.get('callback')
+      if callback is not None:
+        etag=None
+      elif etag is not None and self.headers.get('If-None-Match') == etag:
+        self.send_response(304)
+        self.send_header("ETag",etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        AVNLog.ld("nav response not modified",etag)
+        return
       self.send_response(200)
-      if requestParam is not None and not requestParam.get('callback') is None:
-        rtj="%s(%s);"%(requestParam.get('callback'),rtj)
+      if callback is not None:
+        wbytes=("%s("%callback).encode('utf-8')+wbytes+b");"
         self.send_header("Content-type", "text/javascript")
       else:
         self.send_header("Content-type", "application/json")
-      wbytes=rtj.encode('utf-8')
       self.send_header("Content-Length", str(len(wbytes)))
       self.send_header("Last-Modified", self.date_time_string())
-      self.send_header("Cache-Control", "no-store")
+      if etag is not None:
+        self.send_header("ETag",etag)
+        self.send_header("Cache-Control", "no-cache")
+      else:
+        self.send_header("Cache-Control", "no-store")
       self.end_headers()
       self.wfile.write(wbytes)
-      AVNLog.ld("nav response",rtj)
+      AVNLog.ld("nav response",wbytes)
     else:
       AVNLog.ld("empty response")
 
+  def getCachedResponse(self,requestParam,generation,creator):
+    '''
+    get the response for a request from the response cache of the server
+    @param generation: the store generation the response depends on, None if only time based
+    @param creator: a function(requestParam) returning the json string
+    @return: a NavResponse
+    '''
+    return self.server.responseCache.get(NavResponseCache.requestKey(requestParam),generation,
+                                         lambda: creator(requestParam))
+
   def sendJsFile(self,filename,baseUrl,addCode=None):
     '''
     send a js file that we encapsulate into an anonymus function
@@ -299,13 +603,15 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     try:
       rtj=None
       if requestType=='gps' or requestType=='self':
-        rtj=self.handleGpsRequest(requestParam)
+        rtj=self.getCachedResponse(requestParam,self.server.navdata.getGeneration(),self.handleGpsRequest)
       elif requestType=='nmeaStatus':
         rtj=self.handleNmeaStatus(requestParam)
       elif requestType=='ais':
-        rtj=self.handleAISRequest(requestParam)
+        rtj=self.getCachedResponse(requestParam,self.server.navdata.getAisGeneration(),self.handleAISRequest)
       elif requestType=='status':
-        rtj=self.handleStatusRequest(requestParam)
+        rtj=self.getCachedResponse(requestParam,None,self.handleStatusRequest)
+      elif requestType=='queueStatus':
+        rtj=self.handleQueueStatusRequest(requestParam)
       elif requestType=='debuglevel' or requestType=='loglevel':
         rtj=self.handleDebugLevelRequest(requestParam)
       elif requestType=='currentloglevel':
@@ -331,7 +637,12 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
       elif requestType=='api':
         #new handling for dedicated requests for some handler
         type=self.getRequestParam(requestParam,'type')
-        rtj=self.handleSpecificRequest(requestParam,type)
+        if type == 'alarm' and self.getRequestParam(requestParam,'status') is not None:
+          #alarm changes are counted in the store
+          rtj=self.getCachedResponse(requestParam,self.server.navdata.getGeneration(),
+                                     lambda rp: self.handleSpecificRequest(rp,type))
+        else:
+          rtj=self.handleSpecificRequest(requestParam,type)
       else:
         #legacy: have the api type as requestType
         rtj=self.handleSpecificRequest(requestParam,requestType)
@@ -359,10 +670,23 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
       rtj = json.dumps(rtj,cls=Encoder)
     return rtj
 
+  def getGenerationParam(self,requestParam):
+    '''
+    get the "since" parameter for delta requests
+    @return: None if not set, -1 if invalid (will return all data)
+    '''
+    since=self.getRequestParam(requestParam,'since')
+    if since is None:
+      return None
+    try:
+      return int(since)
+    except:
+      return -1
+
   #return AIS targets
   #parameter: lat,lon,distance (in NM) - limit to this distance
   def handleAISRequest(self,requestParam):
-    rt=self.server.navdata.getAisData()
+    since=self.getGenerationParam(requestParam)
     lat=None
     lon=None
     lat1=None
@@ -380,43 +704,27 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
         lon1=float(rq)
     except:
       pass
-    frt=[]
+    centers=None
     if not lat is None and not lon is None and not dist is None:
-      dest=(lat,lon)
+      centers=[(lat,lon)]
       AVNLog.debug("limiting AIS to lat=%f,lon=%f,dist=%f",lat,lon,dist)
-      dest1=None
       if lat1 is not None and lon1 is not None:
-        dest1=(lat1,lon1)
+        centers.append((lat1,lon1))
         AVNLog.debug("additional AIS range lat=%f,lon=%f,dist=%f",lat1,lon1,dist)
-      for entry in rt:
-        try:
-          fentry=entry
-          mdist=AVNUtil.distance((fentry.get('lat'),fentry.get('lon')), dest)
-          inRange=False
-          if mdist<=dist:
-            inRange=True
-          else:
-            if dest1 is not None:
-              mdist=AVNUtil.distance((fentry.get('lat'),fentry.get('lon')), dest1)
-              if mdist<=dist:
-                inRange=True
-          if inRange:
-            fentry['distance']=mdist*AVNUtil.NM #have this in m
-            frt.append(fentry)
-          else:
-            AVNLog.debug("filtering out %s due to distance %f",str(fentry['mmsi']),mdist)
-        except:
-          AVNLog.debug("unable to convert ais data: %s",traceback.format_exc())
+    if since is not None:
+      frt=self.server.navdata.getAisChangesSince(since,centers,dist)
+    elif centers is not None:
+      frt=self.server.navdata.getAisDataInRange(centers,dist)
     else:
-      for entry in rt:
-        try:
-          frt.append(entry)
-        except Exception as e:
-          AVNLog.debug("unable to convert ais data: %s",traceback.format_exc())
+      frt=self.server.navdata.getAisData()
     return json.dumps(frt,cls=Encoder)
 
   def handleGpsRequest(self,requestParam):
-    rtv=self.server.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS)
+    since=self.getGenerationParam(requestParam)
+    if since is not None:
+      rtv=self.server.navdata.getChangesSince(since,AVNStore.BASE_KEY_GPS)
+    else:
+      rtv=self.server.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS)
     return json.dumps(rtv,cls=Encoder)
 
   def handleNmeaStatus(self, requestParam):
@@ -474,6 +782,16 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
         rt.append(entry)
     return json.dumps({'handler':rt},cls=Encoder)
 
+  def handleQueueStatusRequest(self,requestParam):
+    '''
+    machine readable statistics for the NMEA queue(s) and their consumers
+    '''
+    rt=[]
+    for handler in AVNWorker.getAllHandlers():
+      if isinstance(handler,AVNQueue):
+        rt.append(handler.getStatistics())
+    return json.dumps({'status':'OK','data':rt},cls=Encoder)
+
   def handleDebugLevelRequest(self,requestParam):
     rt={'status':'ERROR','info':'missing parameter'}
     level=self.getRequestParam(requestParam,'level')
@@ -495,14 +813,13 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     return json.dumps({'status':'OK','level':level,'filter':filter},cls=Encoder)
 
   def writeStream(self,bToSend,fh):
-    maxread = 1000000
-    while bToSend > 0:
-      buf = fh.read(maxread if bToSend > maxread else bToSend)
-      if buf is None or len(buf) == 0:
-        raise Exception("no more data")
-      self.wfile.write(buf)
-      bToSend -= len(buf)
-    fh.close()
+    offset=0
+    if self.canSendFile(fh):
+      offset=fh.tell()
+    try:
+      self.copyRange(fh,offset,bToSend)
+    finally:
+      fh.close()
   def writeChunkedStream(self,fh):
     maxread = 1000000
     while True:
@@ -530,8 +847,17 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     self.wfile.write(wbytes)
 
   def writeFromDownload(self,download: AVNDownload,filename:str=None,noattach:bool=False):
-    self.send_response(200)
     size = download.getSize()
+    range=None
+    if download.isPlainFile():
+      #complete files can be downloaded in parts (resume)
+      lastModified=self.date_time_string(os.path.getmtime(download.filename))
+      range=self.sendRangeResponse(size,lastModified)
+      if range is None:
+        return
+    else:
+      lastModified=self.date_time_string()
+      self.send_response(200)
     if download.dlname is not None:
       filename=download.dlname
     if download.noattach is not None:
@@ -539,15 +865,21 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     if filename is not None and filename != "" and not noattach:
       self.send_header("Content-Disposition", "attachment; %s"%AVNDownload.fileToAttach(filename))
     self.send_header("Content-type", download.getMimeType(self))
-    if size is not None:
-      self.send_header("Content-Length", size)
-    else:
-      self.send_header('Transfer-Encoding', 'chunked')
-    self.send_header("Last-Modified", self.date_time_string())
+    if range is None:
+      if size is not None:
+        self.send_header("Content-Length", size)
+      else:
+        self.send_header('Transfer-Encoding', 'chunked')
+    self.send_header("Last-Modified", lastModified)
     self.end_headers()
     stream = None
     stream = download.getStream()
-    if size is not None:
+    if range is not None:
+      try:
+        self.copyRange(stream,range[0],range[1])
+      finally:
+        stream.close()
+    elif size is not None:
       self.writeStream(size, stream)
     else:
       self.writeChunkedStream(stream)
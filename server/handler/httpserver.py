@@ -25,6 +25,9 @@
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
 
+import collections
+import selectors
+import socket
 import socketserver
 import http.server
 import posixpath
@@ -34,7 +37,8 @@ from typing import Dict, Any
 
 import gemf_reader
 
-from httphandler import AVNHTTPHandler, WebSocketHandler
+from httphandler import AVNHTTPHandler, WebSocketHandler, NavResponseCache
+from asynchttp import AsyncHTTPFrontend
 
 try:
   import create_overview
@@ -51,8 +55,153 @@ except:
 import threading
 
 
+class WorkerPool(object):
+  '''
+  a bounded set of threads working on a queue of tasks
+  threads are created on demand up to numThreads
+  '''
+  def __init__(self,name,numThreads,queueSize):
+    '''
+    @param numThreads: the max number of threads
+    @param queueSize: the max number of tasks waiting for a thread,
+                      submit will fail if the queue is full
+    '''
+    self.name=name
+    self.numThreads=numThreads
+    self.queueSize=queueSize
+    self.condition=threading.Condition()
+    self.queue=collections.deque()
+    self.numStarted=0
+    self.busy=0
+    self.maxBusy=0
+    self.rejected=0
+
+  def submit(self,func,*args):
+    '''
+    run a function in one of the pool threads
+    @return: False if rejected as the pool is exhausted
+    '''
+    with self.condition:
+      idle=self.numStarted-self.busy-len(self.queue)
+      if idle <= 0:
+        if self.numStarted < self.numThreads:
+          self.numStarted+=1
+          thread=threading.Thread(target=self._run,name="%s-%d"%(self.name,self.numStarted))
+          thread.daemon=True
+          thread.start()
+        elif len(self.queue) >= self.queueSize:
+          self.rejected+=1
+          return False
+      self.queue.append((func,args))
+      self.condition.notify()
+    return True
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while len(self.queue) < 1:
+          self.condition.wait()
+        func,args=self.queue.popleft()
+        self.busy+=1
+        if self.busy > self.maxBusy:
+          self.maxBusy=self.busy
+      try:
+        func(*args)
+      except:
+        AVNLog.error("exception in %s: %s",self.name,traceback.format_exc())
+      with self.condition:
+        self.busy-=1
+
+  def getStatus(self):
+    with self.condition:
+      return "%d/%d busy (max %d), %d threads, %d queued, %d rejected"%(
+        self.busy,self.numThreads,self.maxBusy,self.numStarted,len(self.queue),self.rejected)
+
+
+class IdleConnections(object):
+  '''
+  keep alive connections waiting for their next request
+  they do not occupy a pool thread - one thread waits for all of them
+  and calls onReadable when the next request arrives
+  connections that are idle for longer than the timeout are handed to onTimeout
+  '''
+  CHECK_INTERVAL=1
+  def __init__(self,name,timeout,onReadable,onTimeout):
+    '''
+    @param timeout: the max idle time in seconds, None for no limit
+    @param onReadable: function(handler) called when data is available
+    @param onTimeout: function(handler) called for expired connections
+    '''
+    self.name=name
+    self.timeout=timeout
+    self.onReadable=onReadable
+    self.onTimeout=onTimeout
+    self.lock=threading.Lock()
+    self.pending=[]
+    self.selector=selectors.DefaultSelector()
+    self.wakeupReader,self.wakeupWriter=socket.socketpair()
+    self.wakeupReader.setblocking(False)
+    self.selector.register(self.wakeupReader,selectors.EVENT_READ,None)
+    self.resumed=0
+    self.expired=0
+    thread=threading.Thread(target=self._run,name=name)
+    thread.daemon=True
+    thread.start()
+
+  def add(self,handler):
+    '''
+    wait for the next request on the connection of a handler
+    '''
+    with self.lock:
+      self.pending.append(handler)
+    try:
+      self.wakeupWriter.send(b'x')
+    except:
+      pass
+
+  def _run(self):
+    while True:
+      try:
+        events=self.selector.select(self.CHECK_INTERVAL)
+        now=time.monotonic()
+        for key,mask in events:
+          if key.data is None:
+            try:
+              while self.wakeupReader.recv(1024):
+                pass
+            except BlockingIOError:
+              pass
+            continue
+          self.selector.unregister(key.fileobj)
+          self.resumed+=1
+          self.onReadable(key.data[0])
+        with self.lock:
+          pending=self.pending
+          self.pending=[]
+        for handler in pending:
+          try:
+            self.selector.register(handler.connection,selectors.EVENT_READ,(handler,now))
+          except Exception as e:
+            AVNLog.debug("unable to wait for connection: %s",str(e))
+            self.onTimeout(handler)
+        if self.timeout is not None:
+          limit=now-self.timeout
+          for key in list(self.selector.get_map().values()):
+            if key.data is not None and key.data[1] < limit:
+              self.selector.unregister(key.fileobj)
+              self.expired+=1
+              self.onTimeout(key.data[0])
+      except:
+        AVNLog.error("exception in %s: %s",self.name,traceback.format_exc())
+
+  def getStatus(self):
+    return "%d idle, %d resumed, %d expired"%(
+      max(0,len(self.selector.get_map())-1),self.resumed,self.expired)
+
 
 #a HTTP server with threads for each request
+#or with a pool of threads for requests and one for websockets (parameter threadPool)
+#or with an asyncio front end (parameter asyncFrontend)
 class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorker):
   webSocketHandlers: Dict[str, WebSocketHandler]
   navxml=AVNUtil.NAVXML
@@ -93,7 +242,12 @@ class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorke
                      "index":"/viewer/avnav_viewer.html",
                      "chartbase": "maps", #this is the URL without leading /!
                      cls.PORT_CONFIG:"8080",
-                     "numThreads":"5",
+                     "threadPool":"False", #use worker pools instead of a thread for each connection
+                     "numThreads":"5", #threads for requests with threadPool or asyncFrontend
+                     "acceptQueue":"50", #max number of connections waiting for a thread with threadPool
+                     "numWebSocketThreads":"20", #threads for websockets with threadPool
+                     "keepAliveTimeout":"10", #close idle connections after this time (seconds) with threadPool or asyncFrontend
+                     "asyncFrontend":"False", #handle connections in an asyncio loop, requests in numThreads threads
                      "httpHost":"",
         }
     return rt
@@ -134,11 +288,31 @@ class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorke
     self.externalHandlers={} #prefixes that will be handled externally
     self.webSocketHandlers={}
     self.requestHandler=RequestHandlerClass
+    self.responseCache=NavResponseCache()
+    self.requestPool=None
+    self.webSocketPool=None
+    self.idleConnections=None
+    self.asyncFrontend=None
   
   def run(self):
     self.freeAllUsedResources()
     server_address=(self.param['httpHost'],int(self.param[self.PORT_CONFIG]))
-    http.server.HTTPServer.__init__(self, server_address, self.requestHandler)
+    if self.getBoolParam('asyncFrontend'):
+      self.asyncFrontend=AsyncHTTPFrontend(self,max(1,self.getIntParam('numThreads')),self.getKeepAliveTimeout())
+      self.socket=socket.create_server(server_address,backlog=self.request_queue_size)
+      self.server_address=self.socket.getsockname()
+      self.server_name=socket.getfqdn(self.server_address[0])
+      self.server_port=self.server_address[1]
+    elif self.getBoolParam('threadPool'):
+      self.request_queue_size=max(5,self.getIntParam('acceptQueue'))
+      self.requestPool=WorkerPool("HTTPWorker",max(1,self.getIntParam('numThreads')),self.getIntParam('acceptQueue'))
+      #websockets would block forever in the queue, so we do not queue them
+      self.webSocketPool=WorkerPool("WebSocket",max(1,self.getIntParam('numWebSocketThreads')),0)
+      #idle keep alive connections must not block a thread from the request pool
+      self.idleConnections=IdleConnections("HTTPIdle",self.getKeepAliveTimeout(),
+                                           self.resumePooledRequest,self.closeIdleRequest)
+    if self.asyncFrontend is None:
+      http.server.HTTPServer.__init__(self, server_address, self.requestHandler)
     self.claimUsedResource(UsedResource.T_TCP,self.server_port,force=True)
     self.setNameIfEmpty("%s-%d"%(self.getName(),self.server_port))
     AVNLog.info("HTTP server "+self.server_name+", "+str(self.server_port)+" started at thread "+self.name)
@@ -152,7 +326,10 @@ class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorke
       self.interfaceReader=threading.Thread(target=self.readInterfaces)
       self.interfaceReader.daemon=True
       self.interfaceReader.start()
-    self.serve_forever()
+    if self.asyncFrontend is not None:
+      self.asyncFrontend.serve(self.socket)
+    else:
+      self.serve_forever()
 
   def handlePathmapping(self,path):
     if not self.pathmappings is None:
@@ -196,10 +373,102 @@ class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorke
       time.sleep(5)
 
   def getStatusProperties(self):
+    rt={}
     if self.addresslist is not None and len(self.addresslist) > 0:
-      return {'addresses':self.addresslist}
+      rt['addresses']=self.addresslist
+    if self.requestPool is not None:
+      rt['request pool']=self.requestPool.getStatus()
+    if self.webSocketPool is not None:
+      rt['websocket pool']=self.webSocketPool.getStatus()
+    if self.idleConnections is not None:
+      rt['keep alive']=self.idleConnections.getStatus()
+    if self.asyncFrontend is not None:
+      rt['async frontend']=self.asyncFrontend.getStatus()
+    rt['websockets']=AVNHTTPHandler.statistics.getStatus()
+    cacheStats=self.responseCache.getStatistics()
+    rt['response cache']="%d entries, %d hits, %d misses"%(cacheStats['entries'],cacheStats['hits'],cacheStats['misses'])
+    return rt
+
+  def process_request(self, request, client_address):
+    if self.requestPool is None:
+      return super().process_request(request,client_address)
+    if not self.requestPool.submit(self.processPooledRequest,request,client_address):
+      AVNLog.debug("request pool exhausted, rejecting connection from %s",str(client_address))
+      self.rejectRequest(request)
+
+  def rejectRequest(self,request):
+    try:
+      request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    except:
+      pass
+    self.shutdown_request(request)
+
+  def processPooledRequest(self,request,client_address):
+    '''
+    handle a connection in the request pool
+    websocket connections are handed over to the websocket pool
+    after the upgrade, idle keep alive connections are parked
+    in idleConnections
+    '''
+    handler=None
+    try:
+      handler=self.RequestHandlerClass(request,client_address,self)
+    except Exception:
+      self.handle_error(request,client_address)
+    self.finishPooledRequest(handler,request)
+
+  def resumePooledRequest(self,handler):
+    '''
+    called from idleConnections when the next request arrives on a parked connection
+    '''
+    if not self.requestPool.submit(self.processParkedRequest,handler):
+      AVNLog.debug("request pool exhausted, closing connection from %s",str(handler.client_address))
+      self.closeIdleRequest(handler,True)
+
+  def processParkedRequest(self,handler):
+    try:
+      handler.resumeParked()
+    except Exception:
+      self.handle_error(handler.request,handler.client_address)
+    self.finishPooledRequest(handler,handler.request)
+
+  def closeIdleRequest(self,handler,reject=False):
+    handler.parked=False
+    try:
+      handler.finish()
+    except:
+      pass
+    if reject:
+      self.rejectRequest(handler.request)
     else:
-      return {}
+      self.shutdown_request(handler.request)
+
+  def finishPooledRequest(self,handler,request):
+    if handler is not None and handler.parked:
+      self.idleConnections.add(handler)
+      return
+    if handler is not None and handler.wsHandedOver:
+      if self.webSocketPool.submit(handler.runHandedOverWebSocket):
+        return
+      AVNLog.debug("websocket pool exhausted, keeping websocket in request pool")
+      handler.runHandedOverWebSocket()
+      return
+    self.shutdown_request(request)
+
+  def canHandOverWebSocket(self):
+    return self.webSocketPool is not None
+
+  def canParkConnection(self):
+    return self.idleConnections is not None
+
+  def getKeepAliveTimeout(self):
+    '''
+    the timeout for idle connections, None for no timeout
+    '''
+    if self.requestPool is None and not self.getBoolParam('asyncFrontend'):
+      return None
+    rt=self.getFloatParam('keepAliveTimeout')
+    return rt if rt > 0 else None
 
   def registerRequestHandler(self,type,command,handler):
     if type == 'path':
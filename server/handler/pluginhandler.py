@@ -93,6 +93,7 @@ class ApiImpl(AVNApi):
     self.layouts=[]
     self.converters=set()
     self.settingsFiles=[]
+    self.sentenceDecoders=[]
     self.jsCssOnly=False
 
   def isEnabled(self):
@@ -154,6 +155,9 @@ class ApiImpl(AVNApi):
     except:
       pass
     self.converters.clear()
+    for sentence in self.sentenceDecoders:
+      NMEAParser.registerSentenceHandler(sentence,None)
+    self.sentenceDecoders=[]
 
     self.stopHandler()
 
@@ -214,27 +218,44 @@ class ApiImpl(AVNApi):
     else:
       if not key in self.patterns:
         self.patterns.append(key)
+  def _checkPath(self,path):
+    for p in self.patterns:
+      if p == path:
+        return True
+    for p in self.wildcardPatterns:
+      if AVNStore.wildCardMatch(path,p):
+        return True
+    AVNLog.error("%s:setting invalid path %s"%(self.prefix,path))
+    return False
+
   def addData(self,path,value,source=None,record=None,sourcePriority=NMEAParser.DEFAULT_API_PRIORITY):
     if source is None:
       source="plugin-"+self.prefix
-    matches=False
-    for p in self.patterns:
-      if p == path:
-        matches=True
-        break
-    if not matches:
-      for p in self.wildcardPatterns:
-        if AVNStore.wildCardMatch(path,p):
-          matches=True
-          break
-    if not matches:
-      AVNLog.error("%s:setting invalid path %s"%(self.prefix,path))
+    if not self._checkPath(path):
       return False
     self.store.setValue(path,value,source,sourcePriority*10,record=record)
     return True
+
+  def registerNMEADecoder(self, sentence, callback):
+    def handler(parser,tag,darray,source,basePriority,timestamp):
+      values=callback(darray,source)
+      if not values:
+        return False
+      stored=False
+      for path,value in values.items():
+        if not self._checkPath(path):
+          continue
+        self.store.setValue(path,value,source,basePriority,record=tag,timestamp=timestamp)
+        stored=True
+      return stored
+    NMEAParser.registerSentenceHandler(sentence,handler,replace=False)
+    self.sentenceDecoders.append(sentence)
   def getDataByPrefix(self, prefix):
     return self.store.getDataByPrefix(prefix)
 
+  def getChangesSince(self, generation, prefix):
+    return self.store.getChangesSince(generation,prefix)
+
   def getSingleValue(self, key,includeInfo=False):
     return self.store.getSingleValue(key,includeInfo=includeInfo)
 
@@ -31,7 +31,7 @@ import time
 from avnqueue import AVNQueue, Fetcher
 from avnserial import *
 import avnav_handlerList
-from avnav_nmea import NMEAParser
+from avnav_nmea import NMEAParser, NMEAFilter
 from avnav_util import AVNLog
 from avnav_worker import AVNWorker
 
@@ -85,7 +85,8 @@ class SerialWriter(SerialReader):
                           nmeaFilter=self.P_FILTER.fromDict(param),
                           blackList=self.P_BLACKLIST.fromDict(param),
                           sumKey='out',
-                          ownsubsource=self._getSubSourceName() if not self.P_REPLY_RECEIVED.fromDict(param) else None)
+                          ownsubsource=self._getSubSourceName() if not self.P_REPLY_RECEIVED.fromDict(param) else None,
+                          returnBytes=True)
 
     self.addrmap={}
     #the serial device
@@ -194,7 +195,7 @@ class SerialWriter(SerialReader):
           self._fetcher.report()
           if len(data)>0:
             for line in data:
-              self.device.write(line.encode('ascii','ignore'))
+              self.device.write(line)
         except Exception as e:
           AVNLog.debug("Exception %s in serial write, close and reopen %s",traceback.format_exc(),portname)
           try:
@@ -223,7 +224,7 @@ class SerialWriter(SerialReader):
     filterstr=self.P_READFILTER.fromDict(self.param)
     filter=None
     if filterstr != "":
-      filter=filterstr.split(',')
+      filter=NMEAFilter.compile(filterstr)
     source=self.sourceName
     priority=AVNWorker.PRIORITY_PARAM_DESCRIPTION.fromDict(self.param)
     while not self.doStop:
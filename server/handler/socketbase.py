@@ -40,7 +40,7 @@ from avnqueue import AVNQueue, Fetcher
 class SocketReader(object):
   P_STRIP_LEADING = WorkerParameter('stripLeading', False, type=WorkerParameter.T_BOOLEAN,
                                 description="strip anything before $ or ! in received lines")
-  START_PATTERN=re.compile('[$!]')
+  START_PATTERN=re.compile(b'[$!]')
   def __init__(self,socket,queue:AVNQueue,setInfo:InfoHandler,shouldStop=None,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,stripLeading=False):
     self.queue=queue
     self.socket=socket
@@ -82,8 +82,8 @@ class SocketReader(object):
     sock=self.socket
     filterA = None
     if filter:
-      filterA = filter.split(',')
-    pattern=AVNUtil.getNMEACheck()
+      filterA = NMEAFilter.compile(filter)
+    pattern=AVNUtil.getNMEACheck(binary=True)
     peer = "unknown connection"
     try:
       peer="%s:%d"%sock.getsockname()
@@ -92,7 +92,7 @@ class SocketReader(object):
       pass
     AVNLog.info("%s established, start reading",peer)
     self.infoHandler.setInfo(INAME, "receiving %s"%(peer,), WorkerStatus.RUNNING)
-    buffer=""
+    buffer=b""
     try:
       sock.settimeout(1)
       lastReceived=time.time()
@@ -114,34 +114,31 @@ class SocketReader(object):
         if len(data) == 0:
           AVNLog.info("connection lost")
           break
-        buffer=buffer+data.decode('ascii','ignore')
+        #we keep the received bytes - the queue will only decode them when needed
+        buffer=buffer+data
         lines=buffer.splitlines(True)
-        if lines[-1][-1]=='\n':
+        if lines[-1][-1:]==b'\n':
           #last one ends with nl
-          for l in lines:
-            l=l.translate(NMEAParser.STRIPCHARS)
-            l=self._removeLeading(l)
-            if pattern.match(l):
-              if not NMEAParser.checkFilter(l, filterA):
-                continue
-              nmeaSum.add(1)
-              self.queue.addNMEA(l,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
-              if minTime is not None:
-                time.sleep(minTime/1000)
-            else:
-              AVNLog.debug("ignoring unknown data %s",l)
-          buffer=''
+          buffer=b''
         else:
-          for i in range(len(lines)-1):
-            line=lines[i].translate(NMEAParser.STRIPCHARS)
-            line=self._removeLeading(line)
-            if pattern.match(line):
-              nmeaSum.add(1)
-              self.queue.addNMEA(line,source=sourceName,sourcePriority=self.sourcePriority)
+          buffer=lines.pop()
+        batch=[]
+        for l in lines:
+          l=l.translate(None,NMEAParser.STRIPBYTES)
+          l=self._removeLeading(l)
+          if pattern.match(l):
+            if filterA is not None and not filterA.matches(l):
+              continue
+            nmeaSum.add(1)
+            if minTime:
+              self.queue.addNMEA(l,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
+              time.sleep(minTime/1000)
             else:
-              AVNLog.debug("ignoring unknown data %s",lines[i])
-          if len(lines) > 0:
-            buffer=lines[-1]
+              batch.append(l)
+          else:
+            AVNLog.debug("ignoring unknown data %s",l)
+        if len(batch) > 0:
+          self.queue.addNMEABatch(batch,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
         if len(buffer) > 4096:
           AVNLog.debug("no line feed in long data, stopping")
           break
@@ -168,11 +165,18 @@ class SocketReader(object):
     :param blacklist:
     :return:
     '''
+    peer="unknown connection"
+    try:
+      peer="%s:%d"%self.socket.getpeername()
+    except:
+      pass
     fetcher=Fetcher(self.queue,self.infoHandler,
                     nmeaFilter=filterstr,
                     blackList=blacklist,
                     sumKey='writer',
-                    ownsubsource=subsource)
+                    ownsubsource=subsource,
+                    returnBytes=True,
+                    name="writer-%s"%peer)
     try:
       fetcher.report()
       self.socket.sendall(("avnav_server %s\r\n" % (version)).encode('utf-8'))
@@ -182,7 +186,7 @@ class SocketReader(object):
         fetcher.report()
         if len(data) > 0:
           for line in data:
-            self.socket.sendall(line.encode('ascii', errors='ignore'))
+            self.socket.sendall(line)
             hasSend = True
         if not hasSend:
           # just throw an exception if the reader potentially closed the socket
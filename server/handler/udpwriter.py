@@ -93,7 +93,8 @@ class AVNUdpWriter(AVNWorker):
   def run(self):
     self._fetcher=Fetcher(self.queue,self,
                           nmeaFilter=self.FILTER_PARAM.fromDict(self.param),
-                          blackList=self.BLACKLIST_PARAM.fromDict(self.param)
+                          blackList=self.BLACKLIST_PARAM.fromDict(self.param),
+                          returnBytes=True
                           )
     self.setNameIfEmpty("%s-%s:%s" % (self.getName(), self.P_HOST.fromDict(self.param),self.P_PORT.fromDict(self.param)))
     while not self.shouldStop():
@@ -110,7 +111,7 @@ class AVNUdpWriter(AVNWorker):
           self._fetcher.report()
           if len(data) > 0:
             for line in data:
-                self.socket.sendto(line.encode('ascii',errors='ignore'),(addr,port))
+                self.socket.sendto(line,(addr,port))
         self.socket.shutdown(socket.SHUT_RDWR)
         self.socket.close()
       except Exception as e:
@@ -29,6 +29,8 @@ import os
 import sqlite3
 import sys
 import threading
+import time
+import urllib.parse
 
 import create_overview
 from avnav_util import AVNLog, AVNUtil, ChartFile
@@ -39,54 +41,113 @@ from avnav_util import AVNLog, AVNUtil, ChartFile
 #tile_column => x
 #tile_row => 2^^z-1-y
 
-class QueueEntry(object):
-  def __init__(self,tile):
+class ConnectionPool(object):
+  '''
+  read only sqlite connections for a file that can be used from any thread
+  connections are opened on demand up to maxConnections
+  '''
+  #the address space is limited on 32 bit systems
+  MMAP_SIZE=256*1024*1024 if sys.maxsize > 2**32 else 16*1024*1024
+  def __init__(self,filename,maxConnections):
+    self.filename=filename
+    self.maxConnections=max(1,maxConnections)
     self.cond=threading.Condition()
-    self.tile=tile
-    self.data=None
-    self.dataAvailable=False
-
-  def waitAndGet(self):
-    while True:
-      self.cond.acquire()
-      if self.dataAvailable:
-        self.cond.release()
-        return self.data
-      self.cond.wait(5)
-      self.cond.release()
-
-  def wakeUp(self):
-    self.cond.acquire()
-    try:
-      self.cond.notifyAll()
-    finally:
-      self.cond.release()
-  def setData(self,data):
-    self.cond.acquire()
-    self.data=data
-    self.dataAvailable=True
-    self.cond.notify_all()
-    self.cond.release()
+    self.free=[]
+    self.numOpen=0
+    self.closed=False
+    self.requests=0
+    self.waits=0
+    self.waitTime=0
+    self.maxWait=0
+
+  def _connect(self):
+    uri="file:%s?mode=ro"%urllib.parse.quote(os.path.abspath(self.filename))
+    connection=sqlite3.connect(uri,uri=True,check_same_thread=False)
+    connection.execute("pragma mmap_size=%d"%self.MMAP_SIZE)
+    return connection
+
+  def acquire(self,timeout):
+    '''
+    get a connection, wait if all are in use
+    @return: the connection or None if closed or timed out
+    '''
+    start=time.monotonic()
+    connection=None
+    with self.cond:
+      self.requests+=1
+      waited=False
+      while True:
+        if self.closed:
+          return None
+        if len(self.free) > 0:
+          connection=self.free.pop()
+          break
+        if self.numOpen < self.maxConnections:
+          self.numOpen+=1
+          break
+        waited=True
+        remaining=start+timeout-time.monotonic()
+        if remaining <= 0:
+          AVNLog.error("timeout waiting for a connection to %s",self.filename)
+          return None
+        self.cond.wait(remaining)
+      if waited:
+        waitTime=time.monotonic()-start
+        self.waits+=1
+        self.waitTime+=waitTime
+        if waitTime > self.maxWait:
+          self.maxWait=waitTime
+    if connection is None:
+      try:
+        connection=self._connect()
+      except:
+        with self.cond:
+          self.numOpen-=1
+          self.cond.notify()
+        raise
+    return connection
+
+  def release(self,connection):
+    with self.cond:
+      if not self.closed:
+        self.free.append(connection)
+        self.cond.notify()
+        return
+      self.numOpen-=1
+    connection.close()
+
+  def close(self):
+    with self.cond:
+      self.closed=True
+      connections=self.free
+      self.free=[]
+      self.numOpen-=len(connections)
+      self.cond.notify_all()
+    for connection in connections:
+      try:
+        connection.close()
+      except:
+        pass
 
+  def getStatus(self):
+    with self.cond:
+      return "%d requests, %d/%d connections, %d waited (avg %.1fms, max %.1fms)"%(
+        self.requests,self.numOpen,self.maxConnections,self.waits,
+        self.waitTime*1000/self.waits if self.waits > 0 else 0,self.maxWait*1000)
 
 
 class MBTilesFile(ChartFile):
-  def __init__(self,filename,timeout=300):
+  TILE_QUERY="select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?"
+  def __init__(self,filename,timeout=300,numConnections=4):
     self.filename=filename
     self.isOpen=False
-    self.cond=threading.Condition()
-    self.connection=None
     self.zoomlevels=[]
     self.zoomLevelBoundings={}
     self.schemeTMS=True
     self.originalScheme=None
     self.schemeInconsistent=False #if there is a scheme entry in the DB but no avnav_schema
-    self.requestQueue=[]
     self.timeout=timeout
-    self.stop=False
-    self.handler=threading.Thread(target=self.handleRequests)
-    self.handler.setDaemon(True)
-    self.handler.start()
+    self.pool=ConnectionPool(filename,numConnections)
     self.changeCount=AVNUtil.utcnow()
 
   def getOriginalScheme(self):
@@ -94,30 +155,6 @@ class MBTilesFile(ChartFile):
       return None
     return self.originalScheme
 
-  def wakeUp(self):
-    self.cond.acquire()
-    try:
-      self.cond.notify_all()
-    finally:
-      self.cond.release()
-
-  def handleRequests(self):
-    connection=sqlite3.connect(self.filename)
-    while not self.stop:
-      self.cond.acquire()
-      request=None
-      if len(self.requestQueue) > 0:
-        request=self.requestQueue.pop(0)
-      else:
-        self.cond.wait(5)
-      self.cond.release()
-      if request is not None:
-        data=self.getTileDataInternal(request.tile,connection)
-        request.setData(data)
-    connection.close()
-
-
-
   #tile is (z,x,y)
   def zxyToZoomColRow(self,tile):
     if self.schemeTMS:
@@ -141,37 +178,80 @@ class MBTilesFile(ChartFile):
     self.createOverview()
     self.isOpen=True
 
+  def _acquire(self):
+    '''
+    get a connection from the pool
+    raises an exception if we cannot get one - this is not a missing tile
+    '''
+    connection=self.pool.acquire(self.timeout)
+    if connection is None:
+      raise Exception("no connection available for %s"%self.filename)
+    return connection
+
   #tile is (z,x,y)
+  #return None if the tile does not exist, raise an exception on errors
   def getTileData(self,tile,source):
     if not self.isOpen:
       raise Exception("not open")
-    request=QueueEntry(tile)
-    self.cond.acquire()
+    connection=self._acquire()
     try:
-      self.requestQueue.append(request)
-      self.cond.notify_all()
-    except:
-      pass
-    self.cond.release()
-    AVNLog.debug("waiting for tile")
-    data=request.waitAndGet()
-    AVNLog.debug("tile received")
-    return data
+      return self.getTileDataInternal(tile,connection)
+    finally:
+      self.pool.release(connection)
 
   def getTileDataInternal(self,tile,connection):
-    cu=None
+    #the statement is prepared once per connection (sqlite3 statement cache)
+    cu=connection.execute(self.TILE_QUERY,self.zxyToZoomColRow(tile))
     try:
-      cu=connection.execute("select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?",self.zxyToZoomColRow(tile))
       t=cu.fetchone()
+    finally:
       cu.close()
-      return t[0]
-    except Exception as e:
+    if t is None:
+      return None
+    return t[0]
+
+  def getTileDataBatch(self,tiles,source):
+    '''
+    read tiles of one zoom level with a single query
+    for (nearly) complete rectangles we query columns x rows,
+    otherwise one OR term per tile (sqlite uses the index for each)
+    @return: the list of tile data, None for missing tiles - raises an exception on errors
+    '''
+    if not self.isOpen:
+      raise Exception("not open")
+    if len(tiles) < 1:
+      return []
+    requested=[self.zxyToZoomColRow(tile) for tile in tiles]
+    zoom=requested[0][0]
+    if any(r[0] != zoom for r in requested):
+      return super().getTileDataBatch(tiles,source)
+    columns=sorted(set(r[1] for r in requested))
+    rows=sorted(set(r[2] for r in requested))
+    if len(columns)*len(rows) <= 2*len(requested):
+      query="select tile_column,tile_row,tile_data from tiles where zoom_level=? and tile_column in (%s) and tile_row in (%s)"%(
+        ",".join("?"*len(columns)),",".join("?"*len(rows)))
+      param=[zoom]+columns+rows
+    else:
+      query="select tile_column,tile_row,tile_data from tiles where zoom_level=? and (%s)"%(
+        " or ".join(["(tile_column=? and tile_row=?)"]*len(requested)))
+      param=[zoom]
+      for r in requested:
+        param.extend(r[1:])
+    found={}
+    connection=self._acquire()
+    cu=None
+    try:
+      cu=connection.execute(query,param)
+      for column,row,data in cu:
+        found[(column,row)]=data
+    finally:
       if cu is not None:
         try:
           cu.close()
         except:
           pass
-    return None
+      self.pool.release(connection)
+    return [found.get((r[1],r[2])) for r in requested]
 
   def getAvnavXml(self,upzoom=2):
     if not self.isOpen:
@@ -276,18 +356,8 @@ class MBTilesFile(ChartFile):
   def close(self):
     if not self.isOpen:
       return
-    self.stop=True
-    #cancel all requests by returning None
-    self.cond.acquire()
-    requests=self.requestQueue
-    self.requestQueue=[]
-    self.cond.notify_all()
-    self.cond.release()
-    for rq in requests:
-      try:
-        rq.setData(None)
-      except:
-        pass
+    #waiting requests will return None
+    self.pool.close()
 
   def deleteFiles(self):
     self.close()
@@ -300,6 +370,9 @@ class MBTilesFile(ChartFile):
   def getDownloadFile(self):
     return self.filename
 
+  def getStatus(self):
+    return self.pool.getStatus()
+
   def __str__(self):
     rt="mbtiles %s " %(self.filename)
     return rt
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# make the server modules and the handlers importable for the tests
+import os
+import sys
+
+serverDir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+for sub in ('handler',''):
+  path=os.path.normpath(os.path.join(serverDir,sub))
+  if not path in sys.path:
+    sys.path.insert(0,path)
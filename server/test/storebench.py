@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+#
+# measure the contention between readers and writers of the AVNStore
+# a writer thread simulates the decoder (AIS targets and gps values),
+# some reader threads simulate the HTTP clients polling gps and ais data
+# usage: storebench.py [numTargets] [numReaders] [seconds]
+#
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from avnav_store import AVNStore
+
+NUM_KEYS=300
+
+def createStore(numTargets):
+  store=AVNStore(1000,1000,'',False)
+  store.registerKey('gps.bench.*','benchmark keys','storebench')
+  for i in range(0,NUM_KEYS):
+    store.setValue('gps.bench.k%d'%i,random.random())
+  for i in range(0,numTargets):
+    store.setAisValue(str(200000000+i),{'type':1,'lat':54+random.random(),'lon':10+random.random(),
+                                         'speed':random.random(),'course':random.random()*360})
+  return store
+
+def writer(store,numTargets,stop,latencies):
+  while not stop.is_set():
+    i=random.randrange(numTargets)
+    start=time.perf_counter()
+    store.setAisValue(str(200000000+i),{'type':1,'lat':54+random.random(),'lon':10+random.random(),
+                                         'speed':random.random(),'course':random.random()*360})
+    store.setValue('gps.bench.k%d'%(i%NUM_KEYS),random.random())
+    latencies.append(time.perf_counter()-start)
+    time.sleep(0.0002)
+
+def reader(store,stop,counter):
+  while not stop.is_set():
+    store.getAisData()
+    store.getDataByPrefix(AVNStore.BASE_KEY_GPS)
+    counter.append(1)
+    time.sleep(0.01)
+
+def run(numTargets,numReaders,seconds):
+  store=createStore(numTargets)
+  stop=threading.Event()
+  latencies=[]
+  reads=[]
+  threads=[threading.Thread(target=writer,args=(store,numTargets,stop,latencies))]
+  for i in range(0,numReaders):
+    threads.append(threading.Thread(target=reader,args=(store,stop,reads)))
+  for t in threads:
+    t.start()
+  time.sleep(seconds)
+  stop.set()
+  for t in threads:
+    t.join()
+  latencies.sort()
+  def pct(p):
+    return latencies[min(len(latencies)-1,int(len(latencies)*p))]*1000
+  print("readers=%d: writes/s=%d, write latency ms: median=%.3f p99=%.3f max=%.3f, reads/s=%d"%(
+    numReaders,len(latencies)/seconds,pct(0.5),pct(0.99),latencies[-1]*1000,len(reads)/seconds))
+
+if __name__ == '__main__':
+  numTargets=int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+  numReaders=int(sys.argv[2]) if len(sys.argv) > 2 else 6
+  seconds=float(sys.argv[3]) if len(sys.argv) > 3 else 5
+  run(numTargets,0,seconds)
+  run(numTargets,numReaders,seconds)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the compiled AIS unpackers (ais.compile_unpackers)
+import pytest
+
+import ais
+from avnav_nmea import NMEAParser, decodeAisPayload
+from avnav_store import AVNStore
+from avnav_util import AVNUtil
+
+
+def baselineDecode(payload,pad):
+  '''
+  the decoding before the compiled unpackers
+  (NMEAParser.parse_ais_messages and NMEAParser.aisToDict)
+  '''
+  bits=ais.BitVector()
+  bits.from_sixbit(payload,pad)
+  values={'length':bits.bitlen}
+  bits.extend_to(168)
+  try:
+    cooked=ais.aivdm_unpack(0,bits,0,values,ais.aivdm_decode)
+    cooked=ais.postprocess(cooked)
+    expected=ais.lengths.get(values['msgtype'],None)
+    if expected is not None:
+      if type(expected) == type(0):
+        expected=(expected,expected)
+      if values['length'] < expected[0] or values['length'] > expected[1]:
+        return None
+  except:
+    return None
+  rt={'class':'AIS'}
+  for bfe in cooked:
+    name=bfe[0].name
+    rt[NMEAParser.aisFieldTranslations.get(name,name)]=str(bfe[1])
+  if rt.get('mmsi') is None:
+    return None
+  return AVNUtil.convertAIS(rt)
+
+
+def sixbits(payload,pad):
+  '''
+  @return: the payload as a string of 0/1
+  '''
+  rt=''
+  for c in payload:
+    v=ord(c)-48
+    if v > 40:
+      v-=8
+    rt+=format(v,'06b')
+  return rt[0:len(rt)-pad]
+
+
+def armor(bitstring):
+  '''
+  @return: (payload,pad) for a string of 0/1
+  '''
+  pad=(6-len(bitstring) % 6) % 6
+  bitstring+='0'*pad
+  rt=''
+  for i in range(0,len(bitstring),6):
+    v=int(bitstring[i:i+6],2)
+    rt+=chr(v+48 if v < 40 else v+56)
+  return (rt,pad)
+
+
+def sixbitText(text):
+  rt=''
+  for c in text:
+    v=ord(c)
+    rt+=format(v-64 if v >= 64 else v,'06b')
+  return rt
+
+
+NAME_EXTENSION=armor(sixbits('E>j9dp0;TW2@30a6h10V:4QpW;P@Lr5n?WwP8N3kkhuP20',4)+sixbitText('EXT'))
+
+#known payloads (from the test data in test/) and the expected fields
+PAYLOADS=[
+  (1,'13uSbD002JPpe?VOC?5AiQHH0<0W',0,{
+    'mmsi':'265874000','status':0,'turn':0,'speed':7.922444444444444,'accuracy':1,
+    'lon':12.387818333333334,'lat':54.70168833333334,'course':45.4,'heading':44,'second':12}),
+  (1,'13B9>0?000Pq4QPOLL3P090N2<0@',0,{
+    'mmsi':'220352000','status':15,'speed':0.0,'heading':288,'raim':'1'}),
+  (2,'23m3:b030L0FCUFMw1?QV1PF0000',0,{
+    'mmsi':'256953000','turn':6,'lon':4.872818333333333,'lat':52.40202333333333,'course':40.8,'heading':48}),
+  (3,'34STQL0022PtclROJId9f7iF07kC',0,{
+    'mmsi':'305734000','lon':13.256775,'lat':54.89736,'course':248.8,'heading':248,'second':43,'radio':'31955'}),
+  (4,'4025bpiumw`M>Pnp@nOP4Ni0251l',0,{
+    'mmsi':'2190051','year':'2013','month':7,'day':31,'hour':8,'minute':29,'second':14,
+    'lon':11.988525,'lat':55.05215166666667,'epfd':1}),
+  (5,'539SI@42<a<p@q0T000pTi>0PthLE9=<tp00000t1Bk>>5wgN>E4PEQCA1O?U4QC31@Qh00',2,{
+    'mmsi':'211343680','imo_id':9217230,'callsign':'DNPI','shipname':'NILS HOLGERSSON','shiptype':60,
+    'to_bow':10,'to_stern':179,'to_port':14,'to_starboard':14,'beam':28,'length':189,
+    'draught':5.7,'destination':'TRAVEMDE<>TRELLEBG','month':7,'day':31,'hour':15,'minute':30}),
+  (5,'539HODP00000@;?W?T0HTpv380000000000000000h66640Ht0000000000000000000000',2,{
+    'mmsi':'211165010','imo_id':0,'callsign':'DB3939','shipname':'FINO 2','destination':'','hour':24,'minute':60}),
+  (18,'B39cHl008P>ItT7mjnMKCwVUkP06',0,{
+    'mmsi':'211474640','speed':1.749111111111111,'lon':12.58764,'lat':54.809345,'course':146.0,
+    'heading':511,'second':13,'cs':'1'}),
+  (19,'C5N3SRgPEnJGEBT>NhWAwwo862PaLELTBJ:V00000000S0D:R220',0,{
+    'mmsi':'367059850','lon':-88.81039166666666,'lat':29.543695,'course':335.9,'shipname':'CAPT.J.RIMES',
+    'shiptype':70,'to_bow':5,'to_stern':21,'to_port':4,'to_starboard':4,'beam':8,'length':26}),
+  (21,'E>j9dp0;TW2@30a6h10V:4QpW;P@Lr5n?WwP8N3kkhuP20',4,{
+    'mmsi':'992111840','aid_type':'0','name':'WIND FARM BALTIC1NW','lon':12.629956666666667,
+    'lat':54.61290833333333,'to_bow':30,'beam':60,'length':60,'virtual_aid':'0'}),
+  (21,NAME_EXTENSION[0],NAME_EXTENSION[1],{
+    'mmsi':'992111840','name':'WIND FARM BALTIC1NWEXT'}),
+  (24,'H39id=Pl59@Tp40000000000000',2,{
+    'mmsi':'211577910','partno':'0','shipname':'MARTINA'}),
+  (24,'H39id=TUC9=B1404?:A0001p5330',0,{
+    'mmsi':'211577910','partno':'1','shiptype':37,'vendorid':'SIMRAD','callsign':'DOJQ',
+    'to_bow':15,'to_stern':5,'to_port':3,'to_starboard':3,'beam':6,'length':20}),
+]
+
+#payloads of types we do not store
+UNKNOWN_PAYLOADS=[
+  ('802R5Ph0GhGEQiUb2Or=18aj>B06EuOwgwl?wnSwe7wwwwwwsAwwnSomwvww',0),
+  ('?3S>Rb0pBiMTD00',2),
+  (':4aKQL1::=Dh',0),
+]
+
+
+def test_knownTypesCovered():
+  assert set(NMEAParser.aisUnpackers.keys()) == set(AVNStore.knownAISTypes)
+  assert set(p[0] for p in PAYLOADS) == set(AVNStore.knownAISTypes)
+
+
+@pytest.mark.parametrize('msgtype,payload,pad,expected',PAYLOADS,ids=["%d-%s"%(p[0],p[1][0:10]) for p in PAYLOADS])
+def test_decode(msgtype,payload,pad,expected):
+  decoded=decodeAisPayload(payload,pad)
+  assert decoded is not None
+  assert decoded['class'] == 'AIS'
+  assert decoded['type'] == msgtype
+  for k,v in expected.items():
+    assert decoded.get(k) == v,"field %s"%k
+  assert decoded == baselineDecode(payload,pad)
+
+
+@pytest.mark.parametrize('msgtype,payload,pad,expected',PAYLOADS,ids=["%d-%s"%(p[0],p[1][0:10]) for p in PAYLOADS])
+def test_truncated(msgtype,payload,pad,expected):
+  bitstring=sixbits(payload,pad)
+  unpacker=NMEAParser.aisUnpackers[msgtype]
+  #keep the type field complete
+  for length in range(6,len(bitstring)):
+    tpayload,tpad=armor(bitstring[0:length])
+    #the complete decoding rejects messages with a wrong length
+    assert decodeAisPayload(tpayload,tpad) == baselineDecode(tpayload,tpad),"length %d"%length
+    #the unpacker itself stops at the end of the data like aivdm_unpack
+    bits=ais.BitVector()
+    bits.from_sixbit(tpayload,tpad)
+    bits.extend_to(168)
+    try:
+      cooked=ais.postprocess(ais.aivdm_unpack(0,bits,0,{},ais.aivdm_decode))
+    except Exception:
+      #the exception types may differ, unpackAisMessage rejects the message in any case
+      with pytest.raises(Exception):
+        unpacker(bits,{})
+      continue
+    expectedFields={}
+    for bfe in cooked:
+      name=bfe[0].name
+      expectedFields[NMEAParser.aisFieldTranslations.get(name,name)]=str(bfe[1])
+    converted=AVNUtil.convertAIS(expectedFields)
+    #beam and length are computed by NMEAParser.unpackAisMessage
+    converted.pop('beam',None)
+    converted.pop('length',None)
+    unpacked=unpacker(bits,{})
+    assert list(unpacked.keys()) == list(converted.keys()),"length %d"%length
+    assert unpacked == converted,"length %d"%length
+
+
+@pytest.mark.parametrize('payload,pad',UNKNOWN_PAYLOADS)
+def test_unknownTypes(payload,pad):
+  assert decodeAisPayload(payload,pad) is None
+
+
+def test_invalid():
+  assert decodeAisPayload('',0) is None
+  #a valid type 1 with an additional character
+  assert decodeAisPayload('13uSbD002JPpe?VOC?5AiQHH0<0W0',0) is None
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the AVNQueue ring buffer: wrap around, resize, maxAge and batches
+import threading
+import time
+
+from avnqueue import AVNQueue, FetcherStatistics
+
+CAPACITY=10
+
+
+def createQueue(capacity=CAPACITY,maxAge=10):
+  return AVNQueue({'maxList':capacity,'maxAge':maxAge})
+
+
+def record(i):
+  return '$GPTST,%d'%i
+
+
+def fill(queue,count,start=0):
+  '''
+  add count records
+  @return: a dict sequence->record
+  '''
+  rt={}
+  for i in range(start,start+count):
+    assert queue.addNMEA(record(i))
+    rt[queue.sequence]=record(i)+"\r\n"
+  return rt
+
+
+def resize(queue,capacity):
+  #what updateConfig does after storing the changed config
+  queue.param['maxList']=capacity
+  queue.readConfig()
+
+
+def expected(records,first,last):
+  return [records[s] for s in range(first,last+1)]
+
+
+def test_fetchAcrossWrap():
+  queue=createQueue()
+  records=fill(queue,CAPACITY*2+5)
+  last=queue.sequence
+  first=last-CAPACITY+1
+  #the slots of the kept entries wrap around the end of the list
+  assert first % CAPACITY > last % CAPACITY
+  for read in range(first-1,last):
+    numErrors,seq,data=queue.fetchFromHistory(read,maxEntries=100,returnError=True)
+    assert numErrors == 0
+    assert seq == last
+    assert data == expected(records,read+1,last)
+  #limited by maxEntries - continue from the returned sequence
+  read=first-1
+  result=[]
+  while read < last:
+    numErrors,read,data=queue.fetchFromHistory(read,maxEntries=3,returnError=True)
+    assert numErrors == 0
+    assert len(data) <= 3
+    result+=data
+  assert result == expected(records,first,last)
+
+
+def test_fetchOverrun():
+  queue=createQueue()
+  records=fill(queue,CAPACITY*3)
+  last=queue.sequence
+  first=last-CAPACITY+1
+  statistics=FetcherStatistics()
+  numErrors,seq,data=queue.fetchFromHistory(first-8,maxEntries=100,returnError=True,statistics=statistics)
+  assert numErrors == 7
+  assert statistics.droppedOverrun == 7
+  assert statistics.droppedAge == 0
+  assert seq == last
+  assert data == expected(records,first,last)
+
+
+def test_fetchNewOnly():
+  queue=createQueue()
+  fill(queue,CAPACITY+3)
+  #a new fetcher (sequence 0) only gets new entries
+  seq,data=queue.fetchFromHistory(0,waitTime=0.05)
+  assert data == []
+  assert seq == queue.sequence
+  records=fill(queue,2,100)
+  seq,data=queue.fetchFromHistory(seq,maxEntries=100)
+  assert data == list(records.values())
+
+
+def test_resizeWhileBehind():
+  queue=createQueue(capacity=20)
+  records=fill(queue,20*2+3)
+  read=queue.sequence-20+2
+  #shrink: the fetcher looses the oldest entries it did not read yet
+  resize(queue,10)
+  assert len(queue.history) == 10
+  last=queue.sequence
+  numErrors,seq,data=queue.fetchFromHistory(read,maxEntries=100,returnError=True)
+  assert numErrors == (last-10+1)-(read+1)
+  assert seq == last
+  assert data == expected(records,last-9,last)
+  #grow: the kept entries stay readable, new ones are appended behind them
+  read=last-7
+  resize(queue,30)
+  assert len(queue.history) == 30
+  records.update(fill(queue,15,1000))
+  last=queue.sequence
+  numErrors,seq,data=queue.fetchFromHistory(read,maxEntries=100,returnError=True)
+  assert numErrors == 0
+  assert seq == last
+  assert data == expected(records,read+1,last)
+  #and now wrap in the bigger buffer
+  records.update(fill(queue,35,2000))
+  last=queue.sequence
+  numErrors,seq,data=queue.fetchFromHistory(last-31,maxEntries=100,returnError=True)
+  assert numErrors == 1
+  assert data == expected(records,last-29,last)
+
+
+def test_maxAge():
+  queue=createQueue(capacity=50,maxAge=1)
+  old=fill(queue,10)
+  start=queue.sequence
+  time.sleep(0.4)
+  new=fill(queue,5,100)
+  last=queue.sequence
+  statistics=FetcherStatistics()
+  numErrors,seq,data=queue.fetchFromHistory(start-10,maxEntries=100,returnError=True,
+                                            maxAge=0.2,statistics=statistics)
+  assert numErrors == 10
+  assert statistics.droppedAge == 10
+  assert statistics.droppedOverrun == 0
+  assert seq == last
+  assert data == list(new.values())
+  #the configured maxAge (1s) still includes the old entries
+  numErrors,seq,data=queue.fetchFromHistory(start-10,maxEntries=100,returnError=True)
+  assert numErrors == 0
+  assert data == list(old.values())+list(new.values())
+  #all entries too old: nothing returned, continue behind the last entry
+  time.sleep(0.4)
+  numErrors,seq,data=queue.fetchFromHistory(start-10,maxEntries=100,returnError=True,
+                                            maxAge=0.2,waitTime=0.05)
+  assert data == []
+  assert numErrors == 15
+  assert seq == last
+
+
+def test_addNMEABatch():
+  queue=createQueue(capacity=50)
+  start=queue.sequence
+  batch=[record(1),'$GP',record(2),b'$GPTST,3',record(4)]
+  assert queue.addNMEABatch(batch) == 4
+  assert queue.sequence == start+4
+  assert queue.addNMEA(record(5))
+  assert queue.addNMEABatch(['','$G']) == 0
+  assert queue.addNMEABatch([record(6),record(7)]) == 2
+  assert queue.sequence == start+7
+  seq,data=queue.fetchFromHistory(start,maxEntries=100)
+  assert seq == start+7
+  assert data == [record(i)+"\r\n" for i in (1,2,3,4,5,6,7)]
+  seq,data=queue.fetchFromHistory(start+4,maxEntries=100)
+  assert data == [record(i)+"\r\n" for i in (5,6,7)]
+
+
+def test_addNMEABatchWrap():
+  queue=createQueue()
+  start=queue.sequence
+  batch=[record(i) for i in range(CAPACITY*2+3)]
+  assert queue.addNMEABatch(batch) == len(batch)
+  assert queue.sequence == start+len(batch)
+  numErrors,seq,data=queue.fetchFromHistory(start,maxEntries=100,returnError=True)
+  assert numErrors == len(batch)-CAPACITY
+  assert data == [r+"\r\n" for r in batch[-CAPACITY:]]
+
+
+def test_addNMEABatchWakesFetcher():
+  queue=createQueue(capacity=50)
+  start=queue.sequence
+  result=[]
+
+  def fetch():
+    result.append(queue.fetchFromHistory(start,maxEntries=100,waitTime=5))
+
+  fetcher=threading.Thread(target=fetch)
+  fetcher.start()
+  time.sleep(0.1)
+  queue.addNMEABatch([record(i) for i in range(5)])
+  fetcher.join(2)
+  assert not fetcher.is_alive()
+  assert result[0] == (start+5,[record(i)+"\r\n" for i in range(5)])
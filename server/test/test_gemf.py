@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the GEMF reader: range lookup and split files
+import os
+import random
+import struct
+
+import pytest
+
+from gemf_reader import GemfFile, RangeIndex
+
+
+def linearFind(ranges,x,y):
+  '''
+  the range lookup before the RangeIndex
+  '''
+  for r in ranges:
+    if x < r[0] or x > r[1] or y < r[2] or y > r[3]:
+      continue
+    return r
+  return None
+
+
+def randomLayout(rnd,size):
+  '''
+  non overlapping ranges in a size x size area
+  @return: list of (xmin,xmax,ymin,ymax,offset)
+  '''
+  used=set()
+  rt=[]
+  for i in range(0,rnd.randint(1,40)):
+    xmin=rnd.randint(0,size-1)
+    ymin=rnd.randint(0,size-1)
+    xmax=min(size-1,xmin+rnd.choice([0,0,1,3,rnd.randint(0,size)]))
+    ymax=min(size-1,ymin+rnd.choice([0,0,1,3,rnd.randint(0,size)]))
+    tiles=set((x,y) for x in range(xmin,xmax+1) for y in range(ymin,ymax+1))
+    if tiles & used:
+      continue
+    used|=tiles
+    rt.append((xmin,xmax,ymin,ymax,len(rt)*1000))
+  return rt
+
+
+def test_rangeIndexParity():
+  rnd=random.Random(4711)
+  size=24
+  for layout in range(0,300):
+    ranges=randomLayout(rnd,size)
+    index=RangeIndex(ranges)
+    for x in range(-2,size+2):
+      for y in range(-2,size+2):
+        assert index.find(x,y) == linearFind(ranges,x,y),"layout %d, ranges %s, tile %d,%d"%(layout,ranges,x,y)
+
+
+def test_rangeIndexEmpty():
+  index=RangeIndex([])
+  assert index.find(0,0) is None
+
+
+#source name -> zoom -> list of (xmin,xmax,ymin,ymax)
+SOURCES={
+  'a':{5:[(0,2,0,1),(4,5,3,6)],6:[(10,10,20,22)]},
+  'b':{5:[(1,1,1,1)]},
+}
+
+
+def tileData(source,z,x,y):
+  #different lengths
+  return ("%s %d/%d/%d;"%(source,z,x,y)*(1+(x+y)%3)).encode('ascii')
+
+
+def createGemf(path,parts):
+  '''
+  write a gemf file, split into parts
+  @param parts: number of files
+  @return: (file name,dict (source,z,x,y) -> data,list of part lengths)
+  '''
+  names=sorted(SOURCES.keys())
+  header=struct.pack("!3l",4,256,len(names))
+  for idx,name in enumerate(names):
+    header+=struct.pack("!2l",idx,len(name))+name.encode('ascii')
+  ranges=[]
+  for idx,name in enumerate(names):
+    for z,zranges in SOURCES[name].items():
+      for r in zranges:
+        ranges.append((name,idx,z)+r)
+  header+=struct.pack("!l",len(ranges))
+  indexStart=len(header)+32*len(ranges)
+  numTiles=0
+  for name,idx,z,xmin,xmax,ymin,ymax in ranges:
+    header+=struct.pack("!6lq",z,xmin,xmax,ymin,ymax,idx,indexStart+12*numTiles)
+    numTiles+=(xmax-xmin+1)*(ymax-ymin+1)
+  dataStart=indexStart+12*numTiles
+  index=b''
+  tiles=[]
+  tileStarts=[]
+  expected={}
+  offset=dataStart
+  for name,idx,z,xmin,xmax,ymin,ymax in ranges:
+    for x in range(xmin,xmax+1):
+      for y in range(ymin,ymax+1):
+        data=tileData(name,z,x,y)
+        index+=struct.pack("!ql",offset,len(data))
+        expected[(name,z,x,y)]=data
+        tiles.append(data)
+        tileStarts.append(offset)
+        offset+=len(data)
+  content=header+index+b''.join(tiles)
+  #split at tile borders (a tile is never split between files)
+  borders=[0]+[tileStarts[len(tileStarts)*i//parts] for i in range(1,parts)]+[len(content)]
+  for i in range(0,parts):
+    name=str(path) if i == 0 else "%s-%d"%(path,i)
+    with open(name,"wb") as f:
+      f.write(content[borders[i]:borders[i+1]])
+  return (str(path),expected,[borders[i+1]-borders[i] for i in range(0,parts)])
+
+
+@pytest.mark.parametrize('parts',[1,2,5])
+def test_getTileData(tmp_path,parts):
+  name,expected,lengthes=createGemf(tmp_path/"test.gemf",parts)
+  gemf=GemfFile(name)
+  gemf.open()
+  try:
+    assert gemf.lengthes == lengthes
+    for (source,z,x,y),data in expected.items():
+      assert gemf.getTileData((z,x,y),source) == data
+    #missing tiles
+    assert gemf.getTileData((5,3,0),'a') is None
+    assert gemf.getTileData((5,1,1),'c') is None
+    assert gemf.getTileData((7,1,1),'a') is None
+  finally:
+    gemf.close()
+  with pytest.raises(Exception):
+    gemf.getTileData((5,1,1),'b')
+
+
+def test_getFileAndOffset(tmp_path):
+  name,expected,lengthes=createGemf(tmp_path/"test.gemf",4)
+  gemf=GemfFile(name)
+  gemf.open()
+  try:
+    assert len(gemf.handles) == 4
+    start=0
+    for i,length in enumerate(lengthes):
+      assert gemf.getFileAndOffset(start) == (gemf.handles[i],0)
+      assert gemf.getFileAndOffset(start+length-1) == (gemf.handles[i],length-1)
+      if start > 0:
+        assert gemf.getFileAndOffset(start-1) == (gemf.handles[i-1],lengthes[i-1]-1)
+      start+=length
+    #behind the last file
+    assert gemf.getFileAndOffset(start) == (None,None)
+    assert gemf.getFileAndOffset(start+1000) == (None,None)
+  finally:
+    gemf.close()
+
+
+def test_invalidOffset(tmp_path):
+  name,expected,lengthes=createGemf(tmp_path/"test.gemf",2)
+  #a missing part makes the tiles behind the first file unreadable - an error, not a missing tile
+  os.unlink(name+"-1")
+  gemf=GemfFile(name)
+  gemf.open()
+  try:
+    assert len(gemf.handles) == 1
+    assert gemf.getTileData((5,0,0),'a') == expected[('a',5,0,0)]
+    with pytest.raises(Exception):
+      gemf.getTileData((6,10,22),'a')
+  finally:
+    gemf.close()
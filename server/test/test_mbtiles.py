@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for reading tiles from mbtiles files
+import random
+import sqlite3
+
+import pytest
+
+from mbtiles_reader import ConnectionPool, MBTilesFile
+
+#zoom level -> (min column,max column,min row,max row) of the stored tiles
+AREAS={
+  3:(1,4,2,5),
+  5:(10,17,12,20),
+}
+#tiles not stored inside the areas: (zoom,column,row)
+HOLES=[(3,2,3),(5,11,13),(5,12,13),(5,15,18)]
+
+
+def createFile(path,scheme=None):
+  connection=sqlite3.connect(path)
+  connection.execute("create table metadata (name text, value text)")
+  connection.execute("create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+  connection.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row)")
+  connection.execute("insert into metadata (name,value) values ('name','test')")
+  if scheme is not None:
+    connection.execute("insert into metadata (name,value) values ('avnav_scheme',?)",[scheme])
+  for zoom,(cmin,cmax,rmin,rmax) in AREAS.items():
+    for column in range(cmin,cmax+1):
+      for row in range(rmin,rmax+1):
+        if (zoom,column,row) in HOLES:
+          continue
+        connection.execute("insert into tiles values (?,?,?,?)",[zoom,column,row,tileData(zoom,column,row)])
+  connection.commit()
+  connection.close()
+  return str(path)
+
+
+def tileData(zoom,column,row):
+  return ("tile %d/%d/%d"%(zoom,column,row)).encode('ascii')
+
+
+def toY(scheme,zoom,row):
+  if scheme == 'xyz':
+    return row
+  return 2**zoom-1-row
+
+
+@pytest.fixture(params=['tms','xyz',None])
+def mbtiles(request,tmp_path):
+  chart=MBTilesFile(createFile(tmp_path/"test.mbtiles",request.param),timeout=5,numConnections=2)
+  chart.open()
+  yield chart,request.param or 'tms'
+  chart.close()
+
+
+def tileRequests(scheme):
+  '''
+  @return: lists of (z,x,y) to be read in one batch
+  '''
+  rnd=random.Random(4711)
+  rt=[]
+  for zoom,(cmin,cmax,rmin,rmax) in AREAS.items():
+    #the complete area and a bit more (missing tiles at the borders)
+    rt.append([(zoom,x,toY(scheme,zoom,row)) for x in range(cmin-1,cmax+2) for row in range(rmin-1,rmax+2)])
+    #a rectangle in the area with holes
+    rt.append([(zoom,x,toY(scheme,zoom,row)) for row in range(rmin,rmin+3) for x in range(cmin,cmin+3)])
+    #scattered tiles (one OR term per tile)
+    rt.append([(zoom,rnd.randint(cmin-2,cmax+2),toY(scheme,zoom,rnd.randint(rmin-2,rmax+2))) for i in range(0,12)])
+    #a single tile, a single missing tile
+    rt.append([(zoom,cmin,toY(scheme,zoom,rmin))])
+    rt.append([(zoom,cmax+5,toY(scheme,zoom,rmax))])
+  #tiles of different zoom levels
+  rt.append([(3,1,toY(scheme,3,2)),(5,10,toY(scheme,5,12)),(4,0,0),(3,4,toY(scheme,3,5))])
+  #duplicates and an unsorted order
+  rt.append([(5,17,toY(scheme,5,20)),(5,10,toY(scheme,5,12)),(5,17,toY(scheme,5,20)),(5,11,toY(scheme,5,13))])
+  return rt
+
+
+def test_getTileData(mbtiles):
+  chart,scheme=mbtiles
+  assert chart.getScheme() == scheme
+  for zoom,(cmin,cmax,rmin,rmax) in AREAS.items():
+    for column in range(cmin,cmax+1):
+      for row in range(rmin,rmax+1):
+        expected=None if (zoom,column,row) in HOLES else tileData(zoom,column,row)
+        assert chart.getTileData((zoom,column,toY(scheme,zoom,row)),None) == expected
+  assert chart.getTileData((4,0,0),None) is None
+
+
+def test_getTileDataBatch(mbtiles):
+  chart,scheme=mbtiles
+  assert chart.getTileDataBatch([],None) == []
+  for tiles in tileRequests(scheme):
+    expected=[chart.getTileData(tile,None) for tile in tiles]
+    assert chart.getTileDataBatch(tiles,None) == expected,"tiles %s"%tiles
+  #ensure we did not only compare missing tiles
+  complete=tileRequests(scheme)[0]
+  data=chart.getTileDataBatch(complete,None)
+  assert len([d for d in data if d is not None]) == 4*4-1
+  assert None in data
+
+
+def test_getTileDataBatchSchemeChange(tmp_path):
+  chart=MBTilesFile(createFile(tmp_path/"test.mbtiles"),timeout=5,numConnections=2)
+  chart.open()
+  try:
+    tiles=[(3,x,y) for x in range(0,8) for y in range(0,8)]
+    tms=chart.getTileDataBatch(tiles,None)
+    assert chart.changeScheme('xyz')
+    xyz=chart.getTileDataBatch(tiles,None)
+    assert xyz == [chart.getTileData(tile,None) for tile in tiles]
+    assert xyz != tms
+    #the same data, just with flipped rows
+    assert xyz == [tms[tiles.index((z,x,7-y))] for z,x,y in tiles]
+  finally:
+    chart.close()
+
+
+def test_getTileDataBatchClosed(tmp_path):
+  chart=MBTilesFile(createFile(tmp_path/"test.mbtiles"),timeout=5,numConnections=2)
+  with pytest.raises(Exception):
+    chart.getTileDataBatch([(3,1,1)],None)
+  chart.open()
+  chart.close()
+  #a closed pool is an error, not a missing tile
+  with pytest.raises(Exception):
+    chart.getTileDataBatch([(3,1,1),(3,1,2)],None)
+  with pytest.raises(Exception):
+    chart.getTileData((3,1,1),None)
+
+
+def test_errorsAreNotMissingTiles(tmp_path):
+  chart=MBTilesFile(createFile(tmp_path/"test.mbtiles"),timeout=0.1,numConnections=1)
+  chart.open()
+  try:
+    tile=(3,1,toY('tms',3,2))
+    #all connections in use - timeout
+    connection=chart.pool.acquire(1)
+    with pytest.raises(Exception):
+      chart.getTileData(tile,None)
+    with pytest.raises(Exception):
+      chart.getTileDataBatch([tile],None)
+    chart.pool.release(connection)
+    assert chart.getTileData(tile,None) == tileData(3,1,2)
+    #query errors
+    chart.TILE_QUERY="select tile_data from nothing where zoom_level=? and tile_column=? and tile_row=?"
+    with pytest.raises(Exception):
+      chart.getTileData(tile,None)
+    #a broken file
+    broken=tmp_path/"broken.mbtiles"
+    broken.write_bytes(b'no database'*100)
+    chart.pool.close()
+    chart.pool=ConnectionPool(str(broken),1)
+    with pytest.raises(Exception):
+      chart.getTileDataBatch([tile,(3,1,1)],None)
+  finally:
+    chart.close()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the navpush protocol: subscribe, deltas, resync and rate limiting
+import json
+import threading
+import time
+
+import pytest
+
+from avnav_store import AVNStore
+from avnnavpush import AVNNavPushHandler, PushConnection
+
+
+class FakeHandler(object):
+  '''
+  collects the messages a PushConnection sends
+  '''
+  def __init__(self):
+    self.lock=threading.Lock()
+    self.messages=[]
+
+  def send_message(self,message):
+    with self.lock:
+      self.messages.append(json.loads(message))
+
+  def close_ws(self):
+    pass
+
+  def take(self,id=None):
+    with self.lock:
+      rt=[m for m in self.messages if id is None or m.get('id') == id]
+      self.messages=[m for m in self.messages if not m in rt]
+    return rt
+
+
+def createStore():
+  store=AVNStore(30,30,'',False)
+  for key in ('gps.lat','gps.lon','gps.speed','nav.x'):
+    store.registerKey(key,'test','test')
+  store.setValue('gps.lat',54.1)
+  store.setValue('gps.lon',10.2)
+  store.setValue('nav.x',1)
+  return store
+
+
+@pytest.fixture
+def pusher():
+  rt=AVNNavPushHandler({'minInterval':'0.2'})
+  rt.navdata=createStore()
+  yield rt
+  rt.stop()
+
+
+def connect(pusher):
+  handler=FakeHandler()
+  connection=pusher.handleApiRequest('websocket','navpush',{},handler=handler)
+  connection.on_ws_connected()
+  return connection,handler
+
+
+def subscribe(connection,id,prefix,interval=0.2,**kwargs):
+  request={'type':'subscribe','id':id,'prefix':prefix,'interval':interval}
+  request.update(kwargs)
+  connection.on_ws_message(json.dumps(request))
+
+
+def withoutInternal(data):
+  '''
+  remove the change counters the store sets itself
+  '''
+  return {k:v for k,v in data.items() if not k.startswith('update')}
+
+
+def push(pusher,connection,now=None):
+  if now is None:
+    now=time.monotonic()
+  return connection.push(pusher.navdata.getGeneration(),pusher.navdata.getAisGeneration(),now)
+
+
+def test_subscribe(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps')
+  messages=handler.take()
+  assert len(messages) == 1
+  m=messages[0]
+  assert m['type'] == 'data'
+  assert m['id'] == 'g'
+  assert m['full']
+  assert m['base'] is None
+  assert m['generation'] == pusher.navdata.getGeneration()
+  assert withoutInternal(m['changed']) == {'lat':54.1,'lon':10.2}
+  #nothing changed - nothing to push
+  assert push(pusher,connection) is None
+  assert handler.take() == []
+
+
+def test_subscribeErrors(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','')
+  connection.on_ws_message(json.dumps({'type':'subscribe','prefix':'gps'}))
+  connection.on_ws_message(json.dumps({'type':'resync','id':'unknown'}))
+  connection.on_ws_message(json.dumps({'type':'invalid','id':'g'}))
+  connection.on_ws_message('no json')
+  messages=handler.take()
+  assert [m['type'] for m in messages] == ['error']*5
+  assert [m['id'] for m in messages] == ['g',None,'unknown','g',None]
+  for i in range(0,PushConnection.MAX_SUBSCRIPTIONS):
+    subscribe(connection,'s%d'%i,'nav')
+  subscribe(connection,'toomany','nav')
+  assert handler.take('toomany')[0]['type'] == 'error'
+  handler.take()
+  #replacing an existing subscription is possible
+  subscribe(connection,'s0','gps')
+  assert withoutInternal(handler.take('s0')[0]['changed']) == {'lat':54.1,'lon':10.2}
+
+
+def test_delta(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps')
+  generation=handler.take()[0]['generation']
+  pusher.navdata.setValue('gps.lat',55)
+  pusher.navdata.setValue('gps.speed',3)
+  pusher.navdata.setValue('nav.x',2)
+  push(pusher,connection,time.monotonic()+1)
+  m=handler.take()
+  assert len(m) == 1
+  assert not m[0]['full']
+  assert m[0]['base'] == generation
+  assert m[0]['generation'] > generation
+  assert m[0]['changed'] == {'lat':55,'speed':3}
+  assert m[0]['removed'] == []
+  #the next delta starts at the generation of the last message
+  pusher.navdata.setValue('gps.lon',11)
+  push(pusher,connection,time.monotonic()+2)
+  n=handler.take()
+  assert n[0]['base'] == m[0]['generation']
+  assert n[0]['changed'] == {'lon':11}
+
+
+def test_otherPrefix(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps',interval=1)
+  handler.take()
+  now=time.monotonic()+1
+  #changes for other prefixes are not sent and do not count as a send
+  pusher.navdata.setValue('nav.x',2)
+  assert push(pusher,connection,now) is None
+  assert handler.take() == []
+  pusher.navdata.setValue('gps.lat',55)
+  push(pusher,connection,now+0.1)
+  assert handler.take()[0]['changed'] == {'lat':55}
+
+
+def test_resync(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps')
+  handler.take()
+  pusher.navdata.setValue('gps.lat',55)
+  connection.on_ws_message(json.dumps({'type':'resync','id':'g'}))
+  m=handler.take()
+  assert len(m) == 1
+  assert m[0]['full']
+  assert m[0]['base'] is None
+  assert withoutInternal(m[0]['changed']) == {'lat':55,'lon':10.2}
+  #nothing left to push after the resync
+  assert push(pusher,connection,time.monotonic()+1) is None
+  assert handler.take() == []
+
+
+def test_unsubscribe(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps')
+  connection.on_ws_message(json.dumps({'type':'unsubscribe','id':'g'}))
+  handler.take()
+  assert not connection.hasSubscriptions()
+  pusher.navdata.setValue('gps.lat',55)
+  assert push(pusher,connection,time.monotonic()+1) is None
+  assert handler.take() == []
+
+
+def test_rateLimit(pusher):
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps',interval=1)
+  subscribe(connection,'n','nav',interval=0.01)
+  start=handler.take('g')[0]['generation']
+  handler.take()
+  #the minInterval of the handler is applied
+  assert connection.subscriptions['n'].interval == 0.2
+  sent=connection.subscriptions['g'].lastSend
+  for i in range(0,5):
+    pusher.navdata.setValue('gps.lat',60+i)
+  #not due yet - the time for the next push is returned
+  assert push(pusher,connection,sent+0.5) == sent+1
+  assert handler.take() == []
+  pusher.navdata.setValue('gps.lon',20)
+  #changes are coalesced
+  assert push(pusher,connection,sent+1) is None
+  m=handler.take()
+  assert len(m) == 1
+  assert m[0]['base'] == start
+  assert m[0]['changed'] == {'lat':64,'lon':20}
+
+
+def test_ais(pusher):
+  store=pusher.navdata
+  for i in range(0,5):
+    store.setAisValue(str(211000000+i),{'type':1,'lat':54+i,'lon':10,'speed':1,'course':2})
+  connection,handler=connect(pusher)
+  subscribe(connection,'a','ais',interval=0.5,centers=[[54,10]],distance=70)
+  m=handler.take()[0]
+  assert m['full']
+  assert sorted(m['changed'].keys()) == ['ais.211000000','ais.211000001']
+  store.setAisValue('211000001',{'type':1,'lat':58,'lon':10,'speed':1,'course':2})
+  store.setAisValue('211000004',{'type':1,'lat':54.2,'lon':10,'speed':1,'course':2})
+  push(pusher,connection,time.monotonic()+1)
+  m=handler.take()[0]
+  assert m['changed'].keys() == {'ais.211000004'}
+  assert m['removed'] == ['ais.211000001']
+
+
+def waitFor(condition,timeout=5):
+  end=time.monotonic()+timeout
+  while time.monotonic() < end:
+    if condition():
+      return True
+    time.sleep(0.02)
+  return False
+
+
+def test_fastAndSlowSubscriber(pusher):
+  '''
+  a subscription with a long interval must not delay the others
+  '''
+  pusher.startThread()
+  slow,slowHandler=connect(pusher)
+  fast,fastHandler=connect(pusher)
+  subscribe(slow,'n','nav',interval=10)
+  subscribe(fast,'g','gps',interval=0.2)
+  assert len(slowHandler.take()) == 1
+  assert len(fastHandler.take()) == 1
+  #now the slow subscription has a change waiting
+  pusher.navdata.setValue('nav.x',2)
+  time.sleep(0.1)
+  for i in range(0,6):
+    pusher.navdata.setValue('gps.lat',60+i)
+    value=60+i
+    assert waitFor(lambda: any(m['changed'].get('lat') == value for m in fastHandler.messages),2),"write %d"%i
+    time.sleep(0.25)
+  messages=fastHandler.take()
+  assert len(messages) == 6
+  for i in range(1,len(messages)):
+    assert messages[i]['base'] == messages[i-1]['generation']
+  assert slowHandler.take() == []
+
+
+def test_pushThread(pusher):
+  pusher.startThread()
+  connection,handler=connect(pusher)
+  subscribe(connection,'g','gps',interval=0.2)
+  handler.take()
+  for i in range(0,20):
+    pusher.navdata.setValue('gps.lat',60+i)
+    time.sleep(0.01)
+  assert waitFor(lambda: any(m['changed'].get('lat') == 79 for m in handler.messages))
+  messages=handler.take()
+  #rate limited to 0.2s
+  assert len(messages) <= 3
+  connection.on_ws_closed()
+  assert pusher.connections == []
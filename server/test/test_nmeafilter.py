@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for NMEAFilter: parity with the former NMEAParser.checkFilter
+import pytest
+
+from avnav_nmea import NMEAFilter, NMEAParser
+
+
+def baselineCheckFilter(line,filter):
+  '''
+  the algorithm of NMEAParser.checkFilter before NMEAFilter
+  '''
+  okMatch = False
+  inversMatch = False
+  hasPositiveCondition = False
+  try:
+    if filter is None:
+      return True
+    for f in filter:
+      invers=False
+      if f[0:1]=="^":
+        invers=True
+        f=f[1:]
+      else:
+        hasPositiveCondition=True
+      if f[0:1]=='$':
+        if line[0:1]!='$':
+          continue
+        if len(f) < 2:
+          if not invers:
+            okMatch=True
+          else:
+            inversMatch=True
+          continue
+        if f[1:4]==line[3:6]:
+          if not invers:
+            okMatch=True
+          else:
+            inversMatch=True
+          continue
+        continue
+      if line.startswith(f):
+        if not invers:
+          okMatch=True
+        else:
+          inversMatch=True
+        continue
+  except:
+    pass
+  if inversMatch:
+    return False
+  if okMatch:
+    return True
+  return not hasPositiveCondition
+
+
+LINES=[
+  '$GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A',
+  '$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47',
+  '$IIMWV,045.0,R,10.5,N,A*1B',
+  '$IIRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A',
+  '$GPRMB,A,0.66,L,003,004,4917.24,N,12309.57,W,001.3,052.5,000.5,V*20',
+  '$PGRME,15.0,M,45.0,M,25.0,M*1C',
+  '!AIVDM,1,1,,A,13aEOK?P00PD2wVMdLDRhgvL289?,0*26',
+  '!AIVDO,1,1,,A,13aEOK?P00PD2wVMdLDRhgvL289?,0*26',
+  '!BSVDM,1,1,,B,13aEOK?P00PD2wVMdLDRhgvL289?,0*26',
+  '$GP',
+  '$',
+  '!',
+  'xyz',
+  '',
+]
+
+FILTERS=[
+  [],
+  [''],
+  ['^'],
+  ['$'],
+  ['^$'],
+  ['!'],
+  ['^!'],
+  ['$RMC'],
+  ['$RM'],
+  ['$RMCX'],
+  ['^$RMC'],
+  ['$RMC','$GGA'],
+  ['$RMC','^$GGA'],
+  ['^$RMC','^$MWV'],
+  ['$GPRMC'],
+  ['$','^$RMC'],
+  ['$','!AIVDM'],
+  ['!AIVDM'],
+  ['!AIVD'],
+  ['^!AIVDO'],
+  ['!AIVDM','^!AIVDO'],
+  ['!','^!BS'],
+  ['$RMC','!AIVDM','^$IIRMC'],
+  ['$IIR','$GPG'],
+  ['$IIR'],
+  ['^$IIR'],
+  ['$GP','^$GPG'],
+  ['$RMC','^$RMC'],
+  ['xy'],
+  ['^xyz'],
+  ['xyz1'],
+]
+
+
+@pytest.mark.parametrize('filter',FILTERS,ids=[",".join(f) if len(f) else "empty" for f in FILTERS])
+def test_parity(filter):
+  compiled=NMEAFilter.compile(filter)
+  fromString=NMEAFilter.compile(",".join(filter)) if len(filter) > 0 else None
+  for line in LINES:
+    expected=baselineCheckFilter(line,filter)
+    assert NMEAParser.checkFilter(line,filter) == expected,"line %s"%line
+    if compiled is None:
+      assert expected
+      continue
+    #twice to check the cached result
+    for i in range(0,2):
+      assert compiled.matches(line) == expected,"line %s"%line
+      assert compiled.matches(line.encode('ascii')) == expected,"line %s (bytes)"%line
+      assert fromString.matches(line) == expected,"line %s (string filter)"%line
+
+
+@pytest.mark.parametrize('filter,line,expected',[
+  (['$RMC'],LINES[0],True),
+  (['$RMC'],LINES[3],True),
+  (['$RMC'],LINES[1],False),
+  (['$RMC'],LINES[6],False),
+  (['^$RMC'],LINES[0],False),
+  (['^$RMC'],LINES[1],True),
+  (['^$RMC'],LINES[6],True),
+  (['$'],LINES[6],False),
+  (['$'],LINES[2],True),
+  (['!AIVDM'],LINES[6],True),
+  (['!AIVDM'],LINES[7],False),
+  (['$','^$RMC'],LINES[3],False),
+  (['$','^$RMC'],LINES[1],True),
+  #$ conditions only compare the sentence type (3 characters), never the talker
+  (['$IIRMC'],LINES[3],False),
+  (['$IIR'],LINES[3],False),
+  (['$RMC','^$RMC'],LINES[0],False),
+])
+def test_semantics(filter,line,expected):
+  assert NMEAFilter.compile(filter).matches(line) == expected
+  assert NMEAFilter.compile(",".join(filter)).matches(line) == expected
+
+
+def test_compile():
+  assert NMEAFilter.compile(None) is None
+  assert NMEAFilter.compile([]) is None
+  filter=NMEAFilter.compile(['$RMC','^$GGA'])
+  assert NMEAFilter.compile('$RMC,^$GGA') is filter
+  assert NMEAFilter.compile(filter) is filter
+  assert str(filter) == '$RMC,^$GGA'
+
+
+def test_cacheOverflow():
+  filter=NMEAFilter.compile(['$RMC','!AIVDM'])
+  for i in range(0,NMEAFilter.MAX_CACHE*2):
+    line='$%02dRMC'%(i % 100) if i % 2 else '!AIV%04d'%i
+    assert filter.matches(line) == baselineCheckFilter(line,['$RMC','!AIVDM'])
+  assert len(filter._cache) <= NMEAFilter.MAX_CACHE
+  assert filter.matches(LINES[0])
+  assert not filter.matches(LINES[1])
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for AVNStore: key tree queries, change feed, AIS grid and expiry
+import random
+import re
+import time
+
+import pytest
+
+from avnav_store import AVNStore
+from avnav_util import AVNUtil
+
+EXPIRY=10
+AIS_EXPIRY=20
+
+KEYS={
+  'gps.lat':54.1,
+  'gps.lon':10.2,
+  'gps.speed':3.5,
+  'gps.test.a':1,
+  'gps.test.b':'x',
+  'gps.test.sub.c':True,
+  'gps.test.sub.d':4.5,
+  'gps.test.sub.deep.e':'e',
+  'gps.other.f':6,
+  'sky.test.g':7,
+}
+
+
+def createStore():
+  store=AVNStore(EXPIRY,AIS_EXPIRY,'',False)
+  store.registerKey('gps.test.*','test keys','test')
+  store.registerKey('gps.other.*','test keys','test')
+  store.registerKey('gps.lat','lat','test')
+  store.registerKey('gps.lon','lon','test')
+  store.registerKey('gps.speed','speed','test')
+  store.registerKey('sky.test.*','test keys','test')
+  for k,v in KEYS.items():
+    store.setValue(k,v)
+  return store
+
+
+def baselineDataByPrefix(values,prefix):
+  '''
+  the algorithm of getDataByPrefix before the key tree (without levels)
+  '''
+  prefix=prefix+"."
+  plen=len(prefix)
+  rt={}
+  for key,value in values.items():
+    if not key.startswith(prefix):
+      continue
+    nkey=re.sub(r'\.*$','',key[plen:])
+    if nkey.find(".") < 0:
+      rt[nkey]=value
+      continue
+    keyparts=nkey.split(".")
+    current=rt
+    for part in keyparts[0:-1]:
+      if current.get(part) is None:
+        current[part]={}
+      nextV=current[part]
+      if not type(nextV) == dict:
+        current[part]={'value':nextV}
+        current=current[part]
+      else:
+        current=nextV
+    current[keyparts[-1]]=value
+  return rt
+
+
+def limitLevels(data,levels):
+  '''
+  the expected result for levels from the complete result
+  '''
+  rt={}
+  for k,v in data.items():
+    if type(v) == dict:
+      if levels > 1:
+        rt[k]=limitLevels(v,levels-1)
+      elif 'value' in v:
+        rt[k]=v['value']
+    else:
+      rt[k]=v
+  return rt
+
+
+def withoutInternal(data):
+  '''
+  remove the change counters the store sets itself
+  '''
+  return {k:v for k,v in data.items() if not k.startswith('update')}
+
+
+@pytest.mark.parametrize('prefix',['gps','gps.test','gps.test.sub','sky','gps.other','gps.none','none'])
+def test_getDataByPrefix(prefix):
+  store=createStore()
+  expected=baselineDataByPrefix(KEYS,prefix)
+  assert withoutInternal(store.getDataByPrefix(prefix)) == expected
+  for levels in (1,2,3):
+    assert withoutInternal(store.getDataByPrefix(prefix,levels)) == limitLevels(expected,levels)
+
+
+def test_getDataByPrefixValueAndChildren():
+  store=createStore()
+  store.setValue('gps.test.sub',99)
+  data=store.getDataByPrefix('gps.test')
+  assert data['sub']['value'] == 99
+  assert data['sub']['c'] is True
+  assert store.getDataByPrefix('gps.test',1)['sub'] == 99
+
+
+def test_changesSince():
+  store=createStore()
+  full=store.getChangesSince(None,'gps.test')
+  assert full['full']
+  assert full['removed'] == []
+  assert full['changed'] == baselineDataByPrefix(KEYS,'gps.test')
+  generation=full['generation']
+  nochange=store.getChangesSince(generation,'gps.test')
+  assert not nochange['full']
+  assert nochange['changed'] == {}
+  assert nochange['generation'] == generation
+  store.setValue('gps.test.sub.c',False)
+  store.setValue('gps.test.x',5)
+  store.setValue('gps.other.f',7)
+  delta=store.getChangesSince(generation,'gps.test')
+  assert not delta['full']
+  assert delta['changed'] == {'sub':{'c':False},'x':5}
+  assert delta['removed'] == []
+  assert delta['generation'] > generation
+  #setting the same value is no change
+  generation=delta['generation']
+  store.setValue('gps.test.x',5)
+  assert store.getChangesSince(generation,'gps.test')['changed'] == {}
+  #a generation from another store (or a restart) gives all data
+  assert store.getChangesSince(store.getGeneration()+1000,'gps.test')['full']
+
+
+def test_changesSinceRemoved():
+  store=createStore()
+  generation=store.getChangesSince(None,'gps.test')['generation']
+  store.expireEntries(time.monotonic()+EXPIRY+1)
+  store.setValue('gps.test.a',2)
+  delta=store.getChangesSince(generation,'gps.test')
+  assert not delta['full']
+  assert delta['changed'] == {'a':2}
+  assert sorted(delta['removed']) == ['b','sub.c','sub.d','sub.deep.e']
+  assert store.getSingleValue('gps.test.b') is None
+  #after REMOVED_PERIOD we do not know the removed keys any more
+  store.expireEntries(time.monotonic()+AVNStore.REMOVED_PERIOD+1)
+  assert store.getChangesSince(generation,'gps.test')['full']
+
+
+def test_expiry():
+  store=createStore()
+  store.setValue('gps.test.keep',1,keepAlways=True)
+  now=time.monotonic()
+  assert store.expireEntries(now) == 0
+  assert store.getSingleValue('gps.lat') == 54.1
+  removed=store.expireEntries(now+EXPIRY+1)
+  assert removed == len(KEYS)
+  assert store.getDataByPrefix('gps.test') == {'keep':1}
+  assert store.getDataByPrefix('sky') == {}
+  assert store.getSingleValue('gps.lat') is None
+  #entries set again are scheduled again
+  store.setValue('gps.lat',55)
+  assert store.getSingleValue('gps.lat') == 55
+
+
+def test_aisExpiry():
+  store=createStore()
+  now=time.monotonic()
+  store.setAisValue('211000001',{'type':1,'lat':54,'lon':10,'speed':1,'course':2},timestamp=now)
+  store.setAisValue('211000002',{'type':1,'lat':54.1,'lon':10,'speed':1,'course':2},timestamp=now+AIS_EXPIRY)
+  assert store.getAisCounter() == 2
+  generation=store.getAisGeneration()
+  assert store.expireEntries(now+AIS_EXPIRY+1) == len(KEYS)+1
+  assert store.getAisCounter() == 1
+  assert [a['mmsi'] for a in store.getAisData()] == ['211000002']
+  delta=store.getAisChangesSince(generation)
+  assert delta['removed'] == ['ais.211000001']
+  assert store.getAisDataInRange([(54,10)],20)[0]['mmsi'] == '211000002'
+
+
+def test_aisDataInRange():
+  rnd=random.Random(4711)
+  store=createStore()
+  targets={}
+  areas=[(54,10,3),(60,179.5,2),(-33,-179.8,2),(78,20,4)]
+  for i in range(0,2000):
+    lat,lon,spread=areas[i % len(areas)]
+    mmsi=str(211000000+i)
+    pos=(lat+rnd.uniform(-spread,spread),((lon+rnd.uniform(-spread,spread)+180) % 360)-180)
+    targets[mmsi]=pos
+    store.setAisValue(mmsi,{'type':1,'lat':pos[0],'lon':pos[1],'speed':1,'course':2})
+  queries=[
+    ([(54,10)],30),
+    ([(54,10),(55,11)],15),
+    ([(60,179.9)],60),
+    ([(-33,179.9)],50),
+    ([(78,20)],120),
+    ([(0,0)],100),
+    ([(54.5,10.5)],3),
+  ]
+  for centers,distance in queries:
+    expected=set()
+    for mmsi,pos in targets.items():
+      for center in centers:
+        if AVNUtil.distance(pos,center) <= distance:
+          expected.add(mmsi)
+          break
+    assert len(expected) > 0 or centers == [(0,0)]
+    result=store.getAisDataInRange(centers,distance)
+    assert set(t['mmsi'] for t in result) == expected,"centers %s, distance %s"%(centers,distance)
+    for t in result:
+      assert t[AVNStore.AIS_DISTANCE_KEY] <= distance*AVNUtil.NM+1
+
+
+def test_aisDataInRangeMoved():
+  store=createStore()
+  store.setAisValue('211000001',{'type':1,'lat':54,'lon':10,'speed':1,'course':2})
+  assert len(store.getAisDataInRange([(54,10)],5)) == 1
+  store.setAisValue('211000001',{'type':1,'lat':58,'lon':10,'speed':1,'course':2})
+  assert len(store.getAisDataInRange([(54,10)],5)) == 0
+  assert len(store.getAisDataInRange([(58,10)],5)) == 1
+  #static data does not change the position
+  store.setAisValue('211000001',{'type':5,'shipname':'TEST'})
+  result=store.getAisDataInRange([(58,10)],5)
+  assert result[0]['shipname'] == 'TEST'
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the segmented LRU tile cache
+import pytest
+
+from tilecache import TileCache
+
+#data size of a test tile - together with the overhead an entry has 1000 bytes
+DATA_SIZE=1000-TileCache.ENTRY_OVERHEAD
+
+
+def key(chart,x):
+  return TileCache.createKey(chart,1,'src',(10,x,5))
+
+
+def data(x):
+  return bytes([x % 256])*DATA_SIZE
+
+
+def checkBytes(cache):
+  assert cache.probationBytes == sum(TileCache._size(d) for d in cache.probation.values())
+  assert cache.protectedBytes == sum(TileCache._size(d) for d in cache.protected.values())
+  assert cache.probationBytes+cache.protectedBytes <= cache.maxBytes
+
+
+def test_promotion():
+  cache=TileCache(10*1000)
+  cache.put(key('a',1),data(1))
+  assert key('a',1) in cache.probation
+  assert cache.contains(key('a',1))
+  #contains does not promote
+  assert key('a',1) in cache.probation
+  assert cache.get(key('a',1)) == (True,data(1))
+  assert key('a',1) in cache.protected
+  assert not key('a',1) in cache.probation
+  assert cache.get(key('a',1)) == (True,data(1))
+  assert key('a',1) in cache.protected
+  assert cache.get(key('a',2)) == (False,None)
+  st=cache.getStatistics()
+  assert (st['hits'],st['misses'],st['entries'],st['bytes']) == (2,1,1,1000)
+  checkBytes(cache)
+
+
+def test_probationEvictedFirst():
+  cache=TileCache(10*1000)
+  #4 tiles used repeatedly
+  for x in range(0,4):
+    cache.put(key('a',x),data(x))
+    cache.get(key('a',x))
+  #a single pass over many tiles
+  for x in range(100,120):
+    cache.put(key('a',x),data(x))
+    checkBytes(cache)
+  for x in range(0,4):
+    assert key('a',x) in cache.protected
+  #only the latest of the single pass tiles survive
+  assert list(cache.probation.keys()) == [key('a',x) for x in range(114,120)]
+  assert cache.getStatistics()['evictions'] == 14
+
+
+def test_protectedLimit():
+  cache=TileCache(10*1000)
+  for x in range(0,10):
+    cache.put(key('a',x),data(x))
+    cache.get(key('a',x))
+    checkBytes(cache)
+  #the oldest protected entries are moved back to probation
+  assert cache.protectedBytes <= cache.maxBytes*TileCache.PROTECTED_RATIO
+  assert list(cache.protected.keys()) == [key('a',x) for x in range(2,10)]
+  assert list(cache.probation.keys()) == [key('a',x) for x in range(0,2)]
+
+
+def test_invalidate():
+  cache=TileCache(20*1000)
+  for chart in ('a','b'):
+    for x in range(0,6):
+      cache.put(key(chart,x),data(x))
+      if x % 2 == 0:
+        cache.get(key(chart,x))
+  #a missing tile
+  cache.put(key('a',10),None)
+  checkBytes(cache)
+  cache.invalidate('a')
+  checkBytes(cache)
+  assert cache.probationBytes == 3*1000
+  assert cache.protectedBytes == 3*1000
+  assert all(k[0] == 'b' for k in list(cache.probation.keys())+list(cache.protected.keys()))
+  cache.invalidate('b')
+  assert (cache.probationBytes,cache.protectedBytes) == (0,0)
+  assert cache.getStatistics()['entries'] == 0
+
+
+def test_getTile():
+  cache=TileCache(10*1000)
+  loads=[]
+
+  def loader(rt):
+    loads.append(rt)
+    return rt
+  assert cache.getTile(key('a',1),lambda: loader(data(1))) == data(1)
+  assert cache.getTile(key('a',1),lambda: loader(data(2))) == data(1)
+  #missing tiles are cached
+  assert cache.getTile(key('a',2),lambda: loader(None)) is None
+  assert cache.getTile(key('a',2),lambda: loader(data(2))) is None
+  assert loads == [data(1),None]
+
+  def failing():
+    raise Exception("read error")
+  #errors are not cached
+  with pytest.raises(Exception):
+    cache.getTile(key('a',3),failing)
+  assert not cache.contains(key('a',3))
+  assert cache.getTile(key('a',3),lambda: loader(data(3))) == data(3)
+
+
+def test_disabled():
+  cache=TileCache(0)
+  assert not cache.isEnabled()
+  cache.put(key('a',1),data(1))
+  assert cache.get(key('a',1)) == (False,None)
+  assert cache.getTile(key('a',1),lambda: data(1)) == data(1)
+  #a tile larger than the cache
+  cache=TileCache(500)
+  cache.put(key('a',1),data(1))
+  assert not cache.contains(key('a',1))
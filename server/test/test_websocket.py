@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+# tests for the websocket handling: permessage-deflate, fragments and the send queue
+import os
+import socket
+import struct
+import threading
+import zlib
+
+import pytest
+
+from avnav_websocket import HTTPWebSocketsHandler, OutQueue, PerMessageDeflate, QueueMessage, \
+  WebSocketStatistics, createFrame, unmask
+
+TRAILER=b'\x00\x00\xff\xff'
+LONG_TEXT="$GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A\r\n"*4
+
+
+class EchoHandler(HTTPWebSocketsHandler):
+  '''
+  sends back every message it receives
+  '''
+  received=None
+
+  def on_ws_message(self,message):
+    self.received.append(message)
+    self.send_message(message)
+
+  def log_message(self,format,*args):
+    pass
+
+
+class Client(object):
+  '''
+  the client side of a websocket connection to an EchoHandler
+  '''
+  def __init__(self,extensions=None):
+    self.sock,serverSock=socket.socketpair()
+    self.sock.settimeout(5)
+    self.received=[]
+
+    def runHandler():
+      handler=EchoHandler.__new__(EchoHandler)
+      handler.received=self.received
+      handler.__init__(serverSock,('127.0.0.1',0),None)
+    self.thread=threading.Thread(target=runHandler,daemon=True)
+    self.thread.start()
+    request="GET /test HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n" \
+            "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n"
+    if extensions is not None:
+      request+="Sec-WebSocket-Extensions: %s\r\n"%extensions
+    self.sock.sendall((request+"\r\n").encode('ascii'))
+    self.buffer=b''
+    while not b'\r\n\r\n' in self.buffer:
+      data=self.sock.recv(4096)
+      assert data,"connection closed during handshake"
+      self.buffer+=data
+    header,_,self.buffer=self.buffer.partition(b'\r\n\r\n')
+    self.headers=header.decode('ascii').split('\r\n')
+    self.compressor=zlib.compressobj(6,zlib.DEFLATED,-15)
+    self.decompressor=zlib.decompressobj(-15)
+
+  def header(self,name):
+    for line in self.headers[1:]:
+      k,_,v=line.partition(':')
+      if k.strip().lower() == name.lower():
+        return v.strip()
+    return None
+
+  def compress(self,data):
+    rt=self.compressor.compress(data)+self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert rt.endswith(TRAILER)
+    return rt[:-len(TRAILER)]
+
+  def sendFrame(self,opcode,payload,fin=True,rsv1=False):
+    if type(payload) is str:
+      payload=payload.encode('utf-8')
+    first=opcode|(0x80 if fin else 0)|(0x40 if rsv1 else 0)
+    length=len(payload)
+    if length <= 125:
+      header=bytes([first,0x80|length])
+    elif length <= 65535:
+      header=bytes([first,0x80|126])+struct.pack(">H",length)
+    else:
+      header=bytes([first,0x80|127])+struct.pack(">Q",length)
+    mask=os.urandom(4)
+    self.sock.sendall(header+mask+unmask(payload,mask))
+
+  def _read(self,num):
+    while len(self.buffer) < num:
+      data=self.sock.recv(65536)
+      assert data,"connection closed"
+      self.buffer+=data
+    rt=self.buffer[0:num]
+    self.buffer=self.buffer[num:]
+    return rt
+
+  def readFrame(self):
+    '''
+    @return: (first byte,payload)
+    '''
+    first,length=self._read(2)
+    assert (length & 0x80) == 0,"server frames must not be masked"
+    length&=0x7f
+    if length == 126:
+      length=struct.unpack(">H",self._read(2))[0]
+    elif length == 127:
+      length=struct.unpack(">Q",self._read(8))[0]
+    return (first,self._read(length))
+
+  def readMessage(self):
+    first,payload=self.readFrame()
+    assert first & 0x80
+    if first & 0x40:
+      payload=self.decompressor.decompress(payload+TRAILER)
+    return (first & 0x0f,payload.decode('utf-8'),(first & 0x40) != 0)
+
+  def close(self):
+    self.sendFrame(0x8,b'')
+    first,payload=self.readFrame()
+    assert first & 0x0f == 0x8
+    self.thread.join(5)
+    assert not self.thread.is_alive()
+    self.sock.close()
+
+
+def test_negotiate():
+  assert PerMessageDeflate.negotiate(None) is None
+  assert PerMessageDeflate.negotiate('x-webkit-deflate-frame') is None
+  deflate,response=PerMessageDeflate.negotiate('permessage-deflate; client_max_window_bits')
+  assert response == 'permessage-deflate'
+  assert not deflate.noContextTakeover
+  deflate,response=PerMessageDeflate.negotiate(
+    'permessage-deflate; server_max_window_bits=8, permessage-deflate; server_no_context_takeover; server_max_window_bits="10"')
+  assert response == 'permessage-deflate; server_no_context_takeover; server_max_window_bits=10'
+  assert deflate.noContextTakeover
+  assert deflate.windowBits == 10
+  assert PerMessageDeflate.negotiate('permessage-deflate; unknown=1') is None
+
+
+@pytest.mark.parametrize('length,headerLength',[(0,2),(125,2),(126,4),(65535,4),(65536,10)])
+def test_createFrame(length,headerLength):
+  message=bytes(i % 251 for i in range(length))
+  frame=createFrame(0x2,message)
+  assert len(frame) == length+headerLength
+  assert frame[0] == 0x82
+  assert frame[headerLength:] == message
+  mask=b'\x01\x82\x33\xf4'
+  assert unmask(unmask(message,mask),mask) == message
+
+
+@pytest.mark.parametrize('noContextTakeover',[False,True])
+def test_compressFrames(noContextTakeover):
+  deflate=PerMessageDeflate(noContextTakeover)
+  decompressor=zlib.decompressobj(-15)
+  for i in range(0,3):
+    frame=createFrame(0x1,LONG_TEXT,deflate)
+    assert frame[0] == 0xc1
+    assert len(frame) < len(LONG_TEXT)
+    assert decompressor.decompress(frame[2:]+TRAILER).decode('utf-8') == LONG_TEXT
+  #small messages and control frames are not compressed
+  assert createFrame(0x1,'short',deflate) == b'\x81\x05short'
+  assert createFrame(0x9,LONG_TEXT[0:100],deflate)[0] == 0x89
+
+
+def test_compressedRoundTrip():
+  client=Client('permessage-deflate; client_max_window_bits')
+  assert client.headers[0].split(' ')[1] == '101'
+  assert client.header('Sec-WebSocket-Extensions') == 'permessage-deflate'
+  for i in range(0,3):
+    message=LONG_TEXT+str(i)
+    client.sendFrame(0x1,client.compress(message.encode('utf-8')),rsv1=True)
+    assert client.readMessage() == (0x1,message,True)
+  #a small message is sent uncompressed by both sides
+  client.sendFrame(0x1,'short')
+  assert client.readMessage() == (0x1,'short',False)
+  client.close()
+  assert client.received == [LONG_TEXT+'0',LONG_TEXT+'1',LONG_TEXT+'2','short']
+
+
+def test_uncompressedRoundTrip():
+  client=Client()
+  assert client.header('Sec-WebSocket-Extensions') is None
+  client.sendFrame(0x1,LONG_TEXT)
+  assert client.readMessage() == (0x1,LONG_TEXT,False)
+  client.close()
+
+
+@pytest.mark.parametrize('compressed',[False,True])
+def test_fragmentedMessage(compressed):
+  client=Client('permessage-deflate' if compressed else None)
+  message=(LONG_TEXT*3).encode('utf-8')
+  if compressed:
+    message=client.compress(message)
+  parts=[message[0:50],message[50:51],message[51:120],message[120:]]
+  #only the first frame has the opcode and rsv1
+  client.sendFrame(0x1,parts[0],fin=False,rsv1=compressed)
+  client.sendFrame(0x0,parts[1],fin=False)
+  #control frames are allowed between the fragments
+  client.sendFrame(0x9,b'ping')
+  assert client.readFrame() == (0x8a,b'ping')
+  client.sendFrame(0x0,parts[2],fin=False)
+  client.sendFrame(0x0,parts[3])
+  assert client.readMessage() == (0x1,LONG_TEXT*3,compressed)
+  #the next message is not appended to the fragments
+  client.sendFrame(0x1,'after fragments')
+  assert client.readMessage() == (0x1,'after fragments',False)
+  client.close()
+  assert client.received == [LONG_TEXT*3,'after fragments']
+
+
+def test_compressedWithoutNegotiation():
+  client=Client()
+  client.sendFrame(0x1,client.compress(LONG_TEXT.encode('utf-8')),rsv1=True)
+  #the handler closes the connection
+  first,payload=client.readFrame()
+  assert first & 0x0f == 0x8
+  client.thread.join(5)
+  assert not client.thread.is_alive()
+  assert client.received == []
+
+
+def test_outQueueOverflow():
+  statistics=WebSocketStatistics()
+  queue=OutQueue(3,statistics)
+  for i in range(0,5):
+    queue.add(QueueMessage("m%d"%i))
+  assert queue.dropped == 2
+  assert statistics.dropped == 2
+  #the oldest messages are dropped
+  assert [m.message for m in queue.readAll(timeout=0)] == ['m2','m3','m4']
+  assert queue.readAll(timeout=0.01) == []
+  assert queue.read(timeout=0.01) is None
+  queue.add(QueueMessage("m5"))
+  assert queue.read(timeout=0).message == 'm5'
+  assert queue.dropped == 2
+  assert '2 dropped' in statistics.getStatus()
+
+
+def test_outQueueWakesReader():
+  queue=OutQueue(10)
+  result=[]
+  reader=threading.Thread(target=lambda: result.append(queue.readAll(timeout=5)))
+  reader.start()
+  queue.add(QueueMessage("m"))
+  reader.join(2)
+  assert not reader.is_alive()
+  assert [m.message for m in result[0]] == ['m']
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+###############################################################################
+# Copyright (c) 2012,2021 Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+###############################################################################
+# a memory limited cache for chart tiles shared by all charts
+
+import collections
+import threading
+
+
+class TileCache(object):
+  '''
+  segmented LRU cache for tiles
+  new tiles go to the probation segment, tiles that are hit again are moved to the
+  protected segment - so a single pass over many tiles (e.g. panning far away)
+  does not evict the tiles that are used repeatedly
+  the key is (chart name, change count, source, z, x, y) - a new change count
+  will never hit old entries, they simply age out
+  missing tiles (None) are cached too
+  '''
+  #approximate memory for an entry without the data
+  ENTRY_OVERHEAD=200
+  #part of the budget for the protected segment
+  PROTECTED_RATIO=0.8
+
+  def __init__(self,maxBytes):
+    self.lock=threading.Lock()
+    self.maxBytes=maxBytes
+    self.probation=collections.OrderedDict()
+    self.protected=collections.OrderedDict()
+    self.probationBytes=0
+    self.protectedBytes=0
+    self.hits=0
+    self.misses=0
+    self.evictions=0
+
+  @classmethod
+  def createKey(cls,chartName,changeCount,source,tile):
+    '''
+    @param tile: (z,x,y)
+    '''
+    return (chartName,changeCount,source,tile[0],tile[1],tile[2])
+
+  @classmethod
+  def _size(cls,data):
+    return cls.ENTRY_OVERHEAD+(len(data) if data is not None else 0)
+
+  def isEnabled(self):
+    return self.maxBytes > 0
+
+  def get(self,key):
+    '''
+    @return: (found,data)
+    '''
+    with self.lock:
+      data=self.protected.get(key,self)
+      if data is not self:
+        self.protected.move_to_end(key)
+        self.hits+=1
+        return (True,data)
+      data=self.probation.pop(key,self)
+      if data is self:
+        self.misses+=1
+        return (False,None)
+      self.hits+=1
+      size=self._size(data)
+      self.probationBytes-=size
+      self.protected[key]=data
+      self.protectedBytes+=size
+      self._shrinkProtected()
+      return (True,data)
+
+  def contains(self,key):
+    '''
+    check for a tile without changing the statistics or the LRU order
+    '''
+    with self.lock:
+      return key in self.protected or key in self.probation
+
+  def put(self,key,data):
+    if not self.isEnabled():
+      return
+    size=self._size(data)
+    if size > self.maxBytes:
+      return
+    with self.lock:
+      if key in self.protected or key in self.probation:
+        return
+      self.probation[key]=data
+      self.probationBytes+=size
+      self._evict()
+
+  def getTile(self,key,loader):
+    '''
+    get a tile from the cache or load and store it
+    @param loader: a function returning the tile data (or None for a missing tile)
+                   if it raises an exception nothing is cached
+    '''
+    if not self.isEnabled():
+      return loader()
+    found,data=self.get(key)
+    if found:
+      return data
+    data=loader()
+    self.put(key,data)
+    return data
+
+  def _shrinkProtected(self):
+    #move the oldest protected entries back to probation
+    limit=self.maxBytes*self.PROTECTED_RATIO
+    while self.protectedBytes > limit and len(self.protected) > 0:
+      key,data=self.protected.popitem(last=False)
+      size=self._size(data)
+      self.protectedBytes-=size
+      self.probation[key]=data
+      self.probationBytes+=size
+    self._evict()
+
+  def _evict(self):
+    while self.probationBytes+self.protectedBytes > self.maxBytes:
+      if len(self.probation) > 0:
+        key,data=self.probation.popitem(last=False)
+        self.probationBytes-=self._size(data)
+      elif len(self.protected) > 0:
+        key,data=self.protected.popitem(last=False)
+        self.protectedBytes-=self._size(data)
+      else:
+        break
+      self.evictions+=1
+
+  def invalidate(self,chartName):
+    '''
+    remove all entries for a chart
+    '''
+    with self.lock:
+      for segment in (self.probation,self.protected):
+        for key in [k for k in segment.keys() if k[0] == chartName]:
+          data=segment.pop(key)
+          if segment is self.probation:
+            self.probationBytes-=self._size(data)
+          else:
+            self.protectedBytes-=self._size(data)
+
+  def getStatistics(self):
+    with self.lock:
+      return {
+        'entries':len(self.probation)+len(self.protected),
+        'bytes':self.probationBytes+self.protectedBytes,
+        'maxBytes':self.maxBytes,
+        'hits':self.hits,
+        'misses':self.misses,
+        'evictions':self.evictions
+      }
+
+  def getStatus(self):
+    st=self.getStatistics()
+    requests=st['hits']+st['misses']
+    return "%d entries, %.1f/%.1f MB, %d hits, %d misses (%.0f%% hit rate), %d evictions"%(
+      st['entries'],st['bytes']/1024/1024,st['maxBytes']/1024/1024,st['hits'],st['misses'],
+      st['hits']*100/requests if requests > 0 else 0,st['evictions'])
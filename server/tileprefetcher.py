@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+###############################################################################
+# Copyright (c) 2012,2021 Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+###############################################################################
+# read the chart tiles ahead of the boat into the tile cache
+
+import math
+import threading
+import time
+import traceback
+
+from avnav_store import AVNStore
+from avnav_util import AVNLog
+from tilecache import TileCache
+
+
+class TilePrefetcher(object):
+  '''
+  predict the track from position, course and speed
+  and load the tiles along this track for the charts and zoom levels
+  that have been requested recently
+  the prefetched tiles go to the probation part of the cache - if they are
+  not used they will be the first to be evicted
+  '''
+  PERIOD=10
+  #only consider charts/zoom levels requested within this time (s)
+  RECENT_TIME=300
+  MAX_RECENT=4
+  #below this speed (m/s) we do not prefetch
+  MIN_SPEED=0.5
+  EARTH_CIRCUMFERENCE=40075016.686
+  KEY_LAT=AVNStore.BASE_KEY_GPS+".lat"
+  KEY_LON=AVNStore.BASE_KEY_GPS+".lon"
+  KEY_COURSE=AVNStore.BASE_KEY_GPS+".track"
+  KEY_SPEED=AVNStore.BASE_KEY_GPS+".speed"
+
+  def __init__(self,chartHandler,minutes,budget):
+    '''
+    @param chartHandler: the AVNChartHandler
+    @param minutes: prefetch the track for this time
+    @param budget: max number of tiles to be read in one period
+    '''
+    self.chartHandler=chartHandler
+    self.minutes=minutes
+    self.budget=budget
+    self.lock=threading.Lock()
+    self.recent={}
+    self.stopEvent=threading.Event()
+    self.thread=None
+    self.loaded=0
+    self.runs=0
+    self.lastInfo="idle"
+
+  def isEnabled(self):
+    return self.minutes > 0 and self.budget > 0 and self.chartHandler.tileCache.isEnabled()
+
+  def recordRequest(self,name,source,zoom):
+    '''
+    called for each tile request
+    '''
+    with self.lock:
+      self.recent[(name,source,zoom)]=time.monotonic()
+
+  def getRecent(self):
+    '''
+    @return: the most recent (name,source,zoom) entries, newest first
+    '''
+    now=time.monotonic()
+    with self.lock:
+      for key,ts in list(self.recent.items()):
+        if ts < (now-self.RECENT_TIME):
+          self.recent.pop(key,None)
+      rt=sorted(self.recent.items(),key=lambda item: item[1],reverse=True)
+    return [item[0] for item in rt[0:self.MAX_RECENT]]
+
+  @classmethod
+  def predictTiles(cls,lat,lon,course,distance,zoom):
+    '''
+    compute the tiles along a rhumb line (a straight line in mercator)
+    @param course: course in degrees
+    @param distance: distance in m
+    @return: list of (x,y), nearest first
+    '''
+    numTiles=2**zoom
+    latr=math.radians(max(-85,min(85,lat)))
+    fx=(lon+180)/360*numTiles
+    fy=(1-math.log(math.tan(latr)+1/math.cos(latr))/math.pi)/2*numTiles
+    #tiles per m at the current latitude
+    scale=numTiles/(cls.EARTH_CIRCUMFERENCE*math.cos(latr))
+    length=distance*scale
+    dx=math.sin(math.radians(course))
+    dy=-math.cos(math.radians(course))
+    rt=[]
+    seen=set()
+    #half tile steps, a 3x3 block around each point
+    steps=int(math.ceil(length*2))
+    for step in range(0,steps+1):
+      px=fx+dx*step/2
+      py=fy+dy*step/2
+      for ox in (0,-1,1):
+        for oy in (0,-1,1):
+          x=int(math.floor(px))+ox
+          y=int(math.floor(py))+oy
+          if y < 0 or y >= numTiles:
+            continue
+          x=x % numTiles
+          if (x,y) in seen:
+            continue
+          seen.add((x,y))
+          rt.append((x,y))
+    return rt
+
+  def prefetch(self):
+    '''
+    one prefetch run
+    @return: the number of tiles read from the charts
+    '''
+    navdata=self.chartHandler.navdata
+    if navdata is None:
+      return 0
+    lat=navdata.getSingleValue(self.KEY_LAT)
+    lon=navdata.getSingleValue(self.KEY_LON)
+    course=navdata.getSingleValue(self.KEY_COURSE)
+    speed=navdata.getSingleValue(self.KEY_SPEED)
+    if lat is None or lon is None or course is None or speed is None:
+      self.lastInfo="no position/course/speed"
+      return 0
+    if speed < self.MIN_SPEED:
+      self.lastInfo="not moving"
+      return 0
+    recent=self.getRecent()
+    if len(recent) < 1:
+      self.lastInfo="no recent chart requests"
+      return 0
+    distance=speed*self.minutes*60
+    cache=self.chartHandler.tileCache
+    loaded=0
+    for name,source,zoom in recent:
+      if loaded >= self.budget or self.stopEvent.is_set():
+        break
+      chartDescription=self.chartHandler.itemList.get(name)
+      if chartDescription is None or not chartDescription.isChart():
+        continue
+      chart=chartDescription.getChart()
+      changeCount=chart.getChangeCount()
+      missing=[]
+      for x,y in self.predictTiles(float(lat),float(lon),float(course),distance,zoom):
+        key=TileCache.createKey(name,changeCount,source,(zoom,x,y))
+        if not cache.contains(key):
+          missing.append(((zoom,x,y),key))
+          if loaded+len(missing) >= self.budget:
+            break
+      if len(missing) < 1:
+        continue
+      data=chart.getTileDataBatch([m[0] for m in missing],source)
+      for (tile,key),tileData in zip(missing,data):
+        cache.put(key,tileData)
+      loaded+=len(missing)
+    self.lastInfo="%d tiles for %d charts/zoom levels"%(loaded,len(recent))
+    return loaded
+
+  def run(self):
+    AVNLog.info("tile prefetcher started")
+    while not self.stopEvent.wait(self.PERIOD):
+      if not self.isEnabled():
+        continue
+      try:
+        loaded=self.prefetch()
+        self.runs+=1
+        self.loaded+=loaded
+      except Exception as e:
+        self.lastInfo="error %s"%str(e)
+        AVNLog.error("error in tile prefetch: %s",traceback.format_exc())
+
+  def start(self):
+    if self.thread is not None and self.thread.is_alive():
+      return
+    self.stopEvent.clear()
+    self.thread=threading.Thread(target=self.run,name="tileprefetcher",daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopEvent.set()
+
+  def getStatus(self):
+    if not self.isEnabled():
+      return "disabled"
+    return "%d tiles in %d runs, last: %s"%(self.loaded,self.runs,self.lastInfo)